@@ -0,0 +1,305 @@
+import abc
+import json
+import logging
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Any, Callable, Dict, Iterable, List, Optional, cast
+import redis
+from sqlalchemy.orm.attributes import instance_state
+
+from allocation import metrics
+from allocation.domain import model
+
+
+logger = logging.getLogger(__name__)
+
+MISSING = object()
+
+
+class AbstractCache(abc.ABC):
+    # the tier label on allocation_allocations_cache_total
+    name = "cache"
+
+    @abc.abstractmethod
+    def get(self, key: str) -> Any:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set(self, key: str, value: Any):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete_many(self, keys: Iterable[str]):
+        raise NotImplementedError
+
+    def generation(self, key: str) -> Any:
+        # taken before loading a value, to be passed to set_if_unchanged; only
+        # tiers shared between processes need to track their invalidations
+        return None
+
+    def set_if_unchanged(self, key: str, value: Any, generation: Any):
+        self.set(key, value)
+
+
+class LRUCache(AbstractCache):
+    name = "local"
+
+    def __init__(self, max_size: int = 10_000, ttl: float = 2.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries: OrderedDict = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            expires, value = self.entries.get(key, (None, MISSING))
+            if value is MISSING:
+                return MISSING
+            if expires < time.monotonic():
+                del self.entries[key]
+                return MISSING
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+
+class RedisCache(AbstractCache):
+    # Shared between processes; values are stored as JSON. Every invalidation
+    # bumps the key's generation, and a value loaded from the database is only
+    # written if its generation has not moved since, so a process that loaded
+    # before another one invalidated cannot put the old rows back.
+
+    name = "redis"
+
+    def __init__(self, client: redis.Redis, ttl: float = 60.0, prefix="cache:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        # long enough to outlast any load that read the generation
+        self.generation_ttl = int(self.ttl * 10 * 1000)
+
+    def get(self, key):
+        # the client is a synchronous one, so this is the value, not an awaitable
+        value = cast(Optional[bytes], self.client.get(self.prefix + key))
+        return MISSING if value is None else json.loads(value)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, json.dumps(value), px=int(self.ttl * 1000))
+
+    def delete_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return
+        pipe = self.client.pipeline(transaction=False)
+        pipe.delete(*[self.prefix + key for key in keys])
+        for key in keys:
+            pipe.incr(self.generation_key(key))
+            pipe.pexpire(self.generation_key(key), self.generation_ttl)
+        pipe.execute()
+
+    def generation(self, key):
+        return self.client.get(self.generation_key(key))
+
+    def set_if_unchanged(self, key, value, generation):
+        generation_key = self.generation_key(key)
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(generation_key)
+                if pipe.get(generation_key) != generation:
+                    return
+                pipe.multi()
+                pipe.set(self.prefix + key, json.dumps(value), px=int(self.ttl * 1000))
+                pipe.execute()
+            except redis.WatchError:
+                pass  # invalidated between the check and the write
+
+    def generation_key(self, key: str) -> str:
+        return f"{self.prefix}generation:{key}"
+
+
+class TieredCache(AbstractCache):
+
+    def __init__(self, *tiers: AbstractCache):
+        self.tiers = tiers
+        self.lock = threading.Lock()
+        self.hits = [0] * len(tiers)
+        self.misses = 0
+        # looked up once here, so counting a lookup is one locked increment
+        self.tier_hits = [
+            metrics.ALLOCATIONS_CACHE.labels(tier.name, "hit") for tier in tiers
+        ]
+        self.tier_misses = [
+            metrics.ALLOCATIONS_CACHE.labels(tier.name, "miss") for tier in tiers
+        ]
+        # bumped on every invalidation, so a value read from the database
+        # before one is not cached after it
+        self.invalidations = 0
+
+    def get(self, key):
+        for i, tier in enumerate(self.tiers):
+            try:
+                value = tier.get(key)
+            except redis.RedisError:
+                logger.warning("cache tier %s unavailable", tier, exc_info=True)
+                continue
+            if value is MISSING:
+                self.tier_misses[i].inc()
+            else:
+                self._count_hit(i)
+                for upper in self.tiers[:i]:
+                    upper.set(key, value)
+                return value
+        with self.lock:
+            self.misses += 1
+        return MISSING
+
+    def set(self, key, value):
+        for tier in self.tiers:
+            try:
+                tier.set(key, value)
+            except redis.RedisError:
+                logger.warning("cache tier %s unavailable", tier, exc_info=True)
+
+    def delete_many(self, keys):
+        keys = list(keys)
+        with self.lock:
+            self.invalidations += 1
+        for tier in self.tiers:
+            try:
+                tier.delete_many(keys)
+            except redis.RedisError:
+                logger.warning("cache tier %s unavailable", tier, exc_info=True)
+
+    def get_or_load(self, key: str, load: Callable[[], Any]):
+        value = self.get(key)
+        if value is not MISSING:
+            return value
+        # invalidations in this process are counted here, the ones in other
+        # processes by the shared tiers' generations
+        invalidations = self.invalidations
+        generations = [self._generation(tier, key) for tier in self.tiers]
+        value = load()
+        with self.lock:
+            stale = invalidations != self.invalidations
+        if stale:
+            return value
+        for tier, generation in zip(self.tiers, generations):
+            if generation is MISSING:
+                continue
+            try:
+                tier.set_if_unchanged(key, value, generation)
+            except redis.RedisError:
+                logger.warning("cache tier %s unavailable", tier, exc_info=True)
+        return value
+
+    def _generation(self, tier: AbstractCache, key: str):
+        try:
+            return tier.generation(key)
+        except redis.RedisError:
+            logger.warning("cache tier %s unavailable", tier, exc_info=True)
+            return MISSING
+
+    @property
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(hits=list(self.hits), misses=self.misses)
+
+    def _count_hit(self, tier: int):
+        with self.lock:
+            self.hits[tier] += 1
+        self.tier_hits[tier].inc()
+
+
+class ProductCache:
+    # Loaded Product aggregates kept between units of work, so a hit skips
+    # the queries and the ORM hydration. A unit of work takes an entry out
+    # while it uses it and only puts it back after a commit, once its events
+    # are collected, so no two ever share one. An entry is only used if
+    # products.version_number still matches, which every change bumps.
+
+    def __init__(self, max_size: int = 1_000):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries: OrderedDict = OrderedDict()
+        self.skus: Dict[str, str] = {}  # batch reference to SKU
+        self.counts: Counter = Counter()
+
+    def take(
+        self, sku: str, current_version: Callable[[], Optional[int]]
+    ) -> Optional[model.Product]:
+        with self.lock:
+            product = self.entries.pop(sku, None)
+        if product is None:
+            result = "miss"
+        elif current_version() != product.version_number:
+            product, result = None, "stale"
+        else:
+            result = "hit"
+        with self.lock:
+            self.counts[result] += 1
+        metrics.PRODUCT_CACHE.labels(result).inc()
+        return product
+
+    def put(self, product: model.Product):
+        with self.lock:
+            self.entries[product.sku] = product
+            self.entries.move_to_end(product.sku)
+            for batchref in loaded_batchrefs(product):
+                self.skus[batchref] = product.sku
+            while len(self.entries) > self.max_size:
+                _, evicted = self.entries.popitem(last=False)
+                for batchref in loaded_batchrefs(evicted):
+                    self.skus.pop(batchref, None)
+
+    def sku_for_batchref(self, batchref: str) -> Optional[str]:
+        return self.skus.get(batchref)
+
+    @property
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(
+                hits=self.counts["hit"],
+                misses=self.counts["miss"],
+                stale=self.counts["stale"],
+            )
+
+
+def loaded_batchrefs(product: model.Product) -> List[str]:
+    # a product loaded lazily may not have its batches yet
+    if "batches" in instance_state(product).unloaded:
+        return []
+    return [batch.reference for batch in product.batches]
+
+
+def allocations_key(orderid: str) -> str:
+    return f"allocations:{orderid}"
+
+
+def allocations_keys(orderids: Iterable[str]) -> List[str]:
+    return [allocations_key(orderid) for orderid in set(orderids)]
+
+
+def make_allocations_cache(redis_client: Optional[redis.Redis] = None):
+    tiers: List[AbstractCache] = [LRUCache()]
+    if redis_client is not None:
+        tiers.append(RedisCache(redis_client))
+    return TieredCache(*tiers)
+
+
+def invalidator(cache: Optional[AbstractCache]):
+    # cached allocations are dropped once the projection has changed them
+    if cache is None:
+        return None
+    return lambda orderids: cache.delete_many(allocations_keys(orderids))
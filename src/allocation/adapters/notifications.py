@@ -1,6 +1,17 @@
 import abc
+import asyncio
+import atexit
+import logging
+import queue
 import smtplib
-from allocation import config
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import DefaultDict, Dict, Optional
+from allocation import config, metrics
+
+
+logger = logging.getLogger(__name__)
 
 
 class AbstractNotifications(abc.ABC):
@@ -10,20 +21,148 @@ class AbstractNotifications(abc.ABC):
         raise NotImplementedError
 
 
-DEFAULT_HOST = config.get_email_host_and_port()["host"]
-DEFAULT_PORT = config.get_email_host_and_port()["port"]
-
-
 class EmailNotifications(AbstractNotifications):
 
-    def __init__(self, smtp_host=DEFAULT_HOST, port=DEFAULT_PORT):
-        self.server = smtplib.SMTP(smtp_host, port=port)
-        self.server.noop()
+    def __init__(self, smtp_host=None, port=None):
+        self.smtp_host = smtp_host or config.get_email_host_and_port()["host"]
+        self.port = port or config.get_email_host_and_port()["port"]
+        # connected on first send and kept open; one connection is shared by
+        # every thread using it
+        self.server = None
+        self.lock = threading.Lock()
 
     def send(self, destination, message):
         msg = f"Subj: allocation service notification\n {message}"
+        with self.lock, metrics.Timer(
+            metrics.ADAPTER_SECONDS.labels("smtp"),
+            metrics.ADAPTER_FAILURES.labels("smtp"),
+        ):
+            try:
+                self._sendmail(destination, msg)
+            except (smtplib.SMTPServerDisconnected, OSError):
+                # the server drops idle connections, so try once on a new one
+                self.close()
+                self._sendmail(destination, msg)
+
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.server = None
+
+    def _sendmail(self, destination, msg):
+        if self.server is None:
+            self.server = smtplib.SMTP(self.smtp_host, port=self.port)
         self.server.sendmail(
             from_addr="allocation@example.com",
             to_addrs=[destination],
             msg=msg,
         )
+
+
+# the messages waiting for each destination, with how often each was sent
+Pending = DefaultDict[str, Counter]
+
+
+class BackgroundNotifications(AbstractNotifications):
+    # send() only queues the message; a worker thread sends everything that
+    # arrived within `window` seconds as one digest per destination, with
+    # repeats of the same message counted rather than sent again
+
+    def __init__(
+        self, notifications: AbstractNotifications, window: Optional[float] = None
+    ):
+        self.notifications = notifications
+        self.window = config.get_notification_window() if window is None else window
+        self.queue: queue.Queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.worker: Optional[threading.Thread] = None
+        # the worker is a daemon, so what it still holds at exit goes out here
+        atexit.register(self.close)
+
+    def send(self, destination, message):
+        with self.lock:
+            if self.worker is None:
+                self.worker = threading.Thread(target=self._run, daemon=True)
+                self.worker.start()
+        self.queue.put((destination, message))
+
+    def close(self, timeout=None):
+        # sends whatever is waiting without waiting for the window to pass
+        with self.lock:
+            worker, self.worker = self.worker, None
+        if worker is not None:
+            self.queue.put(None)
+            worker.join(timeout)
+            if worker.is_alive():
+                return
+        # a send racing with close can queue behind the worker's last item
+        with self.lock:
+            pending = self._drain() if self.worker is None else {}
+        self._send_all(pending)
+
+    def _drain(self) -> Pending:
+        pending: Pending = defaultdict(Counter)
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                return pending
+            if item is not None:
+                destination, message = item
+                pending[destination][message] += 1
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is None:
+                return
+            pending: Pending = defaultdict(Counter)
+            deadline = time.monotonic() + self.window
+            while item is not None:
+                destination, message = item
+                pending[destination][message] += 1
+                try:
+                    item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+            else:
+                stopping = True
+            self._send_all(pending)
+
+    def _send_all(self, pending: Dict[str, Counter]):
+        for destination, messages in pending.items():
+            self._send_digest(destination, messages)
+
+    def _send_digest(self, destination, messages: Counter):
+        digest = "\n".join(
+            message if count == 1 else f"{message} (x{count})"
+            for message, count in messages.items()
+        )
+        try:
+            self.notifications.send(destination, digest)
+        except Exception:
+            logger.exception("Failed to send notification to %s", destination)
+
+
+class AbstractAsyncNotifications(abc.ABC):
+
+    @abc.abstractmethod
+    async def send(self, destination, message):
+        raise NotImplementedError
+
+
+class AsyncEmailNotifications(AbstractAsyncNotifications):
+
+    def __init__(self, smtp_host=None, port=None):
+        self.notifications = EmailNotifications(smtp_host, port)
+        self.lock = asyncio.Lock()
+
+    async def send(self, destination, message):
+        # smtplib blocks, so it runs in a worker thread; one connection is
+        # shared, so sends go out one at a time
+        async with self.lock:
+            await asyncio.to_thread(self.notifications.send, destination, message)
@@ -1,5 +1,22 @@
-from sqlalchemy import MetaData, Table, Column, Integer, String, Date, ForeignKey
+from typing import Literal
+from sqlalchemy import (
+    MetaData,
+    Table,
+    Column,
+    Integer,
+    String,
+    Text,
+    Date,
+    DateTime,
+    ForeignKey,
+    Index,
+    event,
+    func,
+    inspect,
+    text,
+)
 from sqlalchemy.orm import registry, relationship
+from sqlalchemy.schema import CreateColumn
 from allocation.domain import model
 
 metadata = MetaData()
@@ -30,6 +47,8 @@ batches = Table(
     Column("sku", ForeignKey("products.sku")),
     Column("_purchased_quantity", Integer, nullable=False),
     Column("eta", Date, nullable=True),
+    Index("ix_batches_reference", "reference", unique=True),
+    Index("ix_batches_sku", "sku"),
 )
 
 allocations = Table(
@@ -38,6 +57,8 @@ allocations = Table(
     Column("id", Integer, primary_key=True, autoincrement=True),
     Column("orderline_id", ForeignKey("order_lines.id")),
     Column("batch_id", ForeignKey("batches.id")),
+    Index("ix_allocations_batch_id", "batch_id"),
+    Index("ix_allocations_orderline_id", "orderline_id"),
 )
 
 allocations_view = Table(
@@ -46,10 +67,67 @@ allocations_view = Table(
     Column("orderid", String(255)),
     Column("sku", String(255)),
     Column("batchref", String(255)),
+    Index("ix_allocations_view_orderid_sku", "orderid", "sku"),
+    # keyset pagination walks these in order, so a page never sorts or skips
+    Index("ix_allocations_view_sku_orderid", "sku", "orderid", "batchref"),
+    Index("ix_allocations_view_batchref_orderid", "batchref", "orderid", "sku"),
+)
+
+outbox = Table(
+    "outbox",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("channel", String(255), nullable=False),
+    Column("payload", Text, nullable=False),
+    Column("created_at", DateTime, nullable=False, server_default=func.now()),
+    Column("sent_at", DateTime, nullable=True),
+    Column("projected_at", DateTime, nullable=True),
+    Index(
+        "ix_outbox_unsent",
+        "id",
+        postgresql_where=text("sent_at IS NULL"),
+        sqlite_where=text("sent_at IS NULL"),
+    ),
+    Index(
+        "ix_outbox_unprojected",
+        "id",
+        postgresql_where=text("projected_at IS NULL"),
+        sqlite_where=text("projected_at IS NULL"),
+    ),
 )
 
 
-def start_mappers():
+def upgrade_schema(engine):
+    # create_all skips tables that already exist, indexes included
+    metadata.create_all(engine)
+    with engine.begin() as conn:
+        add_missing_columns(conn)
+    for table in metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+
+def add_missing_columns(conn):
+    # only nullable columns without defaults can be added like this
+    inspector = inspect(conn)
+    for table in metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            ddl = CreateColumn(column).compile(dialect=conn.dialect)
+            conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {ddl}"))
+            if table is outbox and column.name == "projected_at":
+                # rows from before the projector were applied to the view by
+                # the old per-event handlers
+                conn.execute(outbox.update().values(projected_at=outbox.c.created_at))
+
+
+# how start_mappers loads relationships no call site asks for explicitly
+Lazy = Literal["select", "selectin", "joined"]
+
+
+def start_mappers(lazy: Lazy = "select"):
     lines_mapper = mapper_registry.map_imperatively(model.OrderLine, order_lines)
     batches_mapper = mapper_registry.map_imperatively(
         model.Batch,
@@ -59,9 +137,24 @@ def start_mappers():
                 lines_mapper,
                 secondary=allocations,
                 collection_class=set,
+                lazy=lazy,
             )
         },
     )
     mapper_registry.map_imperatively(
-        model.Product, products, properties={"batches": relationship(batches_mapper)}
+        model.Product,
+        products,
+        properties={
+            "batches": relationship(batches_mapper, order_by=batches.c.id, lazy=lazy)
+        },
     )
+    # a rollback or refresh reloads what the running totals were built from
+    for cls in [model.Batch, model.Product]:
+        event.listen(cls, "expire", forget_totals)
+        event.listen(cls, "refresh", forget_totals)
+
+
+def forget_totals(target, *args):
+    # None when expiring its parent already dropped the last reference to it
+    if target is not None:
+        target.forget_totals()
@@ -0,0 +1,69 @@
+import json
+from dataclasses import asdict
+from datetime import datetime
+from typing import Iterable, List
+from sqlalchemy import delete, func, insert, select, update
+from allocation.adapters import orm
+from allocation.domain import events
+
+
+# events other services hear about, and the stream each one is published to
+CHANNELS = {
+    events.Allocated: "line_allocated",
+    events.Deallocated: "line_deallocated",
+}
+
+
+def rows_for(messages: Iterable) -> List[dict]:
+    return [
+        dict(channel=CHANNELS[type(message)], payload=json.dumps(asdict(message)))
+        for message in messages
+        if type(message) in CHANNELS
+    ]
+
+
+def add(rows: List[dict]):
+    return insert(orm.outbox).values(rows)
+
+
+def unsent(limit: int):
+    # relays running side by side each get a different batch
+    return (
+        select(orm.outbox.c.id, orm.outbox.c.channel, orm.outbox.c.payload)
+        .where(orm.outbox.c.sent_at.is_(None))
+        .order_by(orm.outbox.c.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+
+
+def mark_sent(ids: List[int]):
+    return update(orm.outbox).where(orm.outbox.c.id.in_(ids)).values(sent_at=func.now())
+
+
+def unprojected(limit: int):
+    return (
+        select(orm.outbox.c.id, orm.outbox.c.channel, orm.outbox.c.payload)
+        .where(orm.outbox.c.projected_at.is_(None))
+        .order_by(orm.outbox.c.id)
+        .limit(limit)
+    )
+
+
+def mark_projected(ids: List[int]):
+    return (
+        update(orm.outbox)
+        .where(orm.outbox.c.id.in_(ids))
+        .values(projected_at=func.now())
+    )
+
+
+def prune(cutoff: datetime, limit: int):
+    # rows relayed and projected before the cutoff are never read again
+    done = (
+        select(orm.outbox.c.id)
+        .where(orm.outbox.c.sent_at < cutoff, orm.outbox.c.projected_at < cutoff)
+        .order_by(orm.outbox.c.id)
+        .limit(limit)
+    )
+    return delete(orm.outbox).where(orm.outbox.c.id.in_(done))
@@ -1,15 +1,33 @@
-import json
-import logging
+import functools
 import redis
-from dataclasses import asdict
+from typing import Iterable, Optional, Tuple
 
-from allocation import config
-from allocation.domain import events
+from allocation import config, metrics
 
 
-r = redis.Redis(**config.get_redis_host_and_port())
+# built on first use, so importing this does not need Redis to be configured
+@functools.lru_cache(maxsize=None)
+def default_client() -> redis.Redis:
+    return redis.Redis(**config.get_redis_host_and_port())
 
 
-def publish(channel, event: events.Event):
-    logging.debug(f"Publishing channel={channel}, event={event}")
-    r.publish(channel, json.dumps(asdict(event)))
+# each channel is a stream, trimmed to roughly this many entries
+STREAM_MAXLEN = 10_000
+
+
+def timed():
+    return metrics.Timer(
+        metrics.ADAPTER_SECONDS.labels("redis"),
+        metrics.ADAPTER_FAILURES.labels("redis"),
+    )
+
+
+def publish_all(
+    messages: Iterable[Tuple[str, str]], client: Optional[redis.Redis] = None
+):
+    # (channel, JSON payload) pairs, as the outbox stores them, in one pipeline
+    pipe = (client or default_client()).pipeline(transaction=False)
+    for channel, payload in messages:
+        pipe.xadd(channel, {"data": payload}, maxlen=STREAM_MAXLEN, approximate=True)
+    with timed():
+        pipe.execute()
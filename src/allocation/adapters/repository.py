@@ -1,6 +1,25 @@
 import abc
+from typing import Any, List, Literal, Optional
+from sqlalchemy import func, select
+from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.sql.base import ExecutableOption
 from allocation.domain import model
-from allocation.adapters import orm
+from allocation.adapters import cache as product_cache, orm
+
+
+# loading strategies for the Product aggregate, picked per call site
+Loading = Literal["lazy", "selectin", "joined", "aggregate"]
+LAZY: Loading = "lazy"  # whatever start_mappers configured, lazy by default
+SELECTIN: Loading = "selectin"  # product, batches and allocations in three queries
+JOINED: Loading = "joined"  # product joined to batches, then allocations
+AGGREGATE: Loading = "aggregate"  # the whole aggregate in a single query
+
+# how concurrent changes to the same product are kept apart
+OPTIMISTIC = "optimistic"  # version_number conflicts, retried by the bus
+FOR_UPDATE = "for_update"  # SELECT ... FOR UPDATE on the products row
+ADVISORY = "advisory"  # transaction-level advisory lock keyed by SKU
+LOCK_MODES = (OPTIMISTIC, FOR_UPDATE, ADVISORY)
 
 
 class AbstractRepository(abc.ABC):
@@ -12,14 +31,16 @@ class AbstractRepository(abc.ABC):
         self._add(product)
         self.seen.add(product)
 
-    def get(self, sku) -> model.Product:
-        product = self._get(sku)
+    def get(self, sku, loading: Optional[Loading] = None) -> model.Product:
+        product = self._get(sku, loading)
         if product:
             self.seen.add(product)
         return product
 
-    def get_by_batchref(self, batchref) -> model.Product:
-        product = self._get_by_batchref(batchref)
+    def get_by_batchref(
+        self, batchref, loading: Optional[Loading] = None
+    ) -> model.Product:
+        product = self._get_by_batchref(batchref, loading)
         if product:
             self.seen.add(product)
         return product
@@ -29,30 +50,173 @@ class AbstractRepository(abc.ABC):
         raise NotImplementedError
 
     @abc.abstractmethod
-    def _get(self, sku) -> model.Product:
+    def _get(self, sku, loading: Optional[Loading]) -> model.Product:
         raise NotImplementedError
 
     @abc.abstractmethod
-    def _get_by_batchref(self, batchref) -> model.Product:
+    def _get_by_batchref(self, batchref, loading: Optional[Loading]) -> model.Product:
         raise NotImplementedError
 
 
 class SqlAlchemyRepository(AbstractRepository):
 
-    def __init__(self, session):
+    def __init__(
+        self,
+        session,
+        lock_mode: str = OPTIMISTIC,
+        cache: Optional[product_cache.ProductCache] = None,
+    ):
         super().__init__()
         self.session = session
+        self.lock_mode = lock_mode
+        self.cache = cache
 
     def _add(self, product: model.Product):
         self.session.add(product)
 
-    def _get(self, sku):
-        return self.session.query(model.Product).filter_by(sku=sku).first()
+    def _cached(self, sku) -> Optional[model.Product]:
+        if self.cache is None:
+            return None
+        if identity_key(model.Product, sku) in self.session.identity_map:
+            # already loaded in this session, the query returns that one
+            return None
+        query = select(orm.products.c.version_number).where(orm.products.c.sku == sku)
+        if self.lock_mode == FOR_UPDATE:
+            query = query.with_for_update()
+        product = self.cache.take(sku, lambda: self.session.execute(query).scalar())
+        if product is not None:
+            self.session.add(product)
+        return product
 
-    def _get_by_batchref(self, batchref) -> model.Product:
-        return (
-            self.session.query(model.Product)
+    def _query(self, loading: Optional[Loading]):
+        query = self.session.query(model.Product).options(*loader_options(loading))
+        if self.lock_mode == FOR_UPDATE:
+            query = query.with_for_update(of=model.Product)
+        return query
+
+    def _get(self, sku, loading=None):
+        if self.lock_mode == ADVISORY:
+            self.session.execute(advisory_lock(sku))
+        return self._cached(sku) or self._query(loading).filter_by(sku=sku).first()
+
+    def _get_by_batchref(self, batchref, loading=None) -> model.Product:
+        sku = self.cache.sku_for_batchref(batchref) if self.cache is not None else None
+        if self.lock_mode == ADVISORY:
+            if sku is None:
+                sku = self.session.execute(sku_for_batchref(batchref)).scalar()
+            if sku is not None:
+                self.session.execute(advisory_lock(sku))
+        cached = self._cached(sku) if sku is not None else None
+        return cached or (
+            self._query(loading)
             .join(model.Batch)
             .filter(orm.batches.c.reference == batchref)
             .first()
         )
+
+
+class AbstractAsyncRepository(abc.ABC):
+
+    def __init__(self):
+        self.seen = set()
+
+    def add(self, product: model.Product):
+        self._add(product)
+        self.seen.add(product)
+
+    async def get(self, sku, loading: Optional[Loading] = None) -> model.Product:
+        product = await self._get(sku, loading)
+        if product:
+            self.seen.add(product)
+        return product
+
+    async def get_by_batchref(
+        self, batchref, loading: Optional[Loading] = None
+    ) -> model.Product:
+        product = await self._get_by_batchref(batchref, loading)
+        if product:
+            self.seen.add(product)
+        return product
+
+    @abc.abstractmethod
+    def _add(self, product: model.Product):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def _get(self, sku, loading: Optional[Loading]) -> model.Product:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def _get_by_batchref(
+        self, batchref, loading: Optional[Loading]
+    ) -> model.Product:
+        raise NotImplementedError
+
+
+class AsyncSqlAlchemyRepository(AbstractAsyncRepository):
+
+    def __init__(self, session, lock_mode: str = OPTIMISTIC):
+        super().__init__()
+        self.session = session
+        self.lock_mode = lock_mode
+
+    def _add(self, product: model.Product):
+        self.session.add(product)
+
+    async def _first(self, query, loading: Optional[Loading]):
+        # an async session cannot lazy load, so anything but an explicit
+        # eager strategy loads the whole aggregate select-in
+        if loading in (None, LAZY):
+            loading = SELECTIN
+        query = query.options(*loader_options(loading))
+        if self.lock_mode == FOR_UPDATE:
+            query = query.with_for_update(of=model.Product)
+        result = await self.session.execute(query)
+        return result.unique().scalars().first()
+
+    async def _get(self, sku, loading=None):
+        if self.lock_mode == ADVISORY:
+            await self.session.execute(advisory_lock(sku))
+        return await self._first(select(model.Product).filter_by(sku=sku), loading)
+
+    async def _get_by_batchref(self, batchref, loading=None) -> model.Product:
+        if self.lock_mode == ADVISORY:
+            sku = (await self.session.execute(sku_for_batchref(batchref))).scalar()
+            if sku is not None:
+                await self.session.execute(advisory_lock(sku))
+        return await self._first(
+            select(model.Product)
+            .join(model.Batch)
+            .filter(orm.batches.c.reference == batchref),
+            loading,
+        )
+
+
+def loader_options(loading: Optional[Loading]) -> List[ExecutableOption]:
+    # start_mappers makes the relationships class attributes, which mypy
+    # cannot see on the plain domain classes
+    product: Any = model.Product
+    batch: Any = model.Batch
+    if loading is None or loading == LAZY:
+        return []
+    if loading == SELECTIN:
+        return [selectinload(product.batches).selectinload(batch._allocations)]
+    if loading == JOINED:
+        return [joinedload(product.batches).selectinload(batch._allocations)]
+    if loading == AGGREGATE:
+        return [joinedload(product.batches).joinedload(batch._allocations)]
+    raise ValueError(f"Unknown loading strategy: {loading}")
+
+
+def advisory_lock(sku: str):
+    # released when the transaction ends; Postgres only
+    return select(func.pg_advisory_xact_lock(func.hashtext(sku)))
+
+
+def try_advisory_lock(key: str):
+    # true if the lock was free and is now held until the transaction ends
+    return select(func.pg_try_advisory_xact_lock(func.hashtext(key)))
+
+
+def sku_for_batchref(batchref: str):
+    return select(orm.batches.c.sku).where(orm.batches.c.reference == batchref)
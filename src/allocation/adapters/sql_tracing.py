@@ -0,0 +1,137 @@
+import logging
+import threading
+import time
+import weakref
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+from sqlalchemy import event
+
+from allocation import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# a statement run this many times by one handler call is reported as a likely
+# N+1, typically a lazy load inside a loop over batches or allocations
+REPEATED = 5
+SLOW_SECONDS = 0.1
+UNATTRIBUTED = "-"
+
+
+@dataclass
+class Statement:
+    message: str
+    handler: str
+    call: Any
+    sql: str
+    seconds: float
+    # psycopg2 buffers results so SELECTs have a row count; SQLite reports None
+    rows: Optional[int]
+
+
+class SqlTracer:
+    # Attributes every statement an engine runs to the bus handler call that
+    # caused it, logging slow statements and repeated ones. Statements are
+    # only kept when asked to, for tests and one-off investigations.
+
+    def __init__(
+        self,
+        keep: bool = False,
+        slow_seconds: float = SLOW_SECONDS,
+        repeated: int = REPEATED,
+    ):
+        self.keep = keep
+        self.slow_seconds = slow_seconds
+        self.repeated = repeated
+        self.statements: List[Statement] = []
+        self.lock = threading.Lock()
+        self.counts: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+    def attach(self, engine):
+        engine = getattr(engine, "sync_engine", engine)
+        event.listen(engine, "before_cursor_execute", self._before)
+        event.listen(engine, "after_cursor_execute", self._after)
+        return self
+
+    def detach(self, engine):
+        engine = getattr(engine, "sync_engine", engine)
+        event.remove(engine, "before_cursor_execute", self._before)
+        event.remove(engine, "after_cursor_execute", self._after)
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("sql_tracing_start", []).append(time.perf_counter())
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info["sql_tracing_start"].pop()
+        rows = cursor.rowcount if cursor.rowcount >= 0 else None
+        call = metrics.current_call.get()
+        if call is None:
+            message, handler = UNATTRIBUTED, UNATTRIBUTED
+        else:
+            message, handler = type(call.message).__name__, call.handler
+        metrics.SQL_SECONDS.labels(handler).observe(seconds)
+
+        if seconds >= self.slow_seconds:
+            logger.warning(
+                "slow statement, %.1fms and %s rows, in %s for %s: %s",
+                seconds * 1e3,
+                rows,
+                handler,
+                message,
+                statement,
+            )
+        with self.lock:
+            if self.keep:
+                self.statements.append(
+                    Statement(message, handler, call, statement, seconds, rows)
+                )
+            if call is None:
+                return
+            counts = self.counts.setdefault(call, Counter())
+            counts[statement] += 1
+            repeats = counts[statement]
+        if repeats == self.repeated:
+            logger.warning(
+                "statement run %d times in one call of %s for %s, an N+1?: %s",
+                repeats,
+                handler,
+                message,
+                statement,
+            )
+
+    def clear(self):
+        with self.lock:
+            self.statements.clear()
+
+    def per_call(self) -> Dict[str, int]:
+        # the most statements any one call of each handler ran
+        calls: Dict[Any, Counter] = defaultdict(Counter)
+        for statement in self.statements:
+            calls[statement.handler][id(statement.call)] += 1
+        return {handler: max(counts.values()) for handler, counts in calls.items()}
+
+    def repeats(self) -> List[Statement]:
+        # the first of each statement a handler call ran at least `repeated` times
+        counts = Counter(
+            (id(s.call), s.sql) for s in self.statements if s.call is not None
+        )
+        seen = set()
+        found = []
+        for statement in self.statements:
+            key = (id(statement.call), statement.sql)
+            if counts.get(key, 0) >= self.repeated and key not in seen:
+                seen.add(key)
+                found.append(statement)
+        return found
+
+    def report(self) -> str:
+        lines = []
+        for s in self.statements:
+            rows = "?" if s.rows is None else s.rows
+            sql = " ".join(s.sql.split())
+            lines.append(
+                f"{s.handler:<30} {s.message:<20} {s.seconds * 1e3:>8.2f}ms"
+                f" {rows:>6} rows  {sql}"
+            )
+        return "\n".join(lines)
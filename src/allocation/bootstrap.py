@@ -1,25 +1,59 @@
+import functools
 import inspect
-from typing import Callable
-from allocation.service_layer import unit_of_work, messagebus, handlers
+import logging
+from typing import Callable, Optional
+from sqlalchemy import text
+from sqlalchemy.orm import configure_mappers
+from allocation.service_layer import (
+    unit_of_work,
+    messagebus,
+    handlers,
+    async_handlers,
+    projector,
+)
+from allocation import config, views
+from allocation.adapters import cache as allocations_cache
 from allocation.adapters import redis_eventpublisher, orm
-from allocation.adapters.notifications import AbstractNotifications, EmailNotifications
+from allocation.adapters.notifications import (
+    AbstractNotifications,
+    BackgroundNotifications,
+    EmailNotifications,
+    AbstractAsyncNotifications,
+    AsyncEmailNotifications,
+)
+
+
+logger = logging.getLogger(__name__)
 
 
 def bootstrap(
     start_orm: bool = True,
-    uow: unit_of_work.AbstractUnitOfWork = unit_of_work.SqlAlchemyUnitOfWork(),
-    notifications: AbstractNotifications = EmailNotifications(),
-    publish: Callable = redis_eventpublisher.publish,
+    uow: Optional[unit_of_work.AbstractUnitOfWork] = None,
+    notifications: Optional[AbstractNotifications] = None,
+    uow_factory: Optional[Callable[[], unit_of_work.AbstractUnitOfWork]] = None,
+    cache: Optional[allocations_cache.AbstractCache] = None,
+    project: Optional[Callable[[], unit_of_work.SqlAlchemyUnitOfWork]] = None,
 ) -> messagebus.MessageBus:
 
     if start_orm:
         orm.start_mappers()
 
-    dependencies = {"uow": uow, "notifications": notifications, "publish": publish}
+    # each handle() gets its own unit of work from the factory, unless a
+    # single shared one is given (the tests use that to inspect it)
+    if uow_factory is None and uow is None:
+        uow_factory = unit_of_work.SqlAlchemyUnitOfWork
+        project = project or unit_of_work.SqlAlchemyUnitOfWork
+
+    # emails are sent off the request path, with repeats collected into digests
+    if notifications is None:
+        notifications = BackgroundNotifications(EmailNotifications())
+
+    # events reach Redis through the outbox, see entrypoints/outbox_relay.py
+    dependencies = {"notifications": notifications}
 
     # Manual equivalent to
     # injected_command_handlers = {
-    #     commands.Allocate: lambda c: handlers.allocate(c, uow)
+    #     commands.Allocate: lambda c, uow: handlers.allocate(c, uow)
     # }
 
     injected_event_handlers = {
@@ -34,11 +68,105 @@ def bootstrap(
         for command_type, handler in handlers.COMMAND_HANDLERS.items()
     }
 
-    return messagebus.MessageBus(
+    bus = messagebus.MessageBus(
         uow=uow,
+        uow_factory=uow_factory,
         event_handlers=injected_event_handlers,
         command_handlers=injected_command_handlers,
     )
+    # allocations_view catches up with the outbox once per message, through
+    # the units of work from `project`; only SQLAlchemy ones have an outbox
+    if project is not None:
+        bus.after_handle.append(
+            functools.partial(
+                projector.project,
+                project,
+                invalidate=allocations_cache.invalidator(cache),
+            )
+        )
+    return bus
+
+
+def async_bootstrap(
+    start_orm: bool = True,
+    uow: Optional[unit_of_work.AbstractAsyncUnitOfWork] = None,
+    notifications: Optional[AbstractAsyncNotifications] = None,
+    uow_factory: Optional[Callable[[], unit_of_work.AbstractAsyncUnitOfWork]] = None,
+    cache: Optional[allocations_cache.AbstractCache] = None,
+    project: Optional[Callable[[], unit_of_work.AsyncSqlAlchemyUnitOfWork]] = None,
+) -> messagebus.AsyncMessageBus:
+
+    if start_orm:
+        orm.start_mappers()
+
+    if uow_factory is None and uow is None:
+        uow_factory = unit_of_work.AsyncSqlAlchemyUnitOfWork
+        project = project or unit_of_work.AsyncSqlAlchemyUnitOfWork
+    if notifications is None:
+        notifications = AsyncEmailNotifications()
+
+    dependencies = {"notifications": notifications}
+
+    injected_event_handlers = {
+        event_type: [
+            inject_dependencies(handler, dependencies) for handler in event_handlers
+        ]
+        for event_type, event_handlers in async_handlers.EVENT_HANDLERS.items()
+    }
+
+    injected_command_handlers = {
+        command_type: inject_dependencies(handler, dependencies)
+        for command_type, handler in async_handlers.COMMAND_HANDLERS.items()
+    }
+
+    bus = messagebus.AsyncMessageBus(
+        uow=uow,
+        uow_factory=uow_factory,
+        event_handlers=injected_event_handlers,
+        command_handlers=injected_command_handlers,
+    )
+    if project is not None:
+        bus.after_handle.append(
+            functools.partial(
+                projector.project_async,
+                project,
+                projector.AsyncTurn(),
+                invalidate=allocations_cache.invalidator(cache),
+            )
+        )
+    return bus
+
+
+def warm_up():
+    # adapters connect on first use; entrypoints call this at startup so the
+    # first message does not pay for mapper configuration and new connections.
+    # A backend that is down is only logged: it is retried when it is used.
+    configure_mappers()
+    for name, connect in [
+        ("postgres", _connect_to_postgres),
+        ("redis", lambda: redis_eventpublisher.default_client().ping()),
+    ]:
+        try:
+            connect()
+        except Exception:
+            logger.warning("Could not connect to %s during warm-up", name)
+    try:
+        _preload_products()
+    except Exception:
+        logger.warning("Could not preload the product cache", exc_info=True)
+
+
+def _connect_to_postgres():
+    # the connection goes back to the pool open
+    with unit_of_work.default_session_factory()() as session:
+        session.execute(text("SELECT 1"))
+
+
+def _preload_products():
+    limit = config.get_product_cache_preload()
+    if limit and unit_of_work.default_product_cache() is not None:
+        skus = views.busiest_skus(limit, unit_of_work.SqlAlchemyUnitOfWork)
+        unit_of_work.preload_products(unit_of_work.SqlAlchemyUnitOfWork(), skus)
 
 
 def inject_dependencies(handler, dependecies):
@@ -46,4 +174,9 @@ def inject_dependencies(handler, dependecies):
     deps = {
         name: dependency for name, dependency in dependecies.items() if name in params
     }
-    return lambda message: handler(message, **deps)
+    if "uow" in params:
+        injected = lambda message, uow: handler(message, uow=uow, **deps)
+    else:
+        injected = lambda message, uow: handler(message, **deps)
+    # keeps the handler's name for logs and metrics
+    return functools.update_wrapper(injected, handler)
@@ -1,12 +1,16 @@
 import os
 
 
-def get_postgres_uri():
+def get_postgres_uri(driver=None):
+    # DB_URI points the sync stack at any database, e.g. SQLite for load tests
+    if driver is None and "DB_URI" in os.environ:
+        return os.environ["DB_URI"]
     host = os.environ.get("DB_HOST", "localhost")
     port = 54321 if host == "localhost" else 5432
     password = os.environ.get("DB_PASSWORD", "wdsfds447567")
     user, db_name = "allocation", "allocation"
-    return f"postgresql://{user}:{password}@{host}:{port}/{db_name}"
+    scheme = f"postgresql+{driver}" if driver else "postgresql"
+    return f"{scheme}://{user}:{password}@{host}:{port}/{db_name}"
 
 
 def get_api_url():
@@ -23,6 +27,52 @@ def get_redis_host_and_port():
 
 def get_email_host_and_port():
     host = os.environ.get("EMAIL_HOST", "localhost")
-    port = 11025 if host == "locahost" else 1025
-    http_port = 18025 if host == "locahost" else 8025
+    port = int(os.environ.get("EMAIL_PORT", 11025 if host == "localhost" else 1025))
+    http_port = 18025 if host == "localhost" else 8025
     return dict(host=host, port=port, http_port=http_port)
+
+
+def get_worker_count():
+    return int(os.environ.get("ALLOCATION_WORKERS", 1))
+
+
+def get_lock_mode():
+    return os.environ.get("ALLOCATION_LOCK_MODE", "optimistic")
+
+
+def get_cache_uses_redis():
+    return os.environ.get("ALLOCATIONS_CACHE_REDIS", "0") == "1"
+
+
+def get_notification_window():
+    # seconds over which repeated notifications are collected into one email
+    return float(os.environ.get("NOTIFICATION_WINDOW", "5"))
+
+
+def get_outbox_retention_seconds():
+    # how long relayed and projected outbox rows are kept before being pruned
+    return float(os.environ.get("OUTBOX_RETENTION_HOURS", 24)) * 3600
+
+
+def get_metrics_port():
+    # where processes without a web app serve /metrics
+    return int(os.environ.get("METRICS_PORT", 9100))
+
+
+def get_product_cache_size():
+    # loaded products kept per process; 0 turns the cache off
+    return int(os.environ.get("PRODUCT_CACHE_SIZE", 0))
+
+
+def get_product_cache_preload():
+    # how many of the busiest SKUs to load into it at startup
+    return int(os.environ.get("PRODUCT_CACHE_PRELOAD", 0))
+
+
+def get_sql_tracing():
+    # SQL_TRACE=1 attributes statements to handlers, logging slow and repeated ones
+    return os.environ.get("SQL_TRACE", "0") == "1"
+
+
+def get_slow_query_seconds():
+    return float(os.environ.get("SLOW_QUERY_MS", 100)) / 1000
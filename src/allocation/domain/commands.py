@@ -1,20 +1,26 @@
 from dataclasses import dataclass
-from typing import Optional
+from typing import Optional, List
 from datetime import date
 
 
 class Command:
-    pass
+    # no per-instance __dict__, here or in the dataclasses below
+    __slots__ = ()
 
 
-@dataclass
+@dataclass(slots=True)
 class Allocate(Command):
     orderid: str
     sku: str
     qty: int
 
 
-@dataclass
+@dataclass(slots=True)
+class AllocateMany(Command):
+    lines: List[Allocate]
+
+
+@dataclass(slots=True)
 class CreateBatch(Command):
     ref: str
     sku: str
@@ -22,7 +28,7 @@ class CreateBatch(Command):
     eta: Optional[date] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class ChangeBatchQuantity(Command):
     ref: str
     qty: int
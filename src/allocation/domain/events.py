@@ -2,15 +2,16 @@ from dataclasses import dataclass
 
 
 class Event:
-    pass
+    # no per-instance __dict__, here or in the dataclasses below
+    __slots__ = ()
 
 
-@dataclass
+@dataclass(slots=True)
 class OutOfStock(Event):
     sku: str
 
 
-@dataclass
+@dataclass(slots=True)
 class Allocated(Event):
     orderid: str
     sku: str
@@ -18,7 +19,7 @@ class Allocated(Event):
     batchref: str
 
 
-@dataclass
+@dataclass(slots=True)
 class Deallocated(Event):
     orderid: str
     sku: str
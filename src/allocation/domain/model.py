@@ -1,16 +1,25 @@
+import bisect
+import sys
 from dataclasses import dataclass
 from datetime import date
-from typing import Optional, List
-from . import events, commands
+from typing import Dict, Optional, List, Tuple
+from . import commands, events
 from sqlalchemy import orm
 
 
 @dataclass(unsafe_hash=True)
 class OrderLine:
+    # mapped classes need a __dict__ (and weakrefs), so no __slots__ here
     orderid: str
     sku: str
     qty: int
 
+    @orm.reconstructor
+    def init_on_load(self):
+        # all of a product's lines share one SKU, but each loaded row brings
+        # its own copy; written past the instrumentation, it is not a change
+        self.__dict__["sku"] = sys.intern(self.sku)
+
 
 class Batch:
     def __init__(self, ref: str, sku: str, qty: int, eta: Optional[date]):
@@ -19,6 +28,16 @@ class Batch:
         self.eta = eta
         self._purchased_quantity = qty
         self._allocations = set()
+        self._allocated_quantity: Optional[int] = 0
+
+    @orm.reconstructor
+    def init_on_load(self):
+        # _allocations may not be loaded yet, so the total is rebuilt on first use
+        self.forget_totals()
+
+    def forget_totals(self):
+        # also called when the ORM expires or refreshes _allocations
+        self._allocated_quantity = None
 
     def __repr__(self):
         return f"<Batch {self.reference}>"
@@ -39,16 +58,20 @@ class Batch:
         return self.eta > other.eta
 
     def allocate(self, line: OrderLine):
-        if self.can_allocate(line):
+        if self.can_allocate(line) and line not in self._allocations:
+            self._allocated_quantity = self.allocated_quantity + line.qty
             self._allocations.add(line)
 
     def deallocate(self, line: OrderLine):
         if line in self._allocations:
+            self._allocated_quantity = self.allocated_quantity - line.qty
             self._allocations.remove(line)
 
     @property
     def allocated_quantity(self):
-        return sum(line.qty for line in self._allocations)
+        if self._allocated_quantity is None:
+            self._allocated_quantity = sum(line.qty for line in self._allocations)
+        return self._allocated_quantity
 
     @property
     def purchased_quantity(self):
@@ -65,8 +88,26 @@ class Batch:
     def can_allocate(self, line):
         return self.available_quantity >= line.qty and self.sku == line.sku
 
-    def deallocate_one(self) -> OrderLine:
-        return self._allocations.pop()
+    def release(self, excess: int) -> List[OrderLine]:
+        # the fewest lines that free `excess`: the largest ones, then the
+        # smallest that covers what is left; ties go by order id
+        lines = sorted(self._allocations, key=lambda line: (line.qty, line.orderid))
+        quantities = [line.qty for line in lines]
+        released = []
+        while excess > 0 and lines:
+            i = min(bisect.bisect_left(quantities, excess), len(lines) - 1)
+            del quantities[i]
+            line = lines.pop(i)
+            released.append(line)
+            excess -= line.qty
+        allocated = self.allocated_quantity
+        self._allocations.difference_update(released)
+        self._allocated_quantity = allocated - sum(line.qty for line in released)
+        return released
+
+
+# where a batch sits in allocation order, see Product._order_key
+BatchKey = Tuple[bool, date, int]
 
 
 class Product:
@@ -76,31 +117,96 @@ class Product:
         self.batches = batches
         self.version_number = version_number
         self.events = []
+        self._batch_keys: Optional[Dict[Batch, BatchKey]] = None
+        self._in_stock: Optional[List[Tuple[BatchKey, Batch]]] = None
 
     @orm.reconstructor
     def init_on_load(self):
         self.events = []
-
-    def allocate(self, line: OrderLine) -> str:
-        try:
-            batch = next(b for b in sorted(self.batches) if b.can_allocate(line))
-            batch.allocate(line)
-            self.version_number += 1
-            self.events.append(
-                events.Allocated(
-                    orderid=line.orderid,
-                    sku=line.sku,
-                    batchref=batch.reference,
-                    qty=line.qty,
-                )
+        # batches may not be loaded yet, so the index is built on first use
+        self.forget_totals()
+
+    def forget_totals(self):
+        # also called when the ORM expires or refreshes the batches
+        self._batch_keys = None
+        self._in_stock = None
+
+    @staticmethod
+    def _order_key(batch: Batch, position: int) -> BatchKey:
+        # same order as sorted(batches): warehouse stock first, then by eta,
+        # ties keep the order in which batches were added
+        return (batch.eta is not None, batch.eta or date.min, position)
+
+    def _batch_index(
+        self,
+    ) -> Tuple[Dict[Batch, BatchKey], List[Tuple[BatchKey, Batch]]]:
+        keys, in_stock = self._batch_keys, self._in_stock
+        if keys is None or in_stock is None or len(keys) != len(self.batches):
+            keys = {
+                batch: self._order_key(batch, position)
+                for position, batch in enumerate(self.batches)
+            }
+            in_stock = sorted(
+                (key, batch)
+                for batch, key in keys.items()
+                if batch.available_quantity > 0
             )
-            return batch.reference
-        except StopIteration:
+            self._batch_keys, self._in_stock = keys, in_stock
+        return keys, in_stock
+
+    def _reindex(self, batch: Batch):
+        keys, index = self._batch_index()
+        key = keys[batch]
+        i = bisect.bisect_left(index, (key,))
+        indexed = i < len(index) and index[i][1] is batch
+        if indexed and batch.available_quantity <= 0:
+            del index[i]
+        elif not indexed and batch.available_quantity > 0:
+            index.insert(i, (key, batch))
+
+    def add_batch(self, batch: Batch):
+        self.batches.append(batch)
+        self.version_number += 1
+        if self._batch_keys is not None:
+            self._batch_keys[batch] = self._order_key(batch, len(self.batches) - 1)
+            self._reindex(batch)
+
+    def allocate(self, line: OrderLine) -> Optional[str]:
+        batchref = self._place(line)
+        if batchref is None:
             self.events.append(events.OutOfStock(line.sku))
+        return batchref
+
+    def _place(self, line: OrderLine) -> Optional[str]:
+        _, index = self._batch_index()
+        batch = next((b for _, b in index if b.can_allocate(line)), None)
+        if batch is None:
+            return None
+        batch.allocate(line)
+        self._reindex(batch)
+        self.version_number += 1
+        self.events.append(
+            events.Allocated(
+                orderid=line.orderid,
+                sku=line.sku,
+                batchref=batch.reference,
+                qty=line.qty,
+            )
+        )
+        return batch.reference
 
     def change_batch_quantity(self, ref: str, qty: int):
         batch = next(b for b in self.batches if b.reference == ref)
         batch.purchased_quantity = qty
-        while batch.available_quantity < 0:
-            line = batch.deallocate_one()
-            self.events.append(commands.Allocate(line.orderid, line.sku, line.qty))
+        self.version_number += 1
+        released = batch.release(-batch.available_quantity)
+        self._reindex(batch)
+        # all the Deallocated first, so the projector applies them as one run
+        self.events.extend(
+            events.Deallocated(line.orderid, line.sku, line.qty) for line in released
+        )
+        for line in released:
+            if self._place(line) is None:
+                # no batch has room for it now, so it waits for a transaction
+                # of its own, where it may find a new batch or go out of stock
+                self.events.append(commands.Allocate(line.orderid, line.sku, line.qty))
@@ -1,13 +1,32 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
+from sqlalchemy.exc import DBAPIError
 from allocation.domain import commands
 from allocation.service_layer import unit_of_work
 from allocation.service_layer.handlers import InvalidSku
-from allocation import views, bootstrap
+from allocation import config, metrics, views, bootstrap
+from allocation.adapters import cache, redis_eventpublisher
 from datetime import datetime
 
 
 app = Flask(__name__)
-bus = bootstrap.bootstrap()
+# other processes can only invalidate the Redis tier, so the in-process tier
+# keeps entries for a couple of seconds at most
+allocations_cache = cache.make_allocations_cache(
+    redis_eventpublisher.default_client() if config.get_cache_uses_redis() else None
+)
+# requests are served on several threads; the bus gives each handle() call
+# its own unit of work, so the one bus can be shared between them
+bus = bootstrap.bootstrap(cache=allocations_cache)
+
+MAX_BULK_ORDERIDS = 10_000
+
+
+def create_app():
+    # what the server loads (FLASK_APP=...flask_app.py:create_app); mappers and
+    # connection pools are set up here, before the first request rather than
+    # in it, and not on every import
+    bootstrap.warm_up()
+    return app
 
 
 @app.route("/allocate", methods=["POST"])
@@ -21,10 +40,27 @@ def allocate_endpoint():
         bus.handle(cmd)
     except InvalidSku as e:
         return {"messages": str(e)}, 400
+    except DBAPIError as e:
+        # still conflicting after the bus retried it
+        if not unit_of_work.is_conflict(e):
+            raise
+        return {"messages": f"Too much contention on {cmd.sku}, try again"}, 409
 
     return "OK", 202
 
 
+@app.route("/allocate/bulk", methods=["POST"])
+def allocate_bulk_endpoint():
+    cmd = commands.AllocateMany(
+        [
+            commands.Allocate(line["orderid"], line["sku"], line["qty"])
+            for line in request.json["lines"]
+        ]
+    )
+    [results] = bus.handle(cmd)
+    return jsonify(results), 202
+
+
 @app.route("/add_batch", methods=["POST"])
 def add_batch():
     eta = request.json["eta"]
@@ -38,9 +74,64 @@ def add_batch():
     return "OK", 201
 
 
+# The allocation views read allocations_view, which the projector brings up to
+# date after each write without waiting for a projection already running, so
+# they are eventually consistent: a write usually shows up by the time its
+# request returns, and otherwise within the outbox relay's poll interval.
 @app.route("/allocations/<orderid>", methods=["GET"])
 def allocations_view_endpoint(orderid):
-    result = views.allocations(orderid, bus.uow)
+    result = views.allocations(
+        orderid, unit_of_work.SqlAlchemyUnitOfWork, allocations_cache
+    )
     if not result:
         return "Not Found", 404
-    return jsonify(result), 200
+    response = jsonify(result)
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+@app.route("/allocations/bulk", methods=["POST"])
+def allocations_bulk_endpoint():
+    body = request.get_json(silent=True)
+    orderids = body.get("orderids") if isinstance(body, dict) else None
+    # a string would otherwise be looked up one character at a time
+    if not (
+        isinstance(orderids, list)
+        and all(isinstance(orderid, str) for orderid in orderids)
+    ):
+        return {"messages": "orderids must be a list of strings"}, 400
+    if len(orderids) > MAX_BULK_ORDERIDS:
+        return {"messages": f"At most {MAX_BULK_ORDERIDS} order ids at a time"}, 400
+    results = views.allocations_for_orders(orderids, unit_of_work.SqlAlchemyUnitOfWork)
+    return jsonify(results), 200
+
+
+@app.route("/allocations", methods=["GET"])
+def allocations_list_endpoint():
+    sku, batchref = request.args.get("sku"), request.args.get("batchref")
+    try:
+        if sku is not None and batchref is None:
+            page, cursor = views.allocations_for_sku(
+                sku, unit_of_work.SqlAlchemyUnitOfWork, **paging()
+            )
+        elif batchref is not None and sku is None:
+            page, cursor = views.allocations_for_batch(
+                batchref, unit_of_work.SqlAlchemyUnitOfWork, **paging()
+            )
+        else:
+            return {"messages": "Give exactly one of sku or batchref"}, 400
+    except ValueError as e:
+        return {"messages": str(e)}, 400
+    return jsonify({"allocations": page, "next": cursor}), 200
+
+
+def paging():
+    return dict(
+        after=request.args.get("after"),
+        limit=request.args.get("limit", views.PAGE_SIZE, type=int),
+    )
@@ -0,0 +1,16 @@
+import logging
+from sqlalchemy import create_engine
+
+from allocation import config
+from allocation.adapters import orm
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    engine = create_engine(config.get_postgres_uri())
+    orm.upgrade_schema(engine)
+    logging.info("schema is up to date")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import logging
+import time
+from datetime import datetime, timedelta
+
+from allocation import config, metrics
+from allocation.adapters import cache, outbox, redis_eventpublisher
+from allocation.service_layer import projector, unit_of_work
+
+
+BATCH_SIZE = 500
+POLL_INTERVAL = 0.2
+# how long to wait before trying again when Postgres or Redis is down
+RETRY_AFTER = 2.0
+PRUNE_BATCH_SIZE = 5_000
+PRUNE_INTERVAL = 60.0
+
+
+def main():
+    metrics.serve(config.get_metrics_port())
+    session_factory = unit_of_work.default_session_factory()
+    client = redis_eventpublisher.default_client()
+    invalidate = cache.invalidator(
+        cache.make_allocations_cache(client) if config.get_cache_uses_redis() else None
+    )
+    retention = config.get_outbox_retention_seconds()
+    next_prune = time.monotonic()
+    while True:
+        try:
+            relayed = relay(session_factory, client)
+            # the app projects after every message; this picks up whatever a
+            # crashed app process left behind
+            projector.project(unit_of_work.SqlAlchemyUnitOfWork, invalidate=invalidate)
+            if time.monotonic() >= next_prune:
+                prune(session_factory, retention)
+                next_prune = time.monotonic() + PRUNE_INTERVAL
+        except Exception:
+            logging.exception("Failed to relay outbox, will retry")
+            time.sleep(RETRY_AFTER)
+            continue
+        if relayed < BATCH_SIZE:
+            time.sleep(POLL_INTERVAL)
+
+
+def relay(session_factory, client=None, batch_size=BATCH_SIZE) -> int:
+    # the rows stay locked until they are marked sent; if publishing fails the
+    # transaction rolls back and they are sent again later, so consumers may
+    # see an event twice but never miss one
+    with session_factory() as session, session.begin():
+        if projector.is_postgres(session):
+            # rows another relay sent since this snapshot are skipped, not a
+            # serialization failure
+            session.connection(execution_options=unit_of_work.PESSIMISTIC_OPTIONS)
+        rows = session.execute(outbox.unsent(batch_size)).all()
+        if not rows:
+            return 0
+
+        redis_eventpublisher.publish_all(
+            ((row.channel, row.payload) for row in rows), client
+        )
+        session.execute(outbox.mark_sent([row.id for row in rows]))
+
+    logging.debug("relayed %d events", len(rows))
+    return len(rows)
+
+
+def prune(session_factory, retention: float, batch_size=PRUNE_BATCH_SIZE) -> int:
+    # in batches, so no one transaction locks a large part of the table; the
+    # timestamps are the database's now(), taken to be in UTC
+    cutoff = datetime.utcnow() - timedelta(seconds=retention)
+    pruned = 0
+    while True:
+        with session_factory() as session, session.begin():
+            deleted = session.execute(outbox.prune(cutoff, batch_size)).rowcount
+        pruned += deleted
+        if deleted < batch_size:
+            logging.debug("pruned %d outbox rows", pruned)
+            return pruned
+
+
+if __name__ == "__main__":
+    main()
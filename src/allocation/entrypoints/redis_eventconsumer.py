@@ -1,30 +1,141 @@
 import json
 import logging
+import os
+import socket
+from collections import defaultdict, deque
+from typing import DefaultDict, Deque
 import redis
 
-from allocation import config, bootstrap
-from allocation.adapters import orm
+from allocation import config, bootstrap, metrics, views
+from allocation.adapters import cache, orm, redis_eventpublisher
 from allocation.domain import commands
-from allocation.service_layer import unit_of_work, messagebus
+from allocation.service_layer import unit_of_work
+from allocation.service_layer.executor import ShardedExecutor
 
 
-r = redis.Redis(**config.get_redis_host_and_port())
+STREAM = "change_batch_quantity"
+GROUP = "allocation"
+DEAD_LETTERS = f"{STREAM}:dead"
+BATCH_SIZE = 100
+BLOCK_MS = 5_000
+# an entry pending this long belongs to a consumer that died holding it
+CLAIM_IDLE_MS = 60_000
+MAX_DELIVERIES = 5
+
+
+def make_bus():
+    return bootstrap.bootstrap(
+        start_orm=False,
+        cache=shared_cache(),
+    )
+
+
+def shared_cache():
+    # reallocations here must still reach the API's Redis cache tier
+    if config.get_cache_uses_redis():
+        return cache.make_allocations_cache(redis_eventpublisher.default_client())
+    return None
 
 
 def main():
-    bus = bootstrap.bootstrap()
-    pubsub = r.pubsub(ignore_subscribe_messages=True)
-    pubsub.subscribe("change_batch_quantity")
+    orm.start_mappers()
+    executor = ShardedExecutor(
+        bus_factory=make_bus,
+        workers=config.get_worker_count(),
+        resolve_sku=lambda ref: views.sku_for_batchref(
+            ref, unit_of_work.SqlAlchemyUnitOfWork
+        ),
+    )
+    bootstrap.warm_up()
+    metrics.serve(config.get_metrics_port())
+    client = redis_eventpublisher.default_client()
+    # run as many of these as needed, the group shares the stream between them
+    consumer = f"{socket.gethostname()}-{os.getpid()}"
+    create_group(client)
+
+    while True:
+        consume(client, executor, consumer)
+
+
+def create_group(client):
+    try:
+        client.xgroup_create(STREAM, GROUP, id="0", mkstream=True)
+    except redis.ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+def consume(
+    client, executor, consumer, count=BATCH_SIZE, block=BLOCK_MS, idle=CLAIM_IDLE_MS
+):
+    _, entries, *_ = client.xautoclaim(
+        STREAM, GROUP, consumer, min_idle_time=idle, start_id="0-0", count=count
+    )
+    if not entries:
+        response = client.xreadgroup(
+            GROUP, consumer, {STREAM: ">"}, count=count, block=block
+        )
+        entries = response[0][1] if response else []
+    handle_entries(client, executor, entries)
+    return len(entries)
+
+
+def handle_entries(client, executor, entries):
+    # each batch's entries in stream order; different batches run side by side
+    queued: DefaultDict[str, Deque[tuple]] = defaultdict(deque)
+    for entry_id, fields in entries:
+        if fields is None:
+            continue  # trimmed from the stream while it was pending
+        try:
+            command = to_command(fields)
+        except (KeyError, ValueError) as e:
+            dead_letter(client, entry_id, fields, e)
+            continue
+        queued[command.ref].append((entry_id, fields, command))
+
+    handled = []
+    while queued:
+        # the next entry of every batch, once the one before it was handled
+        heads = {ref: entries.popleft() for ref, entries in queued.items()}
+        futures = {}
+        for ref, (entry_id, fields, command) in heads.items():
+            logging.debug("handling %s %s", entry_id, fields)
+            futures[ref] = executor.submit(command)
+        for ref, future in futures.items():
+            entry_id, fields, _ = heads[ref]
+            error = future.exception()
+            if error is None:
+                handled.append(entry_id)
+            else:
+                logging.error("Failed to handle %s", entry_id, exc_info=error)
+                if deliveries(client, entry_id) < MAX_DELIVERIES:
+                    # the rest of this batch's entries stay pending behind it,
+                    # so an older quantity is never applied after a newer one
+                    del queued[ref]
+                    continue
+                dead_letter(client, entry_id, fields, error)
+            if not queued[ref]:
+                del queued[ref]
+    if handled:
+        client.xack(STREAM, GROUP, *handled)
+
+
+def to_command(fields):
+    data = json.loads(fields[b"data"])
+    return commands.ChangeBatchQuantity(ref=data["batchref"], qty=data["qty"])
+
 
-    for m in pubsub.listen():
-        handle_change_batch_quantity(m, bus)
+def deliveries(client, entry_id):
+    [pending] = client.xpending_range(STREAM, GROUP, entry_id, entry_id, 1)
+    return pending["times_delivered"]
 
 
-def handle_change_batch_quantity(m, bus):
-    logging.debug(f"handling {m}")
-    data = json.loads(m["data"])
-    cmd = commands.ChangeBatchQuantity(ref=data["batchref"], qty=data["qty"])
-    bus.handle(cmd)
+def dead_letter(client, entry_id, fields, error):
+    logging.error("Dead lettering %s: %r", entry_id, error)
+    pipe = client.pipeline()
+    pipe.xadd(DEAD_LETTERS, {**fields, "id": entry_id, "error": repr(error)})
+    pipe.xack(STREAM, GROUP, entry_id)
+    pipe.execute()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,236 @@
+import bisect
+import threading
+import time
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+
+# A minimal registry in the Prometheus text format, cheap enough to leave on:
+# label values are looked up once per call, and recording then takes one lock
+# and, for histograms, one bisect. Each process keeps its own, so spawned
+# executor workers are not included in the parent's.
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+SECONDS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+COUNTS = (1, 2, 5, 10, 25, 50, 100, 250, 1000)
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self.lock = threading.Lock()
+        # CounterSeries or HistogramSeries, depending on the metric
+        self.series: Dict[Tuple[str, ...], Any] = {}
+        REGISTRY.append(self)
+
+    def labels(self, *values: str):
+        try:
+            return self.series[values]
+        except KeyError:
+            with self.lock:
+                return self.series.setdefault(values, self._new_series())
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        # labels() may add a series while this runs on another thread
+        with self.lock:
+            all_series = sorted(self.series.items())
+        for values, series in all_series:
+            labels = tuple(zip(self.label_names, values))
+            lines.extend(series.samples(self.name, labels))
+        return lines
+
+    def _new_series(self):
+        raise NotImplementedError
+
+
+class CounterSeries:
+    __slots__ = ("lock", "value")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value: float = 0
+
+    def inc(self, amount: float = 1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        yield f"{name}{format_labels(labels)} {self.value}"
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def _new_series(self):
+        return CounterSeries()
+
+
+class HistogramSeries:
+    __slots__ = ("lock", "buckets", "counts", "sum")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        # a count per bucket, the last one for +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def samples(self, name, labels):
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        cumulative = 0
+        for le, count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += count
+            bucket = format_labels(labels + (("le", str(le)),))
+            yield f"{name}_bucket{bucket} {cumulative}"
+        yield f"{name}_sum{format_labels(labels)} {total}"
+        yield f"{name}_count{format_labels(labels)} {cumulative}"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = SECONDS,
+    ):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def _new_series(self):
+        return HistogramSeries(self.buckets)
+
+
+class Timer:
+    __slots__ = ("series", "failures", "start")
+
+    def __init__(
+        self, series: HistogramSeries, failures: Optional[CounterSeries] = None
+    ):
+        self.series = series
+        self.failures = failures
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, exc_type, *args):
+        self.series.observe(time.perf_counter() - self.start)
+        if exc_type is not None and self.failures is not None:
+            self.failures.inc()
+
+
+def format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (key, value.replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n"))
+        for key, value in labels
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+REGISTRY: List[Metric] = []
+
+# the handler call the bus is running, so that work it causes further down,
+# like SQL statements, can be attributed to it
+current_call: ContextVar[Optional[Any]] = ContextVar("current_call", default=None)
+
+
+def render() -> str:
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+MESSAGE_SECONDS = Histogram(
+    "allocation_message_seconds", "Time the bus spent on each message", ["type"]
+)
+MESSAGE_FAILURES = Counter(
+    "allocation_message_failures_total", "Messages whose handling raised", ["type"]
+)
+HANDLER_SECONDS = Histogram(
+    "allocation_handler_seconds", "Time spent in each handler call", ["handler"]
+)
+HANDLER_FAILURES = Counter(
+    "allocation_handler_failures_total", "Handler calls that raised", ["handler"]
+)
+CASCADE_LENGTH = Histogram(
+    "allocation_cascade_messages",
+    "Messages handled for one top-level message, itself included",
+    buckets=COUNTS,
+)
+QUEUE_DEPTH = Histogram(
+    "allocation_queue_depth",
+    "Largest number of messages queued while handling one top-level message",
+    buckets=COUNTS,
+)
+RETRIES = Counter(
+    "allocation_command_retries_total",
+    "Commands run again after a conflict",
+    ["command"],
+)
+UOW_SECONDS = Histogram(
+    "allocation_uow_seconds", "Unit of work commit and rollback time", ["operation"]
+)
+ADAPTER_SECONDS = Histogram(
+    "allocation_adapter_seconds", "Time spent in calls to external systems", ["adapter"]
+)
+ADAPTER_FAILURES = Counter(
+    "allocation_adapter_failures_total",
+    "Calls to external systems that raised",
+    ["adapter"],
+)
+PRODUCT_CACHE = Counter(
+    "allocation_product_cache_total",
+    "Product cache lookups by result: hit, miss or stale",
+    ["result"],
+)
+ALLOCATIONS_CACHE = Counter(
+    "allocation_allocations_cache_total",
+    "Allocations cache lookups by tier and result: hit or miss",
+    ["tier", "result"],
+)
+SQL_SECONDS = Histogram(
+    "allocation_sql_seconds",
+    "Time spent in SQL statements, by the handler that ran them",
+    ["handler"],
+)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port: int, host: str = "") -> ThreadingHTTPServer:
+    # for processes without a web app of their own, like the consumer
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
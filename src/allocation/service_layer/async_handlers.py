@@ -0,0 +1,105 @@
+from __future__ import annotations
+import logging
+from allocation.domain import model, events, commands
+from allocation.service_layer import handlers, unit_of_work
+from allocation.service_layer.handlers import InvalidSku
+from allocation.adapters import notifications, repository
+from typing import List, Optional
+
+
+logger = logging.getLogger(__name__)
+
+
+async def add_batch(
+    command: commands.CreateBatch,
+    uow: unit_of_work.AbstractAsyncUnitOfWork,
+):
+    async with uow:
+        product = await uow.products.get(sku=command.sku)
+        if product is None:
+            product = model.Product(command.sku, batches=[])
+            uow.products.add(product)
+        product.add_batch(
+            model.Batch(command.ref, command.sku, command.qty, command.eta)
+        )
+        await uow.commit()
+
+
+async def allocate(
+    command: commands.Allocate, uow: unit_of_work.AbstractAsyncUnitOfWork
+) -> Optional[str]:
+    line = model.OrderLine(command.orderid, command.sku, command.qty)
+
+    async with uow:
+        product = await uow.products.get(sku=line.sku, loading=repository.SELECTIN)
+        if product is None:
+            raise InvalidSku(f"Invalid sku: {line.sku}")
+        batchref = product.allocate(line)
+        await uow.commit()
+
+    return batchref
+
+
+async def allocate_many(
+    command: commands.AllocateMany, uow: unit_of_work.AbstractAsyncUnitOfWork
+) -> List[dict]:
+    results: handlers.Results = {}
+    async with uow:
+        for sku, lines in handlers.lines_by_sku(command).items():
+            product = await uow.products.get(sku=sku, loading=repository.SELECTIN)
+            if product is None:
+                handlers.failed(results, sku, lines, f"Invalid sku: {sku}")
+                continue
+
+            placed = [
+                (position, line, product.allocate(line)) for position, line in lines
+            ]
+            try:
+                await uow.commit()
+            except Exception:
+                logger.exception(f"Failed to commit allocations for {sku}")
+                await uow.rollback()
+                product.events.clear()
+                handlers.failed(
+                    results, sku, lines, f"Could not allocate {sku}, try again"
+                )
+            else:
+                handlers.allocated(results, sku, placed)
+
+    return handlers.in_order(results, command)
+
+
+async def send_out_of_stock_notification(
+    event: events.OutOfStock,
+    notifications: notifications.AbstractAsyncNotifications,
+):
+    await notifications.send(
+        "user@mail.com",
+        f"Out of stock for {event.sku}",
+    )
+
+
+async def change_batch_quantity(
+    command: commands.ChangeBatchQuantity, uow: unit_of_work.AbstractAsyncUnitOfWork
+):
+    async with uow:
+        product = await uow.products.get_by_batchref(
+            batchref=command.ref, loading=repository.SELECTIN
+        )
+        product.change_batch_quantity(ref=command.ref, qty=command.qty)
+        await uow.commit()
+
+
+EVENT_HANDLERS = {
+    events.OutOfStock: [send_out_of_stock_notification],
+    # allocations_view is kept up to date by the projector, from the outbox;
+    # lines a shrinking batch releases are reallocated by the product itself
+    events.Allocated: [],
+    events.Deallocated: [],
+}
+COMMAND_HANDLERS = {
+    commands.Allocate: allocate,
+    commands.AllocateMany: allocate_many,
+    commands.CreateBatch: add_batch,
+    commands.ChangeBatchQuantity: change_batch_quantity,
+}
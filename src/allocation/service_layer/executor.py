@@ -0,0 +1,128 @@
+from __future__ import annotations
+import multiprocessing
+import threading
+import zlib
+from collections import defaultdict
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional
+from allocation.domain import commands
+
+
+if TYPE_CHECKING:
+    from allocation.service_layer import messagebus
+
+
+# Every shard is a single worker with its own bus, and a command always goes to
+# the shard its SKU hashes to: different SKUs run concurrently, commands for the
+# same SKU run in the order they were submitted. With processes=True the workers
+# are spawned processes, so bus_factory must be picklable and start the ORM.
+class ShardedExecutor:
+
+    def __init__(
+        self,
+        bus_factory: Callable[[], messagebus.MessageBus],
+        workers: int,
+        resolve_sku: Callable[[str], Optional[str]],
+        processes: bool = False,
+    ):
+        self.resolve_sku = resolve_sku
+        self.skus_by_batchref: Dict[str, str] = {}
+        if processes:
+            context = multiprocessing.get_context("spawn")
+            self.shards: List[Executor] = [
+                ProcessPoolExecutor(
+                    max_workers=1,
+                    mp_context=context,
+                    initializer=_start_worker,
+                    initargs=(bus_factory,),
+                )
+                for _ in range(workers)
+            ]
+            self.buses: List[Optional[messagebus.MessageBus]] = [None] * workers
+        else:
+            self.shards = [ThreadPoolExecutor(max_workers=1) for _ in range(workers)]
+            self.buses = [bus_factory() for _ in range(workers)]
+
+    def handle(self, message: commands.Command):
+        return self.submit(message).result()
+
+    def submit(self, message: commands.Command) -> Future:
+        if isinstance(message, commands.AllocateMany):
+            return self._submit_many(message)
+        return self._submit_to(self.shard_for(self.sku_for(message)), message)
+
+    def sku_for(self, message: commands.Command) -> Optional[str]:
+        if isinstance(message, commands.ChangeBatchQuantity):
+            # a batch never changes SKU, so a found one is only looked up once;
+            # one not found may just not be created yet, so it is tried again
+            sku = self.skus_by_batchref.get(message.ref)
+            if sku is None:
+                sku = self.resolve_sku(message.ref)
+                if sku is not None:
+                    self.skus_by_batchref[message.ref] = sku
+            return sku
+        return getattr(message, "sku", None)
+
+    def shard_for(self, sku: Optional[str]) -> int:
+        # crc32 rather than hash(), which differs between processes
+        return zlib.crc32((sku or "").encode()) % len(self.shards)
+
+    def shutdown(self, wait: bool = True):
+        for shard in self.shards:
+            shard.shutdown(wait=wait)
+
+    def _submit_to(self, shard: int, message: commands.Command) -> Future:
+        bus = self.buses[shard]
+        if bus is None:
+            return self.shards[shard].submit(_handle_in_worker, message)
+        return self.shards[shard].submit(bus.handle, message)
+
+    def _submit_many(self, command: commands.AllocateMany) -> Future:
+        positions_by_shard = defaultdict(list)
+        for position, line in enumerate(command.lines):
+            positions_by_shard[self.shard_for(line.sku)].append(position)
+
+        parts = {
+            shard: self._submit_to(
+                shard, commands.AllocateMany([command.lines[p] for p in positions])
+            )
+            for shard, positions in positions_by_shard.items()
+        }
+        combined: Future = Future()
+        remaining = [len(parts)]
+        lock = threading.Lock()
+
+        def combine(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            try:
+                results = [None] * len(command.lines)
+                for shard, positions in positions_by_shard.items():
+                    [line_results, *_] = parts[shard].result()
+                    for position, result in zip(positions, line_results):
+                        results[position] = result
+                combined.set_result([results])
+            except Exception as e:
+                combined.set_exception(e)
+
+        if not parts:
+            combined.set_result([[]])
+        for part in parts.values():
+            part.add_done_callback(combine)
+        return combined
+
+
+_worker_bus: Optional[messagebus.MessageBus] = None
+
+
+def _start_worker(bus_factory):
+    global _worker_bus
+    _worker_bus = bus_factory()
+
+
+def _handle_in_worker(message):
+    if _worker_bus is None:
+        raise RuntimeError("the worker's bus was not started")
+    return _worker_bus.handle(message)
@@ -1,10 +1,13 @@
 from __future__ import annotations
+import logging
+from collections import defaultdict
 from allocation.domain import model, events, commands
 from allocation.service_layer import unit_of_work
-from allocation.adapters import redis_eventpublisher, notifications
-from sqlalchemy import text
-from dataclasses import asdict
-from typing import Callable
+from allocation.adapters import notifications, repository
+from typing import Dict, List, Optional, Sequence, Tuple
+
+
+logger = logging.getLogger(__name__)
 
 
 class InvalidSku(Exception):
@@ -20,21 +23,23 @@ def add_batch(
     uow: unit_of_work.AbstractUnitOfWork,
 ):
     with uow:
-        product = uow.products.get(sku=command.sku)
+        product = uow.products.get(sku=command.sku, loading=repository.LAZY)
         if product is None:
             product = model.Product(command.sku, batches=[])
             uow.products.add(product)
-        product.batches.append(
+        product.add_batch(
             model.Batch(command.ref, command.sku, command.qty, command.eta)
         )
         uow.commit()
 
 
-def allocate(command: commands.Allocate, uow: unit_of_work.AbstractUnitOfWork) -> str:
+def allocate(
+    command: commands.Allocate, uow: unit_of_work.AbstractUnitOfWork
+) -> Optional[str]:
     line = model.OrderLine(command.orderid, command.sku, command.qty)
 
     with uow:
-        product = uow.products.get(sku=line.sku)
+        product = uow.products.get(sku=line.sku, loading=repository.SELECTIN)
         if product is None:
             raise InvalidSku(f"Invalid sku: {line.sku}")
         batchref = product.allocate(line)
@@ -43,43 +48,66 @@ def allocate(command: commands.Allocate, uow: unit_of_work.AbstractUnitOfWork) -
     return batchref
 
 
-def add_allocation_to_read_model(
-    event: events.Allocated, uow: unit_of_work.AbstractUnitOfWork
-):
+def allocate_many(
+    command: commands.AllocateMany, uow: unit_of_work.AbstractUnitOfWork
+) -> List[dict]:
+    results: Results = {}
     with uow:
-        uow.session.execute(
-            text(
-                """
-                INSERT INTO allocations_view (orderid, sku, batchref)
-                VALUES (:orderid, :sku, :batchref)
-                """
-            ),
-            dict(orderid=event.orderid, sku=event.sku, batchref=event.batchref),
+        for sku, lines in lines_by_sku(command).items():
+            product = uow.products.get(sku=sku, loading=repository.SELECTIN)
+            if product is None:
+                failed(results, sku, lines, f"Invalid sku: {sku}")
+                continue
+
+            placed = [
+                (position, line, product.allocate(line)) for position, line in lines
+            ]
+            try:
+                uow.commit()
+            except Exception:
+                logger.exception(f"Failed to commit allocations for {sku}")
+                uow.rollback()
+                product.events.clear()
+                failed(results, sku, lines, f"Could not allocate {sku}, try again")
+            else:
+                allocated(results, sku, placed)
+
+    return in_order(results, command)
+
+
+# allocate_many's planning, shared with the async handler: lines are grouped
+# by SKU, each SKU commits on its own, and results come back in request order
+Lines = List[Tuple[int, model.OrderLine]]
+Results = Dict[int, dict]
+
+
+def lines_by_sku(command: commands.AllocateMany) -> Dict[str, Lines]:
+    grouped: Dict[str, Lines] = defaultdict(list)
+    for position, c in enumerate(command.lines):
+        grouped[c.sku].append((position, model.OrderLine(c.orderid, c.sku, c.qty)))
+    return grouped
+
+
+def failed(results: Results, sku: str, lines: Lines, error: str):
+    for position, line in lines:
+        results[position] = dict(orderid=line.orderid, sku=sku, error=error)
+
+
+def allocated(
+    results: Results,
+    sku: str,
+    placed: Sequence[Tuple[int, model.OrderLine, Optional[str]]],
+):
+    for position, line, batchref in placed:
+        results[position] = (
+            dict(orderid=line.orderid, sku=sku, batchref=batchref)
+            if batchref
+            else dict(orderid=line.orderid, sku=sku, error=f"Out of stock for {sku}")
         )
-        uow.commit()
-
-
-def reallocate(event: events.Deallocated, uow: unit_of_work.AbstractUnitOfWork):
-    with uow:
-        product = uow.products.get(sku=event.sku)
-        product.events.append(commands.Allocate(**asdict(event)))
-        uow.commit()
 
 
-def remove_allocation_from_read_model(
-    event: events.Deallocated, uow: unit_of_work.AbstractUnitOfWork
-):
-    with uow:
-        uow.session.execute(
-            text(
-                """
-                DELETE FROM allocations_view
-                WHERE orderid = :orderid AND sku = :sku
-                """
-            ),
-            dict(orderid=event.orderid, sku=event.sku),
-        )
-        uow.commit()
+def in_order(results: Results, command: commands.AllocateMany) -> List[dict]:
+    return [results[position] for position in range(len(command.lines))]
 
 
 def send_out_of_stock_notification(
@@ -95,28 +123,23 @@ def change_batch_quantity(
     command: commands.ChangeBatchQuantity, uow: unit_of_work.SqlAlchemyUnitOfWork
 ):
     with uow:
-        product = uow.products.get_by_batchref(batchref=command.ref)
+        product = uow.products.get_by_batchref(
+            batchref=command.ref, loading=repository.SELECTIN
+        )
         product.change_batch_quantity(ref=command.ref, qty=command.qty)
         uow.commit()
 
 
-def publish_allocated_event(event: events.Allocated, publish: Callable):
-    publish("line_allocated", event)
-
-
 EVENT_HANDLERS = {
     events.OutOfStock: [send_out_of_stock_notification],
-    events.Allocated: [
-        publish_allocated_event,
-        add_allocation_to_read_model,
-    ],
-    events.Deallocated: [
-        remove_allocation_from_read_model,
-        reallocate,
-    ],
+    # allocations_view is kept up to date by the projector, from the outbox;
+    # lines a shrinking batch releases are reallocated by the product itself
+    events.Allocated: [],
+    events.Deallocated: [],
 }
 COMMAND_HANDLERS = {
     commands.Allocate: allocate,
+    commands.AllocateMany: allocate_many,
     commands.CreateBatch: add_batch,
     commands.ChangeBatchQuantity: change_batch_quantity,
 }
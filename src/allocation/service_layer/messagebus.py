@@ -1,61 +1,284 @@
 from __future__ import annotations
 import logging
+import threading
+from collections import Counter, deque
+from tenacity import (
+    AsyncRetrying,
+    Retrying,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+from allocation import metrics
 from allocation.domain import events, commands
-from allocation.service_layer import handlers
-from typing import Union, List, TYPE_CHECKING, Dict, Type, Callable
-
-
-if TYPE_CHECKING:
-    from allocation.service_layer import unit_of_work
+from allocation.service_layer import handlers, unit_of_work
+from typing import (
+    Any,
+    Awaitable,
+    Generic,
+    Iterable,
+    Iterator,
+    TypeVar,
+    Union,
+    List,
+    Dict,
+    Type,
+    Callable,
+    Tuple,
+    Optional,
+    Sequence,
+)
 
 
 logger = logging.getLogger(__name__)
 
 Message = Union[commands.Command, events.Event]
+# each message type's bus method, and whether its result is returned
+Dispatch = Dict[type, Tuple[Callable, bool]]
+UoW = TypeVar(
+    "UoW", unit_of_work.AbstractUnitOfWork, unit_of_work.AbstractAsyncUnitOfWork
+)
+
+# a conflicting command is run again in a fresh transaction, after a jittered
+# backoff so the transactions it lost to can get out of the way
+MAX_ATTEMPTS = 5
+RETRY_WAIT = wait_random_exponential(multiplier=0.01, max=0.5)
+
+
+class RetryStats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # by command name
+        self.retried: Counter[str] = Counter()
+        self.gave_up: Counter[str] = Counter()
+
+    def record_retry(self, command: commands.Command):
+        with self.lock:
+            self.retried[type(command).__name__] += 1
+        metrics.RETRIES.labels(type(command).__name__).inc()
+
+    def record_give_up(self, command: commands.Command):
+        with self.lock:
+            self.gave_up[type(command).__name__] += 1
+
+
+def retrying(bus, command: commands.Command, retrying_class=Retrying):
+    def before_sleep(retry_state):
+        bus.retry_stats.record_retry(command)
+        logger.warning(
+            "conflict handling command %s, attempt %d",
+            command,
+            retry_state.attempt_number,
+        )
+
+    return retrying_class(
+        stop=stop_after_attempt(bus.max_attempts),
+        wait=bus.retry_wait,
+        retry=retry_if_exception(unit_of_work.is_conflict),
+        before_sleep=before_sleep,
+        reraise=True,
+    )
+
+
+def timed_message(message: Message):
+    name = type(message).__name__
+    return metrics.Timer(
+        metrics.MESSAGE_SECONDS.labels(name), metrics.MESSAGE_FAILURES.labels(name)
+    )
+
 
+class HandlerCall:
+    # one attempt at running a handler: timed, counted if it fails, and made
+    # the current call so work it causes (like SQL) can be attributed to it
+    __slots__ = ("message", "handler", "timer", "token", "__weakref__")
 
-class MessageBus:
+    def __init__(self, message: Message, handler: Callable):
+        self.message = message
+        self.handler = getattr(handler, "__name__", type(handler).__name__)
+        self.timer = metrics.Timer(
+            metrics.HANDLER_SECONDS.labels(self.handler),
+            metrics.HANDLER_FAILURES.labels(self.handler),
+        )
+
+    def __enter__(self):
+        self.token = metrics.current_call.set(self)
+        self.timer.__enter__()
+
+    def __exit__(self, *exc_info):
+        self.timer.__exit__(*exc_info)
+        metrics.current_call.reset(self.token)
+
+
+class Cascade:
+    # the messages one handle() call works through: the one given, then those
+    # its handlers raised, in order. Both buses only add the await points.
+
+    def __init__(self, message: Message, dispatch: Dispatch):
+        self.queue = deque([message])
+        self.dispatch = dispatch
+        self.results: List[Any] = []
+        self.handled = 0
+        self.depth = 0
+
+    def __iter__(self) -> Iterator[Tuple[Message, Callable, bool]]:
+        while self.queue:
+            self.depth = max(self.depth, len(self.queue))
+            message = self.queue.popleft()
+            try:
+                handle, is_command = self.dispatch[type(message)]
+            except KeyError:
+                raise Exception(f"{message} was not an Event or Command") from None
+            self.handled += 1
+            yield message, handle, is_command
+
+    def handled_one(self, is_command: bool, result, new_messages: Iterable[Message]):
+        self.queue.extend(new_messages)
+        if is_command:
+            self.results.append(result)
+
+    def record(self):
+        # a message that failed still counts as handled
+        if self.handled:
+            metrics.CASCADE_LENGTH.labels().observe(self.handled)
+            metrics.QUEUE_DEPTH.labels().observe(self.depth)
+
+
+class BaseMessageBus(Generic[UoW]):
+    # what the sync and async buses share: dispatch, retry policy and hooks
+    handle_event: Callable
+    handle_command: Callable
 
     def __init__(
         self,
-        uow: unit_of_work.AbstractUnitOfWork,
+        uow: Optional[UoW],
         event_handlers: Dict[Type[events.Event], List[Callable]],
-        command_handlers: Dict[Type[commands.Command], List[Callable]],
+        command_handlers: Dict[Type[commands.Command], Callable],
+        uow_factory: Optional[Callable[[], UoW]] = None,
+        max_attempts: int = MAX_ATTEMPTS,
+        retry_wait=RETRY_WAIT,
+        after_handle: Sequence[Callable[[], Any]] = (),
     ):
-        self.uow = uow
+        self.uow: Optional[UoW] = uow
+        if uow_factory is None:
+            if uow is None:
+                raise ValueError("A bus needs a unit of work or a factory for them")
+            shared = uow
+            uow_factory = lambda: shared
+        self.uow_factory: Callable[[], UoW] = uow_factory
+        self.after_handle = list(after_handle)
+        self.max_attempts = max_attempts
+        self.retry_wait = retry_wait
+        self.retry_stats = RetryStats()
         self.event_handlers = event_handlers
         self.command_handlers = command_handlers
+        self.dispatch: Dispatch = {
+            **{t: (self.handle_event, False) for t in event_handlers},
+            **{t: (self.handle_command, True) for t in command_handlers},
+        }
+
+    def event_failed(self, event: events.Event):
+        logger.exception("Exception handling event %s", event)
+
+    def command_failed(self, command: commands.Command, e: Exception):
+        if unit_of_work.is_conflict(e):
+            self.retry_stats.record_give_up(command)
+        logger.exception("Exception handling command %s", command)
+
+    def hook_failed(self, hook: Callable):
+        logger.exception("Exception in after_handle hook %s", hook)
+
+
+class MessageBus(BaseMessageBus[unit_of_work.AbstractUnitOfWork]):
 
     def handle(self, message: Message):
-        results = []
-        self.queue = [message]
-        while self.queue:
-            message = self.queue.pop(0)
-            if isinstance(message, events.Event):
-                self.handle_event(message)
-            elif isinstance(message, commands.Command):
-                self.handle_command(message)
-            else:
-                raise Exception(f"{message} was not an Event or Command")
+        uow = self.uow_factory()
+        cascade = Cascade(message, self.dispatch)
+        try:
+            for message, handle, is_command in cascade:
+                with timed_message(message):
+                    result = handle(message, uow)
+                cascade.handled_one(is_command, result, uow.collect_new_events())
+        finally:
+            cascade.record()
+            self.run_after_handle()
+
+        return cascade.results
 
-        return results
+    def run_after_handle(self):
+        # runs even when handling failed; the work before the failure committed
+        for hook in self.after_handle:
+            try:
+                hook()
+            except Exception:
+                self.hook_failed(hook)
 
-    def handle_event(self, event: events.Event):
+    def handle_event(self, event: events.Event, uow: unit_of_work.AbstractUnitOfWork):
         for handler in self.event_handlers[type(event)]:
             try:
-                logger.debug(f"handling event {event} with handler {handler}")
-                handler(event)
-                self.queue.extend(self.uow.collect_new_events())
+                logger.debug("handling event %s with handler %s", event, handler)
+                with HandlerCall(event, handler):
+                    handler(event, uow)
             except Exception:
-                logger.exception(f"Exception handling event {event}")
-                continue
+                self.event_failed(event)
+
+    def handle_command(
+        self, command: commands.Command, uow: unit_of_work.AbstractUnitOfWork
+    ):
+        logger.debug("handling command %s", command)
+        try:
+            handler = self.command_handlers[type(command)]
+            for attempt in retrying(self, command):
+                with attempt, HandlerCall(command, handler):
+                    return handler(command, uow)
+        except Exception as e:
+            self.command_failed(command, e)
+            raise
+
 
-    def handle_command(self, command: commands.Command):
-        logger.debug(f"handling command {command}")
+class AsyncMessageBus(BaseMessageBus[unit_of_work.AbstractAsyncUnitOfWork]):
+
+    async def handle(self, message: Message):
+        uow = self.uow_factory()
+        cascade = Cascade(message, self.dispatch)
+        try:
+            for message, handle, is_command in cascade:
+                with timed_message(message):
+                    result = await handle(message, uow)
+                cascade.handled_one(is_command, result, uow.collect_new_events())
+        finally:
+            cascade.record()
+            await self.run_after_handle()
+
+        return cascade.results
+
+    async def run_after_handle(self):
+        for hook in self.after_handle:
+            try:
+                await hook()
+            except Exception:
+                self.hook_failed(hook)
+
+    async def handle_event(
+        self, event: events.Event, uow: unit_of_work.AbstractAsyncUnitOfWork
+    ):
+        for handler in self.event_handlers[type(event)]:
+            try:
+                logger.debug("handling event %s with handler %s", event, handler)
+                with HandlerCall(event, handler):
+                    await handler(event, uow)
+            except Exception:
+                self.event_failed(event)
+
+    async def handle_command(
+        self, command: commands.Command, uow: unit_of_work.AbstractAsyncUnitOfWork
+    ):
+        logger.debug("handling command %s", command)
         try:
             handler = self.command_handlers[type(command)]
-            handler(command)
-            self.queue.extend(self.uow.collect_new_events())
-        except Exception:
-            logger.exception(f"Exception handling command {command}")
+            async for attempt in retrying(self, command, AsyncRetrying):
+                with attempt, HandlerCall(command, handler):
+                    return await handler(command, uow)
+        except Exception as e:
+            self.command_failed(command, e)
             raise
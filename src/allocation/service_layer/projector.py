@@ -0,0 +1,146 @@
+from __future__ import annotations
+import asyncio
+import json
+import threading
+from itertools import groupby
+from operator import itemgetter
+from typing import Callable, Iterable, List, Optional, Tuple
+from sqlalchemy import bindparam, delete, insert
+from allocation.adapters import orm, outbox, repository
+from allocation.service_layer import unit_of_work
+
+
+# allocations_view is built from the outbox rather than from events in memory:
+# the rows are in commit order per order id, and the ones not yet projected
+# survive a crash, so any process can pick the projection up where it stopped
+BATCH_SIZE = 1_000
+PROJECTION = "allocations_view"
+
+view = orm.allocations_view
+# each channel's statement, and the payload fields it takes
+STATEMENTS = {
+    "line_allocated": (insert(view), ("orderid", "sku", "batchref")),
+    "line_deallocated": (
+        delete(view).where(
+            view.c.orderid == bindparam("orderid"), view.c.sku == bindparam("sku")
+        ),
+        ("orderid", "sku"),
+    ),
+}
+
+# Projecting never waits for another projector. A caller that finds the lock
+# taken leaves a request and returns; the holder goes round again for it, so
+# its rows are in the view soon after, but not necessarily when it returns.
+# Across processes the advisory lock is only tried: rows a busy projector in
+# another process missed are picked up by the next message or the relay.
+lock = threading.Lock()
+requested = threading.Event()
+
+Invalidate = Callable[[Iterable[str]], None]
+
+
+def project(
+    uow_factory: Callable[[], unit_of_work.SqlAlchemyUnitOfWork],
+    batch_size: int = BATCH_SIZE,
+    invalidate: Optional[Invalidate] = None,
+) -> int:
+    requested.set()
+    projected = 0
+    while requested.is_set() and lock.acquire(blocking=False):
+        try:
+            requested.clear()
+            projected += _drain(uow_factory, batch_size, invalidate)
+        finally:
+            lock.release()
+    return projected
+
+
+def _drain(uow_factory, batch_size, invalidate) -> int:
+    projected = 0
+    while True:
+        with uow_factory() as uow:
+            if is_postgres(uow.session):
+                uow.session.connection(
+                    execution_options=unit_of_work.PESSIMISTIC_OPTIONS
+                )
+                if not uow.session.execute(
+                    repository.try_advisory_lock(PROJECTION)
+                ).scalar():
+                    return projected
+            rows = decode(uow.session.execute(outbox.unprojected(batch_size)))
+            for statement, params in statements_for(rows):
+                uow.session.execute(statement, params)
+            uow.commit()
+        if invalidate and rows:
+            invalidate(payload["orderid"] for _, _, payload in rows)
+        projected += len(rows)
+        if len(rows) < batch_size:
+            return projected
+
+
+class AsyncTurn:
+    # lock and requested for project_async, one per event loop
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.requested = False
+
+
+async def project_async(
+    uow_factory: Callable[[], unit_of_work.AsyncSqlAlchemyUnitOfWork],
+    turn: AsyncTurn,
+    batch_size: int = BATCH_SIZE,
+    invalidate: Optional[Invalidate] = None,
+) -> int:
+    turn.requested = True
+    projected = 0
+    # nothing runs between the check and taking the lock, so this cannot wait
+    while turn.requested and not turn.lock.locked():
+        async with turn.lock:
+            turn.requested = False
+            projected += await _drain_async(uow_factory, batch_size, invalidate)
+    return projected
+
+
+async def _drain_async(uow_factory, batch_size, invalidate) -> int:
+    projected = 0
+    while True:
+        async with uow_factory() as uow:
+            if is_postgres(uow.session):
+                await uow.session.connection(
+                    execution_options=unit_of_work.PESSIMISTIC_OPTIONS
+                )
+                locked = await uow.session.execute(
+                    repository.try_advisory_lock(PROJECTION)
+                )
+                if not locked.scalar():
+                    return projected
+            rows = decode(await uow.session.execute(outbox.unprojected(batch_size)))
+            for statement, params in statements_for(rows):
+                await uow.session.execute(statement, params)
+            await uow.commit()
+        if invalidate and rows:
+            invalidate(payload["orderid"] for _, _, payload in rows)
+        projected += len(rows)
+        if len(rows) < batch_size:
+            return projected
+
+
+def decode(result) -> List[Tuple[int, str, dict]]:
+    return [(row.id, row.channel, json.loads(row.payload)) for row in result]
+
+
+def statements_for(rows: List[Tuple[int, str, dict]]):
+    # consecutive rows of one kind go out as a single executemany; keeping the
+    # runs in outbox order keeps each order's allocations in order
+    for channel, run in groupby(rows, key=itemgetter(1)):
+        statement, fields = STATEMENTS[channel]
+        yield statement, [{f: payload[f] for f in fields} for _, _, payload in run]
+    if rows:
+        yield outbox.mark_projected([id_ for id_, _, _ in rows]), {}
+
+
+def is_postgres(session):
+    # the advisory lock keeps projectors in other processes from applying the
+    # same rows; it needs READ COMMITTED to see what the last holder did
+    return session.get_bind().dialect.name == "postgresql"
@@ -1,32 +1,86 @@
 from __future__ import annotations
 import abc
-from sqlalchemy import create_engine
+import functools
+from typing import Iterable, Iterator, Union
+from sqlalchemy import create_engine, exc, inspect
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
-from allocation import config
-from allocation.adapters import repository
+from allocation import config, metrics
+from allocation.adapters import cache, outbox, repository, sql_tracing
 
 
-DEFAULT_SESSION_FACTORY = sessionmaker(
-    bind=create_engine(config.get_postgres_uri(), isolation_level="REPEATABLE READ")
-)
+def traced(engine):
+    if config.get_sql_tracing():
+        tracer = sql_tracing.SqlTracer(slow_seconds=config.get_slow_query_seconds())
+        tracer.attach(engine)
+    return engine
 
 
-class AbstractUnitOfWork(abc.ABC):
+@functools.lru_cache(maxsize=None)
+def default_session_factory():
+    # built on first use, like the async one below
+    uri = config.get_postgres_uri()
+    if not uri.startswith("postgresql"):
+        return sessionmaker(bind=traced(create_engine(uri)))
+    return sessionmaker(
+        bind=traced(create_engine(uri, isolation_level="REPEATABLE READ"))
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def default_product_cache():
+    size = config.get_product_cache_size()
+    return cache.ProductCache(size) if size else None
+
+
+# serialization_failure and deadlock_detected: the transaction was rolled back
+# without doing anything, so it can simply be run again
+CONFLICT_SQLSTATES = {"40001", "40P01"}
+
+# under REPEATABLE READ the snapshot is taken before a lock is granted, so the
+# lock holder's changes would still conflict; pessimistic modes read committed
+PESSIMISTIC_OPTIONS = {"isolation_level": "READ COMMITTED"}
+
+
+def is_conflict(e: BaseException) -> bool:
+    return (
+        isinstance(e, exc.DBAPIError)
+        and getattr(e.orig, "pgcode", None) in CONFLICT_SQLSTATES
+    )
+
+
+class NewEvents:
+    # what both kinds of unit of work do with the events raised by the
+    # products their repository has seen
+    products: Union[repository.AbstractRepository, repository.AbstractAsyncRepository]
+
+    def collect_new_events(self) -> Iterator:
+        for product in self.products.seen:
+            if product.events:
+                new_events, product.events = product.events, []
+                yield from new_events
+
+    def discard_new_events(self):
+        # the changes that raised them are being rolled back
+        for product in self.products.seen:
+            product.events.clear()
+
+
+class AbstractUnitOfWork(NewEvents, abc.ABC):
     products: repository.AbstractRepository
 
     def __enter__(self) -> AbstractUnitOfWork:
         return self
 
-    def __exit__(self, *args):
-        self.rollback()
+    def __exit__(self, exc_type, *args):
+        if exc_type is not None:
+            self.discard_new_events()
+        with metrics.Timer(metrics.UOW_SECONDS.labels("rollback")):
+            self.rollback()
 
     def commit(self):
-        self._commit()
-
-    def collect_new_events(self):
-        for product in self.products.seen:
-            while product.events:
-                yield product.events.pop(0)
+        with metrics.Timer(metrics.UOW_SECONDS.labels("commit")):
+            self._commit()
 
     @abc.abstractmethod
     def _commit(self):
@@ -39,20 +93,185 @@ class AbstractUnitOfWork(abc.ABC):
 
 class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
 
-    def __init__(self, session_factory=DEFAULT_SESSION_FACTORY):
+    def __init__(self, session_factory=None, lock_mode=None, product_cache=None):
+        if session_factory is None:
+            session_factory = default_session_factory()
+            # cached products belong to one database, so only units of work
+            # on the default one share the default cache
+            if product_cache is None:
+                product_cache = default_product_cache()
         self.session_factory = session_factory
+        self.product_cache = product_cache
+        self.lock_mode = check_lock_mode(lock_mode or config.get_lock_mode())
+        self.committed = set()
+        self.releasable = set()
 
     def __enter__(self):
+        # events are collected once all handlers for a message have run, so
+        # products from an earlier session keep them until then
+        uncollected = (
+            {p for p in self.products.seen if p.events}
+            if hasattr(self, "products")
+            else set()
+        )
         self.session = self.session_factory()
-        self.products = repository.SqlAlchemyRepository(self.session)
+        if self.product_cache is not None:
+            # products go back to the cache loaded, not expired
+            self.session.expire_on_commit = False
+        lock_mode = session_lock_mode(self.session, self.lock_mode)
+        if lock_mode != repository.OPTIMISTIC:
+            self.session.connection(execution_options=PESSIMISTIC_OPTIONS)
+        self.products = repository.SqlAlchemyRepository(
+            self.session, lock_mode=lock_mode, cache=self.product_cache
+        )
+        self.committed = set()
+        self.products.seen.update(uncollected)
+        self.recorded = {product: len(product.events) for product in uncollected}
         return super().__enter__()
 
     def __exit__(self, *args):
         super().__exit__(*args)
         self.session.close()
+        # anything changed since the last commit, or expired by a rollback
+        # after it, is not cached
+        self.releasable = {
+            product
+            for product in self.committed
+            if not inspect(product).modified and not inspect(product).expired_attributes
+        }
+
+    def collect_new_events(self):
+        yield from super().collect_new_events()
+        self.release_products()
+
+    def release_products(self):
+        # back to the cache once this unit of work is done with them
+        for product in self.releasable:
+            if not product.events:
+                self.product_cache.put(product)
+                self.products.seen.discard(product)
+        self.releasable = set()
 
     def _commit(self):
+        # published events are written in the same transaction as the change
+        # that raised them, and relayed to Redis later
+        rows = outbox.rows_for(unrecorded_events(self))
+        if rows:
+            self.session.execute(outbox.add(rows))
         self.session.commit()
+        mark_recorded(self)
+        if self.product_cache is not None:
+            self.committed.update(p for p in self.products.seen if p in self.session)
 
     def rollback(self):
         self.session.rollback()
+
+
+@functools.lru_cache(maxsize=None)
+def default_async_session_factory():
+    # built on first use, so the sync stack does not need an async driver
+    return async_sessionmaker(
+        bind=traced(
+            create_async_engine(
+                config.get_postgres_uri(driver="asyncpg"),
+                isolation_level="REPEATABLE READ",
+            )
+        ),
+        expire_on_commit=False,
+    )
+
+
+class AbstractAsyncUnitOfWork(NewEvents, abc.ABC):
+    products: repository.AbstractAsyncRepository
+
+    async def __aenter__(self) -> AbstractAsyncUnitOfWork:
+        return self
+
+    async def __aexit__(self, exc_type, *args):
+        if exc_type is not None:
+            self.discard_new_events()
+        with metrics.Timer(metrics.UOW_SECONDS.labels("rollback")):
+            await self.rollback()
+
+    async def commit(self):
+        with metrics.Timer(metrics.UOW_SECONDS.labels("commit")):
+            await self._commit()
+
+    @abc.abstractmethod
+    async def _commit(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def rollback(self):
+        raise NotImplementedError
+
+
+class AsyncSqlAlchemyUnitOfWork(AbstractAsyncUnitOfWork):
+
+    def __init__(self, session_factory=None, lock_mode=None):
+        self.session_factory = session_factory or default_async_session_factory()
+        self.lock_mode = check_lock_mode(lock_mode or config.get_lock_mode())
+
+    async def __aenter__(self):
+        uncollected = (
+            {p for p in self.products.seen if p.events}
+            if hasattr(self, "products")
+            else set()
+        )
+        self.session = self.session_factory()
+        lock_mode = session_lock_mode(self.session, self.lock_mode)
+        if lock_mode != repository.OPTIMISTIC:
+            await self.session.connection(execution_options=PESSIMISTIC_OPTIONS)
+        self.products = repository.AsyncSqlAlchemyRepository(
+            self.session, lock_mode=lock_mode
+        )
+        self.products.seen.update(uncollected)
+        self.recorded = {product: len(product.events) for product in uncollected}
+        return await super().__aenter__()
+
+    async def __aexit__(self, *args):
+        await super().__aexit__(*args)
+        await self.session.close()
+
+    async def _commit(self):
+        rows = outbox.rows_for(unrecorded_events(self))
+        if rows:
+            await self.session.execute(outbox.add(rows))
+        await self.session.commit()
+        mark_recorded(self)
+
+    async def rollback(self):
+        await self.session.rollback()
+
+
+def check_lock_mode(lock_mode: str) -> str:
+    if lock_mode not in repository.LOCK_MODES:
+        raise ValueError(f"Unknown lock mode: {lock_mode}")
+    return lock_mode
+
+
+def session_lock_mode(session, lock_mode: str) -> str:
+    # row and advisory locks are Postgres only, other databases stay optimistic
+    if session.get_bind().dialect.name != "postgresql":
+        return repository.OPTIMISTIC
+    return lock_mode
+
+
+def unrecorded_events(uow):
+    # a session can commit more than once, and products carried over from an
+    # earlier session had their events recorded when that one committed
+    for product in uow.products.seen:
+        yield from product.events[uow.recorded.get(product, 0) :]
+
+
+def mark_recorded(uow):
+    uow.recorded = {product: len(product.events) for product in uow.products.seen}
+
+
+def preload_products(uow: SqlAlchemyUnitOfWork, skus: Iterable[str]):
+    # fills the unit of work's product cache, e.g. with the busiest SKUs
+    with uow:
+        for sku in skus:
+            uow.products.get(sku, loading=repository.SELECTIN)
+        uow.commit()
+    list(uow.collect_new_events())
@@ -1,10 +1,33 @@
 from __future__ import annotations
+import base64
+import binascii
+import json
+from allocation.adapters import cache as allocations_cache
 from allocation.service_layer import unit_of_work
-from sqlalchemy import text
+from sqlalchemy import bindparam, text
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 
+# the views read the tables directly, so they need a session
+UnitOfWorkFactory = Callable[[], unit_of_work.SqlAlchemyUnitOfWork]
 
-def allocations(orderid: str, uow: unit_of_work.AbstractUnitOfWork):
-    with uow:
+# keeps each statement well under SQLite's bound parameter limit, and the
+# number of distinct statement shapes small
+IN_CHUNK_SIZE = 500
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1_000
+
+
+def allocations(
+    orderid: str,
+    uow_factory: UnitOfWorkFactory,
+    cache: Optional[allocations_cache.TieredCache] = None,
+):
+    if cache is not None:
+        return cache.get_or_load(
+            allocations_cache.allocations_key(orderid),
+            lambda: allocations(orderid, uow_factory),
+        )
+    with uow_factory() as uow:
         results = list(
             uow.session.execute(
                 text(
@@ -17,3 +40,113 @@ def allocations(orderid: str, uow: unit_of_work.AbstractUnitOfWork):
             )
         )
     return [{"sku": sku, "batchref": batchref} for sku, batchref in results]
+
+
+def sku_for_batchref(batchref: str, uow_factory: UnitOfWorkFactory):
+    with uow_factory() as uow:
+        [sku] = uow.session.execute(
+            text("SELECT sku FROM batches WHERE reference = :batchref"),
+            dict(batchref=batchref),
+        ).first() or [None]
+    return sku
+
+
+def busiest_skus(limit: int, uow_factory: UnitOfWorkFactory) -> List[str]:
+    # the SKUs with the most allocations, a fair guess at the hottest
+    with uow_factory() as uow:
+        rows = uow.session.execute(
+            text(
+                """
+                SELECT sku FROM allocations_view
+                GROUP BY sku ORDER BY count(*) DESC LIMIT :limit
+                """
+            ),
+            dict(limit=limit),
+        )
+        return [sku for (sku,) in rows]
+
+
+def allocations_for_orders(
+    orderids: Iterable[str], uow_factory: UnitOfWorkFactory
+) -> Dict[str, List[dict]]:
+    orderids = list(dict.fromkeys(orderids))
+    results: Dict[str, List[dict]] = {orderid: [] for orderid in orderids}
+    statement = text(
+        """
+        SELECT orderid, sku, batchref FROM allocations_view
+        WHERE orderid IN :orderids
+        """
+    ).bindparams(bindparam("orderids", expanding=True))
+    with uow_factory() as uow:
+        for start in range(0, len(orderids), IN_CHUNK_SIZE):
+            chunk = orderids[start : start + IN_CHUNK_SIZE]
+            for orderid, sku, batchref in uow.session.execute(
+                statement, dict(orderids=chunk)
+            ):
+                results[orderid].append({"sku": sku, "batchref": batchref})
+    return results
+
+
+def allocations_for_sku(
+    sku: str,
+    uow_factory: UnitOfWorkFactory,
+    after: Optional[str] = None,
+    limit: int = PAGE_SIZE,
+) -> Tuple[List[dict], Optional[str]]:
+    return _page("sku", "batchref", sku, uow_factory, after, limit)
+
+
+def allocations_for_batch(
+    batchref: str,
+    uow_factory: UnitOfWorkFactory,
+    after: Optional[str] = None,
+    limit: int = PAGE_SIZE,
+) -> Tuple[List[dict], Optional[str]]:
+    return _page("batchref", "sku", batchref, uow_factory, after, limit)
+
+
+def _page(column, tiebreak, value, uow_factory, after, limit):
+    # keyset pagination: each page starts after the (orderid, tiebreak) the
+    # last one ended on, which the index finds without counting past rows
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    where = f"{column} = :value"
+    params = dict(value=value, limit=limit + 1)
+    if after is not None:
+        where += f" AND (orderid, {tiebreak}) > (:after_orderid, :after_tiebreak)"
+        params["after_orderid"], params["after_tiebreak"] = decode_cursor(after)
+    with uow_factory() as uow:
+        rows = uow.session.execute(
+            text(
+                f"""
+                SELECT orderid, sku, batchref FROM allocations_view
+                WHERE {where}
+                ORDER BY orderid, {tiebreak}
+                LIMIT :limit
+                """
+            ),
+            params,
+        ).all()
+    page = [dict(row._mapping) for row in rows[:limit]]
+    if len(rows) <= limit:
+        return page, None
+    last = page[-1]
+    return page, encode_cursor(last["orderid"], last[tiebreak])
+
+
+def encode_cursor(*key: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[str, str]:
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        key = None
+    # only ever a pair of strings, as encode_cursor wrote it
+    if not (isinstance(key, list) and len(key) == 2):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    orderid, tiebreak = key
+    if not (isinstance(orderid, str) and isinstance(tiebreak, str)):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return orderid, tiebreak
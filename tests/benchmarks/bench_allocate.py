@@ -0,0 +1,35 @@
+import timeit
+from allocation.domain.model import Batch, OrderLine, Product
+
+
+LINE_COUNTS = [10, 100, 1_000, 10_000, 100_000]
+BATCHES = 5
+ALLOCATIONS = 1_000
+
+
+def product_with_allocated_lines(sku, batches, lines):
+    product = Product(
+        sku, [Batch(f"b{i}", sku, lines * 2, None) for i in range(batches)]
+    )
+    for i in range(lines):
+        product.batches[i % batches].allocate(OrderLine(f"old-{i}", sku, 1))
+    return product
+
+
+def time_allocations(lines, batches=BATCHES, allocations=ALLOCATIONS):
+    product = product_with_allocated_lines("bench", batches, lines)
+    new_lines = iter([OrderLine(f"new-{i}", "bench", 1) for i in range(allocations)])
+    seconds = timeit.timeit(
+        lambda: product.allocate(next(new_lines)), number=allocations
+    )
+    return seconds / allocations
+
+
+def main():
+    print(f"{'allocated lines':>16} {'us per allocate':>16}")
+    for lines in LINE_COUNTS:
+        print(f"{lines:>16} {time_allocations(lines) * 1e6:>16.2f}")
+
+
+if __name__ == "__main__":
+    main()
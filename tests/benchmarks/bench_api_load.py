@@ -0,0 +1,244 @@
+import argparse
+import itertools
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import requests
+from sqlalchemy import create_engine
+from tenacity import retry, stop_after_delay, wait_fixed
+from allocation.adapters import orm
+from integration.smtp_server import SMTPServer
+
+
+# Drives the HTTP API from --concurrency threads for --duration seconds and
+# reports throughput and latency percentiles per endpoint. Without --url it
+# starts the app itself on SQLite (or --db-uri, e.g. a local Postgres), with
+# an SMTP stand-in for the out-of-stock emails; --redis adds the
+# docker-compose Redis as the shared cache tier.
+ENDPOINTS = ["POST /add_batch", "POST /allocate", "GET /allocations"]
+BATCH_QTY = 1_000_000
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+@retry(stop=stop_after_delay(20), wait=wait_fixed(0.2))
+def wait_for(url):
+    requests.get(f"{url}/allocations/warming-up", timeout=1)
+
+
+def start_app(db_uri, smtp_port, redis):
+    orm.upgrade_schema(create_engine(db_uri))
+    port = free_port()
+    env = dict(
+        os.environ,
+        DB_URI=db_uri,
+        EMAIL_HOST="localhost",
+        EMAIL_PORT=str(smtp_port),
+        ALLOCATIONS_CACHE_REDIS="1" if redis else "0",
+    )
+    app = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "flask",
+            "--app",
+            "allocation.entrypoints.flask_app:create_app",
+            "run",
+            "--port",
+            str(port),
+            "--with-threads",
+        ],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    url = f"http://localhost:{port}"
+    try:
+        wait_for(url)
+    except Exception:
+        app.kill()
+        raise
+    return app, url
+
+
+class Load:
+
+    def __init__(self, url, skus, skew, mix, seed):
+        self.url = url
+        self.skus = [f"load-{uuid.uuid4().hex[:6]}-{i}" for i in range(skus)]
+        # Zipf-like: the i-th SKU is picked in proportion to 1 / (i + 1) ** skew
+        self.sku_weights = list(
+            itertools.accumulate(1 / (i + 1) ** skew for i in range(skus))
+        )
+        self.mix = mix
+        self.seed = seed
+        self.orderids = []
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(Counter)
+        self.lock = threading.Lock()
+
+    def set_up(self):
+        with requests.Session() as session:
+            for sku in self.skus:
+                self.add_batch(session, sku=sku)
+        self.latencies.clear()
+        self.errors.clear()
+
+    def run(self, concurrency, duration):
+        deadline = time.monotonic() + duration
+        workers = [
+            threading.Thread(target=self.worker, args=(deadline, self.seed + i))
+            for i in range(concurrency)
+        ]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return time.perf_counter() - start
+
+    def worker(self, deadline, seed):
+        rng = random.Random(seed)
+        actions = list(self.mix)
+        weights = list(itertools.accumulate(self.mix.values()))
+        with requests.Session() as session:
+            while time.monotonic() < deadline:
+                [action] = rng.choices(actions, cum_weights=weights)
+                getattr(self, action)(session, rng)
+
+    def sku(self, rng):
+        [sku] = rng.choices(self.skus, cum_weights=self.sku_weights)
+        return sku
+
+    def add_batch(self, session, rng=None, sku=None):
+        ref = f"batch-{uuid.uuid4().hex[:8]}"
+        json_ = dict(ref=ref, sku=sku or self.sku(rng), qty=BATCH_QTY, eta=None)
+        self.timed("POST /add_batch", 201, session.post, "/add_batch", json=json_)
+
+    def allocate(self, session, rng):
+        orderid = f"order-{uuid.uuid4().hex[:8]}"
+        json_ = dict(orderid=orderid, sku=self.sku(rng), qty=1)
+        if self.timed("POST /allocate", 202, session.post, "/allocate", json=json_):
+            self.orderids.append(orderid)
+
+    def read(self, session, rng):
+        if not self.orderids:
+            return self.allocate(session, rng)
+        orderid = rng.choice(self.orderids)
+        self.timed("GET /allocations", 200, session.get, f"/allocations/{orderid}")
+
+    def timed(self, endpoint, expected, method, path, **kwargs):
+        start = time.perf_counter()
+        try:
+            status = method(f"{self.url}{path}", **kwargs).status_code
+        except requests.RequestException as e:
+            status = type(e).__name__
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.latencies[endpoint].append(elapsed)
+            if status != expected:
+                self.errors[endpoint][status] += 1
+        return status == expected
+
+    def report(self, seconds):
+        results = {}
+        for endpoint in ENDPOINTS:
+            latencies = self.latencies[endpoint]
+            if len(latencies) < 2:
+                continue
+            percentiles = statistics.quantiles(latencies, n=100)
+            results[endpoint] = dict(
+                requests=len(latencies),
+                errors=dict(self.errors[endpoint]),
+                per_second=len(latencies) / seconds,
+                p50_ms=percentiles[49] * 1e3,
+                p95_ms=percentiles[94] * 1e3,
+                p99_ms=percentiles[98] * 1e3,
+            )
+        return results
+
+
+def parse_mix(text):
+    # e.g. "read=0.7,allocate=0.25,add_batch=0.05"
+    mix = {}
+    for part in text.split(","):
+        action, weight = part.split("=")
+        if action not in ("read", "allocate", "add_batch"):
+            raise argparse.ArgumentTypeError(f"unknown action {action}")
+        mix[action] = float(weight)
+    return mix
+
+
+def print_report(results, seconds, concurrency):
+    print(f"{concurrency} clients for {seconds:.1f}s")
+    print(
+        f"{'endpoint':<18} {'requests':>9} {'errors':>7} {'req/s':>9}"
+        f" {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
+    )
+    for endpoint, r in results.items():
+        print(
+            f"{endpoint:<18} {r['requests']:>9} {sum(r['errors'].values()):>7}"
+            f" {r['per_second']:>9.1f} {r['p50_ms']:>8.2f}"
+            f" {r['p95_ms']:>8.2f} {r['p99_ms']:>8.2f}"
+        )
+    for endpoint, r in results.items():
+        if r["errors"]:
+            print(f"{endpoint} errors by status: {r['errors']}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", help="an app that is already running")
+    parser.add_argument("--db-uri", help="defaults to a temporary SQLite file")
+    parser.add_argument("--redis", action="store_true")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--skus", type=int, default=100)
+    parser.add_argument("--skew", type=float, default=1.0, help="0 is uniform")
+    parser.add_argument(
+        "--mix", type=parse_mix, default="read=0.7,allocate=0.25,add_batch=0.05"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, help="write the results as JSON")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp, SMTPServer() as smtp:
+        app = None
+        url = args.url
+        if url is None:
+            db_uri = args.db_uri or f"sqlite:///{tmp}/load.db"
+            app, url = start_app(db_uri, smtp.port, args.redis)
+        try:
+            load = Load(url, args.skus, args.skew, args.mix, args.seed)
+            load.set_up()
+            seconds = load.run(args.concurrency, args.duration)
+        finally:
+            if app is not None:
+                app.terminate()
+                app.wait()
+
+    results = load.report(seconds)
+    print_report(results, seconds, args.concurrency)
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import functools
+import logging
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from sqlalchemy import create_engine
+from allocation import bootstrap, config
+from allocation.adapters import orm, repository
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+from unit.test_handlers import FakeNotifications
+
+
+# needs the docker-compose Postgres; every thread allocates to the same SKU
+THREADS = [1, 4, 16]
+ALLOCATIONS = 400
+
+
+def bootstrap_app(lock_mode):
+    uow_factory = functools.partial(
+        unit_of_work.SqlAlchemyUnitOfWork, lock_mode=lock_mode
+    )
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow_factory=uow_factory,
+        notifications=FakeNotifications(),
+        project=uow_factory,
+    )
+
+
+def hot_sku_allocations(lock_mode, threads, allocations=ALLOCATIONS):
+    bus = bootstrap_app(lock_mode)
+    sku = f"hot-{uuid.uuid4().hex[:6]}"
+    bus.handle(commands.CreateBatch(f"{sku}-batch", sku, allocations, None))
+
+    def allocate(i):
+        try:
+            bus.handle(commands.Allocate(f"{sku}-order-{i}", sku, 1))
+        except Exception:
+            return False
+        return True
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        succeeded = sum(pool.map(allocate, range(allocations)))
+    seconds = time.perf_counter() - start
+    stats = bus.retry_stats
+    return (
+        allocations / seconds,
+        sum(stats.retried.values()),
+        allocations - succeeded,
+    )
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    orm.upgrade_schema(create_engine(config.get_postgres_uri()))
+    orm.start_mappers()
+    print(
+        f"{'lock mode':>12} {'threads':>8} {'allocs/s':>10} {'retries':>8} {'failed':>7}"
+    )
+    for lock_mode in repository.LOCK_MODES:
+        for threads in THREADS:
+            rate, retries, failed = hot_sku_allocations(lock_mode, threads)
+            print(
+                f"{lock_mode:>12} {threads:>8} {rate:>10,.0f}"
+                f" {retries:>8} {failed:>7}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+import logging
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from allocation import bootstrap
+from allocation.domain import commands
+from allocation.service_layer.executor import ShardedExecutor
+from unit.test_handlers import FakeNotifications, FakeUnitOFWork
+
+
+WORKER_COUNTS = [1, 2, 4, 8, 16]
+COMMANDS = 2_000
+SKUS = 64
+# stands in for the round trip to the database on every commit
+COMMIT_LATENCY = 0.001
+
+
+class SlowUnitOfWork(FakeUnitOFWork):
+    def _commit(self):
+        time.sleep(COMMIT_LATENCY)
+        super()._commit()
+
+
+def bootstrap_slow_app():
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow=SlowUnitOfWork(),
+        notifications=FakeNotifications(),
+    )
+
+
+def throughput(workers, commands_=COMMANDS, skus=SKUS):
+    executor = ShardedExecutor(
+        bootstrap_slow_app, workers=workers, resolve_sku=lambda ref: None
+    )
+    for i in range(skus):
+        executor.handle(commands.CreateBatch(f"batch-{i}", f"sku-{i}", commands_, None))
+
+    start = time.perf_counter()
+    futures = [
+        executor.submit(commands.Allocate(f"order-{i}", f"sku-{i % skus}", 1))
+        for i in range(commands_)
+    ]
+    for future in futures:
+        future.result()
+    seconds = time.perf_counter() - start
+    executor.shutdown()
+    return commands_ / seconds
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    print(f"{'workers':>8} {'commands/s':>12}")
+    for workers in WORKER_COUNTS:
+        print(f"{workers:>8} {throughput(workers):>12,.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import argparse
+import gc
+import json
+import sys
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+from allocation.adapters import orm, repository
+from allocation.domain import commands, events, model
+
+
+# Bytes per line held once --lines of each are built, and the peak while
+# building them, from tracemalloc; the strings each one owns are included.
+# "loaded" reads them through the ORM the way the allocate handler does, all
+# allocated to one batch of one SKU, from an in-memory SQLite database whose
+# pages are not Python objects and so are not counted.
+LINES = 1_000_000
+INSERT_CHUNK = 50_000
+
+
+def allocate_commands(lines):
+    return [commands.Allocate(f"order-{i:08d}", "sku", 1) for i in range(lines)]
+
+
+def allocated_events(lines):
+    return [events.Allocated(f"order-{i:08d}", "sku", 1, "batch") for i in range(lines)]
+
+
+def order_lines(lines):
+    return [model.OrderLine(f"order-{i:08d}", "sku", 1) for i in range(lines)]
+
+
+def database(lines):
+    engine = create_engine("sqlite://")
+    orm.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(orm.products.insert(), [dict(sku="sku", version_number=0)])
+        conn.execute(
+            orm.batches.insert(),
+            [dict(id=1, reference="batch", sku="sku", _purchased_quantity=lines)],
+        )
+        for start in range(1, lines + 1, INSERT_CHUNK):
+            ids = range(start, min(start + INSERT_CHUNK, lines + 1))
+            conn.execute(
+                orm.order_lines.insert(),
+                [dict(id=i, sku="sku", qty=1, orderid=f"order-{i:08d}") for i in ids],
+            )
+            conn.execute(
+                orm.allocations.insert(),
+                [dict(orderline_id=i, batch_id=1) for i in ids],
+            )
+    return sessionmaker(bind=engine)
+
+
+def loaded_product(session_factory):
+    session = session_factory()
+    product = repository.SqlAlchemyRepository(session).get(
+        "sku", loading=repository.SELECTIN
+    )
+    # the session holds the identity map, which is part of the cost
+    return session, product
+
+
+def measure(build, *args):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        kept = build(*args)
+        gc.collect()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del kept
+    return current, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", type=int, default=LINES)
+    parser.add_argument("--output", type=Path, help="write the results as JSON")
+    args = parser.parse_args()
+
+    results = {}
+
+    def record(name, build, *build_args):
+        current, peak = measure(build, *build_args)
+        results[name] = dict(
+            bytes_per_line=current / args.lines, peak_per_line=peak / args.lines
+        )
+        print(
+            f"{name:<20} {current / args.lines:>10.0f} B"
+            f" {peak / args.lines:>10.0f} B peak {current / 2**20:>10.1f} MiB"
+        )
+
+    print(f"{args.lines} lines each")
+    record("Allocate", allocate_commands, args.lines)
+    record("Allocated", allocated_events, args.lines)
+    record("OrderLine", order_lines, args.lines)
+    session_factory = database(args.lines)
+    orm.start_mappers()
+    try:
+        record("loaded OrderLine", loaded_product, session_factory)
+    finally:
+        clear_mappers()
+
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2) + "\n")
+
+
+if __name__ == "__main__":
+    main()
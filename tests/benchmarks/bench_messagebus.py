@@ -0,0 +1,67 @@
+import sys
+import time
+from datetime import date
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from allocation import bootstrap
+from allocation.domain import commands
+from unit.test_handlers import FakeNotifications, FakeUnitOFWork
+
+
+MESSAGES = 100_000
+SKUS = 100
+
+
+def bootstrap_fake_app():
+    # with a fake unit of work there is no outbox, so no projector either
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow=FakeUnitOFWork(),
+        notifications=FakeNotifications(),
+    )
+
+
+def independent_allocations(messages=MESSAGES, skus=SKUS):
+    bus = bootstrap_fake_app()
+    for i in range(skus):
+        bus.handle(commands.CreateBatch(f"batch-{i}", f"sku-{i}", messages, None))
+
+    # every Allocate raises one Allocated event
+    start = time.perf_counter()
+    for i in range(messages // 2):
+        bus.handle(commands.Allocate(f"order-{i}", f"sku-{i % skus}", 1))
+    return time.perf_counter() - start
+
+
+def reallocation_cascade(messages=MESSAGES):
+    bus = bootstrap_fake_app()
+    lines = messages // 2
+    bus.handle(commands.CreateBatch("shrinking", "sku", lines, None))
+    bus.handle(commands.CreateBatch("spare", "sku", lines, date(2099, 1, 1)))
+    for i in range(lines):
+        bus.handle(commands.Allocate(f"order-{i}", "sku", 1))
+
+    # the product moves every released line to the spare batch itself, so
+    # this is one command whose events are a Deallocated and an Allocated
+    # per line
+    start = time.perf_counter()
+    bus.handle(commands.ChangeBatchQuantity("shrinking", 0))
+    return time.perf_counter() - start
+
+
+def main():
+    for name, scenario in [
+        ("independent allocations", independent_allocations),
+        ("reallocation cascade", reallocation_cascade),
+    ]:
+        seconds = scenario()
+        print(
+            f"{name:>24}: {MESSAGES} messages in {seconds:.2f}s"
+            f" ({MESSAGES / seconds:,.0f} messages/s)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+import json
+import time
+import redis
+from dataclasses import asdict
+from allocation import config
+from allocation.adapters import redis_eventpublisher
+from allocation.domain import events
+
+
+# needs the docker-compose Redis; one Allocated event per line of a bulk call
+EVENT_COUNTS = [1, 10, 100, 1_000]
+
+
+def allocated(count):
+    return [
+        (
+            "line_allocated",
+            json.dumps(asdict(events.Allocated(f"order-{i}", "sku", 1, "batch"))),
+        )
+        for i in range(count)
+    ]
+
+
+def per_event(client, to_publish):
+    start = time.perf_counter()
+    for channel, payload in to_publish:
+        client.xadd(
+            channel,
+            {"data": payload},
+            maxlen=redis_eventpublisher.STREAM_MAXLEN,
+            approximate=True,
+        )
+    return time.perf_counter() - start
+
+
+def pipelined(client, to_publish):
+    # what the outbox relay does with each batch of rows
+    start = time.perf_counter()
+    redis_eventpublisher.publish_all(to_publish, client)
+    return time.perf_counter() - start
+
+
+def main():
+    client = redis.Redis(**config.get_redis_host_and_port())
+    print(f"{'events':>8} {'per event ms':>13} {'pipelined ms':>13}")
+    for count in EVENT_COUNTS:
+        to_publish = allocated(count)
+        print(
+            f"{count:>8} {per_event(client, to_publish) * 1e3:>13.2f}"
+            f" {pipelined(client, to_publish) * 1e3:>13.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
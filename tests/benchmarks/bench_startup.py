@@ -0,0 +1,56 @@
+import statistics
+import subprocess
+import sys
+
+
+# each case runs in a fresh interpreter; with no Postgres or Redis running the
+# warm-up only measures how quickly a refused connection is given up on
+RUNS = 5
+CASES = {
+    "interpreter": "pass",
+    "import bootstrap": "import allocation.bootstrap",
+    "import redis_eventconsumer": "import allocation.entrypoints.redis_eventconsumer",
+    "import flask_app": "import allocation.entrypoints.flask_app",
+    "flask_app ready": (
+        "from allocation.entrypoints import flask_app\nflask_app.create_app()"
+    ),
+    "consumer ready": (
+        "from allocation import bootstrap\n"
+        "from allocation.adapters import orm\n"
+        "from allocation.entrypoints import redis_eventconsumer\n"
+        "orm.start_mappers()\n"
+        "redis_eventconsumer.make_bus()\n"
+        "bootstrap.warm_up()"
+    ),
+}
+TIMED = """
+import logging, time
+logging.disable(logging.CRITICAL)
+start = time.perf_counter()
+{}
+print(time.perf_counter() - start)
+"""
+
+
+def seconds(code):
+    output = subprocess.run(
+        [sys.executable, "-c", TIMED.format(code)],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return float(output.split()[-1])
+
+
+def main():
+    print(f"{'case':<28} {'median ms':>10} {'max ms':>10}")
+    for name, code in CASES.items():
+        runs = [seconds(code) for _ in range(RUNS)]
+        print(
+            f"{name:<28} {statistics.median(runs) * 1e3:>10.1f}"
+            f" {max(runs) * 1e3:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
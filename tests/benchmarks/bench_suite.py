@@ -0,0 +1,291 @@
+import argparse
+import functools
+import gc
+import itertools
+import json
+import logging
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import date
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+from allocation import bootstrap
+from allocation.adapters import cache, orm, repository
+from allocation.domain import commands
+from allocation.domain.model import Batch, OrderLine, Product
+from allocation.service_layer import unit_of_work
+from unit.test_handlers import FakeNotifications, FakeUnitOFWork
+
+
+# Every case is timed on fresh state built outside the timed part, and reports
+# the median seconds per operation over REPEAT runs. Results are written as
+# JSON; compared against a baseline, a case counts as a regression when its
+# median is more than THRESHOLD slower. Baselines are machine specific, so
+# regressions only fail the run with --fail-on-regression, for a baseline
+# recorded on the same machine (see the Makefile's benchmarks targets).
+BASELINE = Path(__file__).with_name("baseline.json")
+REPEAT = 7
+THRESHOLD = 0.25
+
+BATCHES = [1, 10, 100]
+LINES = [0, 1_000, 10_000]
+DEPTHS = [1, 10, 100]
+LOADINGS = [repository.SELECTIN, repository.AGGREGATE]
+# operations per timed run, for the cases cheap enough to need several
+ALLOCATIONS = 200
+CHECKS = 1_000
+SPARE = date(2099, 1, 1)
+
+
+def product_with(sku, batches, lines, capacity=None):
+    # `lines` are spread over the batches, which have room for plenty more
+    capacity = capacity or lines + ALLOCATIONS * 2
+    product = Product(
+        sku, [Batch(f"{sku}-b{i}", sku, capacity, None) for i in range(batches)]
+    )
+    for i in range(lines):
+        product.batches[i % batches].allocate(OrderLine(f"old-{i}", sku, 1))
+    return product
+
+
+def product_allocate(batches, lines):
+    product = product_with("sku", batches, lines)
+    new_lines = [OrderLine(f"new-{i}", "sku", 1) for i in range(ALLOCATIONS)]
+
+    def run():
+        for line in new_lines:
+            product.allocate(line)
+
+    return run, ALLOCATIONS
+
+
+def batch_can_allocate(lines):
+    [batch] = product_with("sku", 1, lines).batches
+    line = OrderLine("new", "sku", 1)
+
+    def run():
+        for _ in range(CHECKS):
+            batch.can_allocate(line)
+
+    return run, CHECKS
+
+
+def change_batch_quantity(batches, depth):
+    # the first batch gives up `depth` lines, which move to the other batches
+    product = product_with("sku", batches, 0)
+    shrinking = product.batches[0]
+    for i in range(depth):
+        shrinking.allocate(OrderLine(f"old-{i}", "sku", 1))
+    return lambda: product.change_batch_quantity(shrinking.reference, 0), 1
+
+
+def fake_bus(*products):
+    uow = FakeUnitOFWork()
+    for product in products:
+        uow.products.add(product)
+    uow.products.seen.clear()
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow=uow,
+        notifications=FakeNotifications(),
+    )
+
+
+def bus_allocate(batches):
+    bus = fake_bus(product_with("sku", batches, 0))
+    allocations = [commands.Allocate(f"new-{i}", "sku", 1) for i in range(ALLOCATIONS)]
+
+    def run():
+        for command in allocations:
+            bus.handle(command)
+
+    return run, ALLOCATIONS
+
+
+def bus_cascade(depth):
+    # shrinking a batch to nothing moves each of its lines to the spare, all
+    # in the one handler call
+    product = product_with("sku", 1, depth, capacity=depth)
+    product.add_batch(Batch("spare", "sku", depth, SPARE))
+    bus = fake_bus(product)
+    return lambda: bus.handle(commands.ChangeBatchQuantity("sku-b0", 0)), 1
+
+
+@functools.lru_cache(maxsize=None)
+def sqlite_database(batches, lines):
+    engine = create_engine("sqlite://")
+    orm.metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+    with session_factory() as session:
+        session.add(product_with("sku", batches, lines))
+        session.commit()
+    return session_factory
+
+
+def sqlite_load(batches, lines, loading):
+    session_factory = sqlite_database(batches, lines)
+
+    def run():
+        with unit_of_work.SqlAlchemyUnitOfWork(session_factory) as uow:
+            uow.products.get(sku="sku", loading=loading)
+
+    return run, 1
+
+
+def sqlite_allocate(batches, lines):
+    # the allocate handler's whole path: load, allocate, commit with the
+    # outbox, then the projection into allocations_view
+    uow_factory = functools.partial(
+        unit_of_work.SqlAlchemyUnitOfWork, sqlite_database(batches, lines)
+    )
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow_factory=uow_factory,
+        notifications=FakeNotifications(),
+        project=uow_factory,
+    )
+    orderids = itertools.count()
+    return lambda: bus.handle(commands.Allocate(f"new-{next(orderids)}", "sku", 1)), 1
+
+
+def sqlite_allocate_cached(batches, lines):
+    # the same with the product cache warm: a version check instead of a load
+    session_factory = sqlite_database(batches, lines)
+    uow_factory = functools.partial(
+        unit_of_work.SqlAlchemyUnitOfWork,
+        session_factory,
+        product_cache=cache.ProductCache(),
+    )
+    unit_of_work.preload_products(uow_factory(), ["sku"])
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow_factory=uow_factory,
+        notifications=FakeNotifications(),
+        project=uow_factory,
+    )
+    orderids = itertools.count()
+    return lambda: bus.handle(commands.Allocate(f"new-{next(orderids)}", "sku", 1)), 1
+
+
+# the domain cases run on unmapped classes, the SQLite ones after start_mappers
+DOMAIN_CASES = [
+    (product_allocate, dict(batches=BATCHES, lines=LINES)),
+    (batch_can_allocate, dict(lines=LINES)),
+    (change_batch_quantity, dict(batches=BATCHES, depth=DEPTHS)),
+    (bus_allocate, dict(batches=BATCHES)),
+    (bus_cascade, dict(depth=DEPTHS)),
+]
+SQLITE_CASES = [
+    (sqlite_load, dict(batches=BATCHES, lines=LINES[:2], loading=LOADINGS)),
+    (sqlite_allocate, dict(batches=BATCHES, lines=LINES[:2])),
+    (sqlite_allocate_cached, dict(batches=BATCHES, lines=LINES[:2])),
+]
+
+
+def cases(grids):
+    for case, grid in grids:
+        for values in itertools.product(*grid.values()):
+            params = dict(zip(grid, values))
+            name = ",".join(f"{key}={value}" for key, value in params.items())
+            yield f"{case.__name__}[{name}]", functools.partial(case, **params)
+
+
+def measure(prepare, repeat):
+    timings = []
+    for _ in range(repeat):
+        run, operations = prepare()
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            run()
+            timings.append((time.perf_counter() - start) / operations)
+        finally:
+            gc.enable()
+    return dict(median=statistics.median(timings), min=min(timings))
+
+
+def run_suite(selected, repeat):
+    results = {}
+
+    def run(grids):
+        for name, prepare in cases(grids):
+            if any(s in name for s in selected) or not selected:
+                results[name] = measure(prepare, repeat)
+                print(f"{name:<62} {results[name]['median'] * 1e6:>12.2f} us")
+
+    run(DOMAIN_CASES)
+    orm.start_mappers()
+    try:
+        run(SQLITE_CASES)
+    finally:
+        clear_mappers()
+        sqlite_database.cache_clear()
+    return dict(meta=meta(repeat), results=results)
+
+
+def meta(repeat):
+    commit = subprocess.run(
+        ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True
+    ).stdout.strip()
+    return dict(
+        python=platform.python_version(),
+        machine=platform.platform(),
+        commit=commit,
+        repeat=repeat,
+    )
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    print(f"\n{'case':<62} {'baseline us':>12} {'now us':>12} {'ratio':>7}")
+    for name, result in results["results"].items():
+        before = baseline["results"].get(name)
+        if before is None:
+            continue
+        ratio = result["median"] / before["median"]
+        flag = " <-" if ratio > 1 + threshold else ""
+        print(
+            f"{name:<62} {before['median'] * 1e6:>12.2f}"
+            f" {result['median'] * 1e6:>12.2f} {ratio:>7.2f}{flag}"
+        )
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-k", dest="selected", action="append", default=[])
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    parser.add_argument("--output", type=Path)
+    parser.add_argument("--compare", type=Path)
+    parser.add_argument("--threshold", type=float, default=THRESHOLD)
+    parser.add_argument("--fail-on-regression", action="store_true")
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    results = run_suite(args.selected, args.repeat)
+    for path in [args.output, BASELINE if args.update_baseline else None]:
+        if path is not None:
+            path.write_text(json.dumps(results, indent=2, sort_keys=True) + "\n")
+
+    if args.compare:
+        baseline = json.loads(args.compare.read_text())
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} cases regressed by over {args.threshold:.0%}")
+            if args.fail_on_regression:
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import contextlib
 import pytest
 import time
 from pathlib import Path
@@ -7,7 +8,8 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, clear_mappers
 from tenacity import retry, stop_after_delay
 
-from allocation.adapters.orm import metadata, start_mappers
+from allocation.adapters.orm import metadata, start_mappers, upgrade_schema
+from allocation.adapters.sql_tracing import SqlTracer
 import allocation.config as config
 import shutil
 import subprocess
@@ -57,6 +59,32 @@ def sqlite_session_factory(in_memory_db):
     clear_mappers()
 
 
+@pytest.fixture
+def sql_trace(in_memory_db):
+    tracer = SqlTracer(keep=True).attach(in_memory_db)
+    yield tracer
+    tracer.detach(in_memory_db)
+
+
+@pytest.fixture
+def query_budget(sql_trace):
+    # with query_budget(allocate=4): fails if any one call of the allocate
+    # handler inside the block runs more than four statements
+    @contextlib.contextmanager
+    def budget(**limits):
+        sql_trace.clear()
+        yield sql_trace
+        used = sql_trace.per_call()
+        over = {
+            handler: used[handler]
+            for handler, limit in limits.items()
+            if used.get(handler, 0) > limit
+        }
+        assert not over, f"over budget {limits}: {over}\n{sql_trace.report()}"
+
+    return budget
+
+
 @retry(stop=stop_after_delay(10))
 def wait_for_postgres_to_come_up(engine):
     return engine.connect()
@@ -78,7 +106,7 @@ def wait_for_redis_to_come_up():
 def postgres_db():
     engine = create_engine(config.get_postgres_uri())
     wait_for_postgres_to_come_up(engine)
-    metadata.create_all(engine)
+    upgrade_schema(engine)
     return engine
 
 
@@ -1,5 +1,6 @@
 from allocation import config
 import requests
+from tenacity import Retrying, stop_after_delay, wait_fixed
 
 
 def post_to_add_batch(ref, sku, qty, eta):
@@ -20,6 +21,48 @@ def post_to_allocate(orderid, sku, qty, expect_success=True):
     return r
 
 
-def get_allocation(orderid):
+def post_to_allocate_bulk(lines):
     url = config.get_api_url()
-    return requests.get(f"{url}/allocations/{orderid}")
+    r = requests.post(f"{url}/allocate/bulk", json={"lines": lines})
+    assert r.status_code == 202
+    return r
+
+
+def get_allocation(orderid, etag=None):
+    url = config.get_api_url()
+    headers = {"If-None-Match": etag} if etag else {}
+    return requests.get(f"{url}/allocations/{orderid}", headers=headers)
+
+
+def get_projected_allocation(orderid):
+    # the view catches up with a write soon after the write returns, though
+    # not always before, so a read straight after one may have to wait
+    for attempt in Retrying(
+        stop=stop_after_delay(3), wait=wait_fixed(0.1), reraise=True
+    ):
+        with attempt:
+            r = get_allocation(orderid)
+            assert r.status_code != 404
+    return r
+
+
+def post_to_get_allocations_bulk(orderids, expect_success=True):
+    url = config.get_api_url()
+    r = requests.post(f"{url}/allocations/bulk", json={"orderids": orderids})
+    if not expect_success:
+        return r
+    assert r.status_code == 200
+    return r.json()
+
+
+def get_allocations(after=None, limit=None, **key):
+    url = config.get_api_url()
+    return requests.get(
+        f"{url}/allocations", params=dict(after=after, limit=limit, **key)
+    )
+
+
+def get_allocations_page(after=None, limit=None, **key):
+    r = get_allocations(after=after, limit=limit, **key)
+    assert r.status_code == 200
+    return r.json()
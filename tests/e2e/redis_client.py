@@ -6,13 +6,25 @@ from allocation import config
 r = redis.Redis(**config.get_redis_host_and_port())
 
 
+class Subscription:
+    # reads a stream from the point it was subscribed to, like pub/sub would
+    def __init__(self, stream):
+        self.stream = stream
+        [[self.last_id, _]] = r.xrevrange(stream, count=1) or [["0-0", None]]
+
+    def get_message(self, timeout):
+        response = r.xread(
+            {self.stream: self.last_id}, count=1, block=int(timeout * 1000)
+        )
+        if not response:
+            return None
+        [[_, [(self.last_id, fields)]]] = response
+        return {"data": fields[b"data"]}
+
+
 def subscribe_to(channel):
-    pubsub = r.pubsub()
-    pubsub.subscribe(channel)
-    confirmation = pubsub.get_message(timeout=3)
-    assert confirmation["type"] == "subscribe"
-    return pubsub
+    return Subscription(channel)
 
 
 def publish_message(channel, message):
-    r.publish(channel, json.dumps(message))
+    r.xadd(channel, {"data": json.dumps(message)})
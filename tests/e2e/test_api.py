@@ -1,5 +1,6 @@
 import pytest
 import api_client
+from concurrent.futures import ThreadPoolExecutor
 
 
 from conftest import random_batchref, random_orderid, random_sku
@@ -21,7 +22,7 @@ def test_happy_path_returns_202_and_allocated_batch():
     r = api_client.post_to_allocate(orderid, sku, qty=3)
     assert r.status_code == 202
 
-    r = api_client.get_allocation(orderid)
+    r = api_client.get_projected_allocation(orderid)
     assert r.ok
     assert r.json() == [{"sku": sku, "batchref": earlybatch}]
 
@@ -37,3 +38,115 @@ def test_unhappy_path_returns_400_and_error_message():
 
     r = api_client.get_allocation(orderid)
     assert r.status_code == 404
+
+
+@pytest.mark.usefixtures("postgres_db")
+@pytest.mark.usefixtures("restart_api")
+def test_unchanged_allocations_return_304():
+    orderid, sku, batch = random_orderid(), random_sku(), random_batchref()
+    api_client.post_to_add_batch(batch, sku, 100, None)
+    api_client.post_to_allocate(orderid, sku, qty=3)
+
+    r = api_client.get_projected_allocation(orderid)
+    assert r.ok
+    etag = r.headers["ETag"]
+
+    r = api_client.get_allocation(orderid, etag=etag)
+    assert r.status_code == 304
+
+
+@pytest.mark.usefixtures("postgres_db")
+@pytest.mark.usefixtures("restart_api")
+def test_bulk_lookup_and_paging_through_a_sku():
+    sku, batch = random_sku(), random_batchref()
+    orderids = sorted(random_orderid(str(i)) for i in range(5))
+    api_client.post_to_add_batch(batch, sku, 100, None)
+    for orderid in orderids:
+        api_client.post_to_allocate(orderid, sku, qty=1)
+    # the outbox is projected in order, so the last order means all of them
+    api_client.get_projected_allocation(orderids[-1])
+
+    assert api_client.post_to_get_allocations_bulk(orderids[:2]) == {
+        orderids[0]: [{"sku": sku, "batchref": batch}],
+        orderids[1]: [{"sku": sku, "batchref": batch}],
+    }
+
+    seen, cursor = [], None
+    while True:
+        page = api_client.get_allocations_page(sku=sku, after=cursor, limit=2)
+        seen += [row["orderid"] for row in page["allocations"]]
+        cursor = page["next"]
+        if cursor is None:
+            break
+    assert seen == orderids
+
+
+@pytest.mark.usefixtures("postgres_db")
+@pytest.mark.usefixtures("restart_api")
+@pytest.mark.parametrize("orderids", ["order1", None, [1, 2], [["order1"]]])
+def test_bulk_lookup_needs_a_list_of_order_ids(orderids):
+    r = api_client.post_to_get_allocations_bulk(orderids, expect_success=False)
+
+    assert r.status_code == 400
+    assert r.json()["messages"] == "orderids must be a list of strings"
+
+
+@pytest.mark.usefixtures("postgres_db")
+@pytest.mark.usefixtures("restart_api")
+def test_malformed_cursor_returns_400():
+    r = api_client.get_allocations(sku=random_sku(), after="WzEsIDJd")
+
+    assert r.status_code == 400
+    assert "Invalid cursor" in r.json()["messages"]
+
+
+@pytest.mark.usefixtures("postgres_db")
+@pytest.mark.usefixtures("restart_api")
+def test_bulk_allocate_reports_each_line():
+    orderid = random_orderid()
+    sku, unknown_sku = random_sku(), random_sku("unknown")
+    batch = random_batchref()
+    api_client.post_to_add_batch(batch, sku, 10, None)
+
+    r = api_client.post_to_allocate_bulk(
+        [
+            {"orderid": orderid, "sku": sku, "qty": 3},
+            {"orderid": orderid, "sku": unknown_sku, "qty": 1},
+        ]
+    )
+
+    assert r.json() == [
+        {"orderid": orderid, "sku": sku, "batchref": batch},
+        {
+            "orderid": orderid,
+            "sku": unknown_sku,
+            "error": f"Invalid sku: {unknown_sku}",
+        },
+    ]
+    r = api_client.get_projected_allocation(orderid)
+    assert r.json() == [{"sku": sku, "batchref": batch}]
+
+
+@pytest.mark.usefixtures("postgres_db")
+@pytest.mark.usefixtures("restart_api")
+def test_concurrent_allocations_each_get_their_own_session():
+    # one SKU per order, so the requests only compete for the app, not a product
+    orders = [(random_orderid(i), random_sku(i), random_batchref(i)) for i in range(40)]
+    for _, sku, batch in orders:
+        api_client.post_to_add_batch(batch, sku, 10, None)
+
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        responses = list(
+            pool.map(
+                lambda order: api_client.post_to_allocate(
+                    order[0], order[1], 1, expect_success=False
+                ),
+                orders,
+            )
+        )
+
+    assert [r.status_code for r in responses] == [202] * len(orders)
+    for orderid, sku, batch in orders:
+        assert api_client.get_projected_allocation(orderid).json() == [
+            {"sku": sku, "batchref": batch}
+        ]
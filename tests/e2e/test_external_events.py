@@ -18,7 +18,7 @@ def test_change_batch_quantity_leading_to_reallocation():
     assert response.ok
 
     # we now get a view
-    response = api_client.get_allocation(orderid)
+    response = api_client.get_projected_allocation(orderid)
     assert response.json()[0]["batchref"] == earlier_batch
 
     subscription = redis_client.subscribe_to("line_allocated")
@@ -0,0 +1,69 @@
+import socketserver
+import threading
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    # just enough of SMTP for smtplib.sendmail
+
+    def handle(self):
+        self.server.connections.append(self.connection)
+        self.reply("220 localhost stand-in")
+        mail = {}
+        while line := self.rfile.readline():
+            command = line.decode().strip().upper()
+            if command.startswith(("EHLO", "HELO")):
+                self.reply("250 localhost")
+            elif command.startswith("MAIL FROM"):
+                mail = {"to": [], "data": ""}
+                self.reply("250 OK")
+            elif command.startswith("RCPT TO"):
+                mail["to"].append(line.decode().strip()[8:].strip("<>"))
+                self.reply("250 OK")
+            elif command == "DATA":
+                self.reply("354 go ahead")
+                mail["data"] = self.read_data()
+                self.server.received.append(mail)
+                self.reply("250 OK")
+            elif command == "QUIT":
+                self.reply("221 bye")
+                return
+            else:
+                self.reply("250 OK")
+
+    def read_data(self):
+        lines = []
+        while (line := self.rfile.readline().decode()) not in (".\r\n", ""):
+            lines.append(line)
+        return "".join(lines)
+
+    def reply(self, text):
+        self.wfile.write(f"{text}\r\n".encode())
+
+
+class SMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("localhost", 0), SMTPHandler)
+        self.received = []
+        self.connections = []
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def drop_connections(self):
+        # what a server does to clients that sat idle too long
+        for connection in self.connections:
+            connection.close()
+        self.connections.clear()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
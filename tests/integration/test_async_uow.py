@@ -0,0 +1,100 @@
+import asyncio
+import pytest
+from unittest import mock
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import clear_mappers
+from sqlalchemy.pool import StaticPool
+from allocation import bootstrap
+from allocation.adapters.orm import metadata, start_mappers
+from allocation.domain import commands, model
+from allocation.service_layer import unit_of_work
+
+
+@pytest.fixture
+def mappers():
+    start_mappers()
+    yield
+    clear_mappers()
+
+
+def run_with_async_sqlite(scenario):
+    async def run():
+        engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+        try:
+            async with engine.begin() as conn:
+                await conn.run_sync(metadata.create_all)
+            return await scenario(
+                async_sessionmaker(bind=engine, expire_on_commit=False)
+            )
+        finally:
+            await engine.dispose()
+
+    return asyncio.run(run())
+
+
+@pytest.mark.usefixtures("mappers")
+def test_async_uow_can_retrieve_a_product_and_allocate_to_it():
+    async def scenario(session_factory):
+        uow = unit_of_work.AsyncSqlAlchemyUnitOfWork(session_factory)
+        async with uow:
+            uow.products.add(
+                model.Product(
+                    "RETRO-CLOCK", [model.Batch("b1", "RETRO-CLOCK", 10, None)]
+                )
+            )
+            await uow.commit()
+
+        async with uow:
+            product = await uow.products.get(sku="RETRO-CLOCK")
+            product.allocate(model.OrderLine("o1", "RETRO-CLOCK", 4))
+            await uow.commit()
+
+        async with uow:
+            product = await uow.products.get_by_batchref("b1")
+            [batch] = product.batches
+            return batch.available_quantity
+
+    assert run_with_async_sqlite(scenario) == 6
+
+
+@pytest.mark.usefixtures("mappers")
+def test_async_uow_rolls_back_uncommitted_work_by_default():
+    async def scenario(session_factory):
+        uow = unit_of_work.AsyncSqlAlchemyUnitOfWork(session_factory)
+        async with uow:
+            uow.products.add(model.Product("MEDIUM-PLINTH", []))
+
+        async with session_factory() as session:
+            return list(await session.execute(text("SELECT * FROM products")))
+
+    assert run_with_async_sqlite(scenario) == []
+
+
+def test_async_bus_updates_the_read_model_and_outbox():
+    async def scenario(session_factory):
+        uow = unit_of_work.AsyncSqlAlchemyUnitOfWork(session_factory)
+        bus = bootstrap.async_bootstrap(
+            start_orm=True,
+            uow=uow,
+            notifications=mock.AsyncMock(),
+            project=lambda: uow,
+        )
+        await bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
+        await bus.handle(commands.Allocate("order1", "sku1", 20))
+
+        async with session_factory() as session:
+            view = list(
+                await session.execute(
+                    text("SELECT sku, batchref FROM allocations_view")
+                )
+            )
+            channels = list(await session.execute(text("SELECT channel FROM outbox")))
+        return view, channels
+
+    try:
+        view, channels = run_with_async_sqlite(scenario)
+        assert view == [("sku1", "b1")]
+        assert channels == [("line_allocated",)]
+    finally:
+        clear_mappers()
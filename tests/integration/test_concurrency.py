@@ -0,0 +1,73 @@
+import functools
+import threading
+import pytest
+from unittest import mock
+from sqlalchemy import create_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+from allocation import bootstrap, views
+from allocation.adapters.orm import metadata
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+
+
+THREADS = 8
+ORDERS_PER_THREAD = 20
+
+
+@pytest.fixture
+def file_sqlite_bus(tmp_path):
+    # an in-memory database is one connection, so use a file to get real
+    # concurrent sessions
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'allocation.db'}", connect_args={"timeout": 30}
+    )
+    metadata.create_all(engine)
+    uow_factory = functools.partial(
+        unit_of_work.SqlAlchemyUnitOfWork, sessionmaker(bind=engine)
+    )
+    bus = bootstrap.bootstrap(
+        start_orm=True,
+        uow_factory=uow_factory,
+        notifications=mock.Mock(),
+        project=uow_factory,
+    )
+    yield bus
+    clear_mappers()
+    engine.dispose()
+
+
+def test_bus_can_be_shared_between_threads(file_sqlite_bus):
+    bus = file_sqlite_bus
+    for t in range(THREADS):
+        bus.handle(commands.CreateBatch(f"batch-{t}", f"sku-{t}", 1000, None))
+
+    errors = []
+    start = threading.Barrier(THREADS)
+
+    def allocate_orders(t):
+        start.wait()
+        try:
+            for i in range(ORDERS_PER_THREAD):
+                [batchref] = bus.handle(
+                    commands.Allocate(f"order-{t}-{i}", f"sku-{t}", 1)
+                )
+                assert batchref == f"batch-{t}"
+        except Exception as e:
+            errors.append(e)
+
+    threads = [
+        threading.Thread(target=allocate_orders, args=(t,)) for t in range(THREADS)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    # a thread's allocations may still be projecting when its handle() returns,
+    # by another thread, but they are all in the view once every thread is done
+    for t in range(THREADS):
+        for i in range(ORDERS_PER_THREAD):
+            assert views.allocations(f"order-{t}-{i}", bus.uow_factory) == [
+                {"sku": f"sku-{t}", "batchref": f"batch-{t}"}
+            ]
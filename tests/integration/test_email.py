@@ -1,17 +1,71 @@
 import pytest
 from allocation import bootstrap
 from allocation.adapters import notifications
+from allocation.domain import commands
 from allocation.service_layer import unit_of_work
 from sqlalchemy.orm import clear_mappers
+from smtp_server import SMTPServer
 
 
 @pytest.fixture
-def bus(sqlite_session_factory):
+def smtp_server():
+    with SMTPServer() as server:
+        yield server
+
+
+@pytest.fixture
+def email(smtp_server):
+    email = notifications.EmailNotifications("localhost", smtp_server.port)
+    yield email
+    email.close()
+
+
+@pytest.fixture
+def background(email):
+    background = notifications.BackgroundNotifications(email, window=60)
+    yield background
+    background.close()
+
+
+@pytest.fixture
+def bus(sqlite_session_factory, background):
     bus = bootstrap.bootstrap(
-        start_orm=True,
+        start_orm=False,
         uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
-        notifications=notifications.EmailNotifications(),
-        publish=lambda *args: None,
+        notifications=background,
     )
     yield bus
     clear_mappers()
+
+
+def test_out_of_stock_burst_sends_one_email(bus, background, smtp_server):
+    bus.handle(commands.CreateBatch("b1", "lamp", 5, None))
+    for i in range(10):
+        bus.handle(commands.Allocate(f"o{i}", "lamp", 10))
+    background.close()
+
+    [mail] = smtp_server.received
+    assert mail["to"] == ["user@mail.com"]
+    assert "Out of stock for lamp (x10)" in mail["data"]
+
+
+def test_connects_on_first_send_and_reuses_the_connection(email, smtp_server):
+    assert smtp_server.connections == []
+
+    email.send("user@mail.com", "one")
+    email.send("user@mail.com", "two")
+
+    assert len(smtp_server.received) == 2
+    assert len(smtp_server.connections) == 1
+
+
+def test_reconnects_when_the_server_dropped_the_connection(email, smtp_server):
+    email.send("user@mail.com", "before")
+
+    smtp_server.drop_connections()
+    email.send("user@mail.com", "after")
+
+    assert [mail["data"].split()[-1] for mail in smtp_server.received] == [
+        "before",
+        "after",
+    ]
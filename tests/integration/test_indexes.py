@@ -0,0 +1,132 @@
+import pytest
+from sqlalchemy import create_engine, inspect, text
+from allocation.adapters import orm
+
+
+HOT_QUERIES = [
+    (
+        "SELECT id FROM batches WHERE reference = :value",
+        "ix_batches_reference",
+    ),
+    (
+        "SELECT id FROM batches WHERE sku = :value",
+        "ix_batches_sku",
+    ),
+    (
+        "SELECT sku, batchref FROM allocations_view WHERE orderid = :value",
+        "ix_allocations_view_orderid_sku",
+    ),
+    (
+        "DELETE FROM allocations_view WHERE orderid = :value AND sku = :value",
+        "ix_allocations_view_orderid_sku",
+    ),
+    (
+        "SELECT sku, batchref FROM allocations_view"
+        " WHERE orderid IN (:value, :value)",
+        "ix_allocations_view_orderid_sku",
+    ),
+    (
+        "SELECT orderid, sku, batchref FROM allocations_view WHERE sku = :value"
+        " AND (orderid, batchref) > (:value, :value)"
+        " ORDER BY orderid, batchref LIMIT 100",
+        "ix_allocations_view_sku_orderid",
+    ),
+    (
+        "SELECT orderid, sku, batchref FROM allocations_view WHERE batchref = :value"
+        " AND (orderid, sku) > (:value, :value)"
+        " ORDER BY orderid, sku LIMIT 100",
+        "ix_allocations_view_batchref_orderid",
+    ),
+    (
+        "SELECT orderline_id FROM allocations WHERE batch_id = :value",
+        "ix_allocations_batch_id",
+    ),
+    (
+        "SELECT batch_id FROM allocations WHERE orderline_id = :value",
+        "ix_allocations_orderline_id",
+    ),
+]
+
+
+def sqlite_plan(session, query):
+    rows = session.execute(text(f"EXPLAIN QUERY PLAN {query}"), dict(value="x"))
+    return " ".join(row[-1] for row in rows)
+
+
+def postgres_plan(session, query):
+    # tables in the test database are tiny, so stop the planner preferring scans
+    session.execute(text("SET LOCAL enable_seqscan = off"))
+    rows = session.execute(text(f"EXPLAIN {query}"), dict(value="x"))
+    return " ".join(row[0] for row in rows)
+
+
+@pytest.mark.parametrize("query, index", HOT_QUERIES)
+def test_sqlite_hot_query_uses_index(session, query, index):
+    assert index in sqlite_plan(session, query)
+
+
+@pytest.mark.parametrize("query, index", HOT_QUERIES)
+def test_postgres_hot_query_uses_index(postgres_session, query, index):
+    try:
+        assert index in postgres_plan(postgres_session, query)
+    finally:
+        postgres_session.rollback()
+
+
+def test_batch_references_are_unique(session):
+    insert = text(
+        "INSERT INTO batches (reference, sku, _purchased_quantity)"
+        " VALUES ('batch1', 'sku1', 10)"
+    )
+    session.execute(insert)
+    with pytest.raises(Exception, match="UNIQUE"):
+        session.execute(insert)
+
+
+def test_upgrade_schema_adds_missing_indexes(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/old.db")
+    with engine.begin() as conn:
+        for table in orm.metadata.sorted_tables:
+            conn.execute(text(f"CREATE TABLE {table.name} (id INTEGER)"))
+            for column in table.columns:
+                if column.name != "id":
+                    conn.execute(
+                        text(f"ALTER TABLE {table.name} ADD COLUMN {column.name}")
+                    )
+
+    orm.upgrade_schema(engine)
+    orm.upgrade_schema(engine)
+
+    indexes = {
+        index["name"]
+        for table in orm.metadata.sorted_tables
+        for index in inspect(engine).get_indexes(table.name)
+    }
+    assert indexes == {
+        index.name for table in orm.metadata.sorted_tables for index in table.indexes
+    }
+
+
+def test_upgrade_schema_adds_projected_at_to_an_existing_outbox(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/old.db")
+    orm.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(text("DROP INDEX ix_outbox_unprojected"))
+        conn.execute(text("ALTER TABLE outbox DROP COLUMN projected_at"))
+        conn.execute(
+            text(
+                "INSERT INTO outbox (channel, payload, created_at)"
+                " VALUES ('line_allocated', '{}', '2024-01-01 00:00:00')"
+            )
+        )
+
+    orm.upgrade_schema(engine)
+
+    with engine.connect() as conn:
+        # already in the view, so the projector must not apply it again
+        assert (
+            conn.execute(
+                text("SELECT count(*) FROM outbox WHERE projected_at IS NULL")
+            ).scalar()
+            == 0
+        )
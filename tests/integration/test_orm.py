@@ -121,3 +121,33 @@ def test_retrieving_allocations(session):
     batch = session.query(model.Batch).one()
 
     assert batch._allocations == {model.OrderLine("order1", "sku1", 12)}
+
+
+def test_retrieved_batch_rebuilds_allocated_quantity(session):
+    batch = model.Batch("batch1", "sku1", 100, eta=None)
+    batch.allocate(model.OrderLine("order1", "sku1", 10))
+    batch.allocate(model.OrderLine("order2", "sku1", 15))
+    session.add(batch)
+    session.commit()
+    session.expunge_all()
+
+    batch = session.query(model.Batch).one()
+    assert batch.available_quantity == 75
+
+    batch.allocate(model.OrderLine("order3", "sku1", 5))
+    batch.deallocate(model.OrderLine("order1", "sku1", 10))
+    assert batch.allocated_quantity == 20
+
+
+def test_loaded_lines_share_their_sku_without_becoming_dirty(session):
+    session.execute(
+        text(
+            "INSERT INTO order_lines (orderid, sku, qty) VALUES "
+            '("order1", "RED-CHAIR", 12),'
+            '("order2", "RED-CHAIR", 13)'
+        )
+    )
+    first, second = session.query(model.OrderLine).all()
+
+    assert first.sku is second.sku
+    assert not session.dirty
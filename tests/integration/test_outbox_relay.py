@@ -0,0 +1,88 @@
+import json
+import fakeredis
+import pytest
+from sqlalchemy import bindparam, text
+from allocation.adapters import outbox
+from allocation.domain import events
+from allocation.entrypoints import outbox_relay
+
+
+def add_to_outbox(engine, *orderids):
+    rows = outbox.rows_for(events.Allocated(o, "sku", 1, "b1") for o in orderids)
+    with engine.begin() as conn:
+        conn.execute(outbox.add(rows))
+
+
+def relayed(client):
+    return [
+        json.loads(fields[b"data"])["orderid"]
+        for _, fields in client.xrange("line_allocated")
+    ]
+
+
+def unsent(engine):
+    with engine.connect() as conn:
+        return conn.execute(
+            text("SELECT count(*) FROM outbox WHERE sent_at IS NULL")
+        ).scalar()
+
+
+def test_relays_unsent_rows_in_batches(in_memory_db, sqlite_session_factory):
+    client = fakeredis.FakeRedis()
+    add_to_outbox(in_memory_db, "o1", "o2", "o3")
+
+    assert outbox_relay.relay(sqlite_session_factory, client, batch_size=2) == 2
+    assert relayed(client) == ["o1", "o2"]
+    assert outbox_relay.relay(sqlite_session_factory, client, batch_size=2) == 1
+    assert outbox_relay.relay(sqlite_session_factory, client, batch_size=2) == 0
+
+    assert relayed(client) == ["o1", "o2", "o3"]
+    assert unsent(in_memory_db) == 0
+
+
+def test_rows_stay_unsent_when_redis_is_down(in_memory_db, sqlite_session_factory):
+    server = fakeredis.FakeServer()
+    client = fakeredis.FakeRedis(server=server)
+    add_to_outbox(in_memory_db, "o1")
+
+    server.connected = False
+    with pytest.raises(Exception):
+        outbox_relay.relay(sqlite_session_factory, client)
+    assert unsent(in_memory_db) == 1
+
+    server.connected = True
+    outbox_relay.relay(sqlite_session_factory, client)
+    assert relayed(client) == ["o1"]
+
+
+def outbox_orderids(engine):
+    with engine.connect() as conn:
+        return [
+            json.loads(payload)["orderid"]
+            for [payload] in conn.execute(text("SELECT payload FROM outbox"))
+        ]
+
+
+def test_prunes_rows_relayed_and_projected_before_the_retention(
+    in_memory_db, sqlite_session_factory
+):
+    add_to_outbox(in_memory_db, "old1", "old2", "unsent", "unprojected", "recent")
+    with in_memory_db.begin() as conn:
+        for orderids, sent, projected in [
+            (["old1", "old2"], "-2 days", "-2 days"),
+            (["unprojected"], "-2 days", None),
+            (["recent"], "-1 hour", "-1 hour"),
+        ]:
+            conn.execute(
+                text(
+                    "UPDATE outbox SET"
+                    " sent_at = datetime('now', :sent),"
+                    " projected_at = datetime('now', :projected)"
+                    " WHERE json_extract(payload, '$.orderid') IN :orderids"
+                ).bindparams(bindparam("orderids", expanding=True)),
+                dict(sent=sent, projected=projected, orderids=orderids),
+            )
+
+    day = 24 * 3600
+    assert outbox_relay.prune(sqlite_session_factory, day, batch_size=1) == 2
+    assert outbox_orderids(in_memory_db) == ["unsent", "unprojected", "recent"]
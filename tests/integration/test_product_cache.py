@@ -0,0 +1,182 @@
+import functools
+import random
+import pytest
+from unittest import mock
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+from allocation import bootstrap, views
+from allocation.adapters import cache, orm
+from allocation.domain import commands, model
+from allocation.service_layer import unit_of_work
+
+
+def sqlite_bus(session_factory, product_cache=None):
+    uow_factory = functools.partial(
+        unit_of_work.SqlAlchemyUnitOfWork,
+        session_factory,
+        product_cache=product_cache,
+    )
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow_factory=uow_factory,
+        notifications=mock.Mock(),
+        project=uow_factory,
+    )
+
+
+@pytest.fixture
+def product_cache():
+    return cache.ProductCache()
+
+
+@pytest.fixture
+def cached_bus(sqlite_session_factory, product_cache):
+    return sqlite_bus(sqlite_session_factory, product_cache)
+
+
+def database_state(session_factory):
+    with session_factory() as session:
+        return [
+            session.execute(text(query)).all()
+            for query in [
+                "SELECT sku, version_number FROM products ORDER BY sku",
+                "SELECT reference, sku, _purchased_quantity FROM batches ORDER BY id",
+                "SELECT b.reference, l.orderid, l.qty FROM allocations a"
+                " JOIN batches b ON b.id = a.batch_id"
+                " JOIN order_lines l ON l.id = a.orderline_id"
+                " ORDER BY l.orderid, b.reference",
+                "SELECT orderid, sku, batchref FROM allocations_view"
+                " ORDER BY orderid, sku",
+            ]
+        ]
+
+
+def random_commands(rng, count):
+    skus = ["lamp", "chair", "table"]
+    batches = {}
+    for i in range(count):
+        action = rng.random()
+        if action < 0.2 or not batches:
+            batches[f"b{i}"] = rng.randint(5, 30)
+            yield commands.CreateBatch(f"b{i}", rng.choice(skus), batches[f"b{i}"])
+        elif action < 0.3:
+            ref = rng.choice(list(batches))
+            batches[ref] = max(0, batches[ref] + rng.randint(-15, 10))
+            yield commands.ChangeBatchQuantity(ref, batches[ref])
+        elif action < 0.4:
+            yield commands.AllocateMany(
+                [
+                    commands.Allocate(f"o{i}-{j}", rng.choice(skus), rng.randint(1, 3))
+                    for j in range(3)
+                ]
+            )
+        else:
+            yield commands.Allocate(f"o{i}", rng.choice(skus), rng.randint(1, 5))
+
+
+def test_same_results_as_without_the_cache(sqlite_session_factory, product_cache):
+    engine = create_engine("sqlite://")
+    orm.metadata.create_all(engine)
+    uncached_session_factory = sessionmaker(bind=engine)
+    cached = sqlite_bus(sqlite_session_factory, product_cache)
+    uncached = sqlite_bus(uncached_session_factory)
+
+    for command in random_commands(random.Random(1), 300):
+        results = []
+        for bus in [cached, uncached]:
+            try:
+                results.append(bus.handle(command))
+            except Exception as e:
+                results.append(repr(e))
+        assert results[0] == results[1], command
+
+    assert database_state(sqlite_session_factory) == database_state(
+        uncached_session_factory
+    )
+    assert product_cache.stats["hits"] > 100
+
+
+def test_hits_skip_loading_the_aggregate(cached_bus, product_cache, sql_trace):
+    cached_bus.handle(commands.CreateBatch("b1", "lamp", 10, None))
+    cached_bus.handle(commands.Allocate("o1", "lamp", 1))
+    sql_trace.clear()
+
+    cached_bus.handle(commands.Allocate("o2", "lamp", 1))
+
+    loads = [s.sql for s in sql_trace.statements if s.handler == "allocate"]
+    assert loads[0].startswith("SELECT products.version_number")
+    assert not any("FROM batches" in sql for sql in loads)
+    assert product_cache.stats == dict(hits=2, misses=1, stale=0)
+
+
+def test_finds_products_by_batchref(cached_bus, product_cache):
+    cached_bus.handle(commands.CreateBatch("b1", "lamp", 10, None))
+    cached_bus.handle(commands.Allocate("o1", "lamp", 6))
+
+    cached_bus.handle(commands.ChangeBatchQuantity("b1", 5))
+
+    # the batchref lookup hit, then reallocating found nothing in stock
+    assert product_cache.stats["hits"] >= 2
+    assert views.allocations("o1", cached_bus.uow_factory) == []
+
+
+def test_changes_made_elsewhere_are_not_missed(
+    sqlite_session_factory, cached_bus, product_cache
+):
+    elsewhere = sqlite_bus(sqlite_session_factory)
+    cached_bus.handle(commands.CreateBatch("b1", "lamp", 10, None))
+    cached_bus.handle(commands.Allocate("o1", "lamp", 5))
+
+    elsewhere.handle(commands.Allocate("o2", "lamp", 5))
+    [batchref] = cached_bus.handle(commands.Allocate("o3", "lamp", 1))
+
+    assert batchref is None
+    assert product_cache.stats["stale"] == 1
+
+
+def test_uncommitted_changes_are_not_cached(sqlite_session_factory, product_cache):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        sqlite_session_factory, product_cache=product_cache
+    )
+    with uow:
+        uow.products.add(model.Product("lamp", [model.Batch("b1", "lamp", 10, None)]))
+        uow.commit()
+    list(uow.collect_new_events())
+
+    with uow:
+        product = uow.products.get("lamp")
+        product.change_batch_quantity("b1", 1)
+    list(uow.collect_new_events())
+
+    with uow:
+        assert uow.products.get("lamp").batches[0].purchased_quantity == 10
+    assert product_cache.stats == dict(hits=1, misses=1, stale=0)
+
+
+def test_least_recently_used_products_are_evicted(sqlite_session_factory):
+    product_cache = cache.ProductCache(max_size=1)
+    bus = sqlite_bus(sqlite_session_factory, product_cache)
+    bus.handle(commands.CreateBatch("b1", "lamp", 10, None))
+    bus.handle(commands.CreateBatch("b2", "chair", 10, None))
+
+    assert list(product_cache.entries) == ["chair"]
+    assert product_cache.sku_for_batchref("b1") is None
+
+
+def test_preloads_the_busiest_skus(sqlite_session_factory, product_cache):
+    bus = sqlite_bus(sqlite_session_factory)
+    for sku, orders in [("lamp", 1), ("chair", 3), ("table", 2)]:
+        bus.handle(commands.CreateBatch(f"{sku}-batch", sku, 10, None))
+        for i in range(orders):
+            bus.handle(commands.Allocate(f"{sku}-{i}", sku, 1))
+
+    skus = views.busiest_skus(2, bus.uow_factory)
+    unit_of_work.preload_products(
+        unit_of_work.SqlAlchemyUnitOfWork(
+            sqlite_session_factory, product_cache=product_cache
+        ),
+        skus,
+    )
+
+    assert skus == ["chair", "table"]
+    assert set(product_cache.entries) == {"chair", "table"}
@@ -0,0 +1,124 @@
+import threading
+import pytest
+from sqlalchemy import event, text
+from allocation.adapters import outbox
+from allocation.domain import events
+from allocation.service_layer import projector, unit_of_work
+
+
+@pytest.fixture
+def uow_factory(sqlite_session_factory):
+    return lambda: unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+
+
+def add_to_outbox(session_factory, *messages):
+    with session_factory() as session:
+        session.execute(outbox.add(outbox.rows_for(messages)))
+        session.commit()
+
+
+def view(session_factory):
+    with session_factory() as session:
+        return list(
+            session.execute(text("SELECT orderid, sku, batchref FROM allocations_view"))
+        )
+
+
+def test_projects_allocations_and_deallocations_in_order(
+    sqlite_session_factory, uow_factory
+):
+    add_to_outbox(
+        sqlite_session_factory,
+        events.Allocated("o1", "sku", 10, "b1"),
+        events.Allocated("o2", "sku", 10, "b1"),
+        events.Deallocated("o1", "sku", 10),
+        events.Allocated("o1", "sku", 10, "b2"),
+    )
+
+    assert projector.project(uow_factory) == 4
+
+    assert sorted(view(sqlite_session_factory)) == [
+        ("o1", "sku", "b2"),
+        ("o2", "sku", "b1"),
+    ]
+
+
+def test_resumes_from_rows_not_yet_projected(sqlite_session_factory, uow_factory):
+    add_to_outbox(sqlite_session_factory, events.Allocated("o1", "sku", 10, "b1"))
+    projector.project(uow_factory)
+    add_to_outbox(sqlite_session_factory, events.Allocated("o2", "sku", 10, "b1"))
+
+    assert projector.project(uow_factory) == 1
+    assert projector.project(uow_factory) == 0
+    assert sorted(view(sqlite_session_factory)) == [
+        ("o1", "sku", "b1"),
+        ("o2", "sku", "b1"),
+    ]
+
+
+def test_applies_each_run_of_events_in_one_statement(
+    in_memory_db, sqlite_session_factory, uow_factory
+):
+    add_to_outbox(
+        sqlite_session_factory,
+        *[events.Allocated(f"o{i}", "sku", 1, "b1") for i in range(50)],
+        *[events.Deallocated(f"o{i}", "sku", 1) for i in range(10)],
+    )
+    statements = []
+
+    @event.listens_for(in_memory_db, "before_cursor_execute")
+    def record(conn, cursor, statement, *args):
+        statements.append(statement.split()[0])
+
+    projector.project(uow_factory, batch_size=100)
+    event.remove(in_memory_db, "before_cursor_execute", record)
+
+    assert statements.count("INSERT") == 1
+    assert statements.count("DELETE") == 1
+    assert len(view(sqlite_session_factory)) == 40
+
+
+def test_projects_in_batches(sqlite_session_factory, uow_factory):
+    add_to_outbox(
+        sqlite_session_factory,
+        *[events.Allocated(f"o{i}", "sku", 1, "b1") for i in range(5)],
+    )
+
+    assert projector.project(uow_factory, batch_size=2) == 5
+    assert len(view(sqlite_session_factory)) == 5
+
+
+def test_does_not_wait_for_a_projection_already_running(
+    sqlite_session_factory, uow_factory
+):
+    add_to_outbox(sqlite_session_factory, events.Allocated("o1", "sku", 10, "b1"))
+
+    with projector.lock:
+        assert projector.project(uow_factory) == 0
+    assert view(sqlite_session_factory) == []
+
+
+def test_the_running_projection_picks_up_rows_it_was_asked_for(
+    sqlite_session_factory, uow_factory
+):
+    add_to_outbox(sqlite_session_factory, events.Allocated("o1", "sku", 10, "b1"))
+    asked = []
+
+    def invalidate(orderids):
+        # another thread commits and asks for a projection while this one runs
+        if not asked:
+            add_to_outbox(
+                sqlite_session_factory, events.Allocated("o2", "sku", 10, "b1")
+            )
+            thread = threading.Thread(
+                target=lambda: asked.append(projector.project(uow_factory))
+            )
+            thread.start()
+            thread.join()
+
+    assert projector.project(uow_factory, invalidate=invalidate) == 2
+    assert asked == [0]
+    assert sorted(view(sqlite_session_factory)) == [
+        ("o1", "sku", "b1"),
+        ("o2", "sku", "b1"),
+    ]
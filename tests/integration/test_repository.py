@@ -0,0 +1,89 @@
+import pytest
+from sqlalchemy import event
+from allocation.adapters import repository
+from allocation.domain import commands, model
+from allocation.service_layer import handlers, unit_of_work
+
+
+def add_product(session_factory, sku, batches, lines_per_batch):
+    session = session_factory()
+    product = model.Product(sku, [])
+    for b in range(batches):
+        batch = model.Batch(f"{sku}-batch{b}", sku, 1000, None)
+        for i in range(lines_per_batch):
+            batch.allocate(model.OrderLine(f"order-{b}-{i}", sku, 1))
+        product.add_batch(batch)
+    session.add(product)
+    session.commit()
+
+
+@pytest.fixture
+def statements(in_memory_db):
+    executed = []
+    record = lambda conn, cursor, statement, *args: executed.append(statement)
+    event.listen(in_memory_db, "before_cursor_execute", record)
+    yield executed
+    event.remove(in_memory_db, "before_cursor_execute", record)
+
+
+def selects(statements):
+    return [s for s in statements if s.lstrip().upper().startswith("SELECT")]
+
+
+@pytest.mark.parametrize(
+    "loading, expected_selects",
+    [
+        (repository.SELECTIN, 3),
+        (repository.JOINED, 2),
+        (repository.AGGREGATE, 1),
+    ],
+)
+def test_loading_strategy_query_count_does_not_grow_with_batches(
+    sqlite_session_factory, statements, loading, expected_selects
+):
+    add_product(sqlite_session_factory, "small", batches=2, lines_per_batch=3)
+    add_product(sqlite_session_factory, "large", batches=50, lines_per_batch=3)
+
+    for sku in ["small", "large"]:
+        statements.clear()
+        with unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory) as uow:
+            product = uow.products.get(sku, loading=loading)
+            assert len(product.batches) in (2, 50)
+            assert all(b.allocated_quantity == 3 for b in product.batches)
+        assert len(selects(statements)) == expected_selects
+
+
+def test_lazy_loading_issues_a_query_per_batch(sqlite_session_factory, statements):
+    add_product(sqlite_session_factory, "sku", batches=10, lines_per_batch=1)
+
+    statements.clear()
+    with unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory) as uow:
+        product = uow.products.get("sku", loading=repository.LAZY)
+        assert sum(b.allocated_quantity for b in product.batches) == 10
+    assert len(selects(statements)) == 12
+
+
+def test_get_by_batchref_uses_loading_strategy(sqlite_session_factory, statements):
+    add_product(sqlite_session_factory, "sku", batches=10, lines_per_batch=1)
+
+    statements.clear()
+    with unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory) as uow:
+        product = uow.products.get_by_batchref(
+            "sku-batch3", loading=repository.SELECTIN
+        )
+        assert sum(b.allocated_quantity for b in product.batches) == 10
+    assert len(selects(statements)) == 3
+
+
+@pytest.mark.parametrize("batches", [1, 20])
+def test_statements_per_allocate_command(sqlite_session_factory, statements, batches):
+    add_product(sqlite_session_factory, "sku", batches=batches, lines_per_batch=5)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+
+    statements.clear()
+    handlers.allocate(commands.Allocate("new-order", "sku", 10), uow)
+
+    # load product, batches and allocations; insert the line and its allocation;
+    # bump the product version; record the Allocated event in the outbox
+    assert len(selects(statements)) == 3
+    assert len(statements) == 7
@@ -0,0 +1,94 @@
+import functools
+import logging
+import pytest
+from unittest import mock
+from allocation import bootstrap
+from allocation.adapters import repository, sql_tracing
+from allocation.domain import commands
+from allocation.service_layer import messagebus, unit_of_work
+
+
+@pytest.fixture
+def sqlite_bus(sqlite_session_factory):
+    uow_factory = functools.partial(
+        unit_of_work.SqlAlchemyUnitOfWork, sqlite_session_factory
+    )
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow_factory=uow_factory,
+        notifications=mock.Mock(),
+        project=uow_factory,
+    )
+
+
+def test_statements_are_attributed_to_handler_and_message(sqlite_bus, sql_trace):
+    sqlite_bus.handle(commands.CreateBatch("b1", "lamp", 10, None))
+    sql_trace.clear()
+
+    sqlite_bus.handle(commands.Allocate("o1", "lamp", 1))
+
+    by_handler = {(s.handler, s.message) for s in sql_trace.statements}
+    assert by_handler == {("allocate", "Allocate"), ("-", "-")}
+    [insert] = [s for s in sql_trace.statements if "INSERT INTO order_lines" in s.sql]
+    assert insert.handler == "allocate"
+    assert insert.rows == 1
+
+
+def test_query_budgets(sqlite_bus, query_budget):
+    sqlite_bus.handle(commands.CreateBatch("b1", "lamp", 10, None))
+    sqlite_bus.handle(commands.CreateBatch("b2", "lamp", 10, None))
+    for i in range(5):
+        sqlite_bus.handle(commands.Allocate(f"o{i}", "lamp", 1))
+
+    # load the product, its batches and their allocations; write the outbox,
+    # the version and the new line
+    with query_budget(allocate=7):
+        sqlite_bus.handle(commands.Allocate("o5", "lamp", 1))
+
+    # the released lines move to b2 in the same transaction, whatever their number
+    with query_budget(change_batch_quantity=8, allocate=0):
+        sqlite_bus.handle(commands.ChangeBatchQuantity("b1", 2))
+
+
+def test_query_budget_fails_when_exceeded(sqlite_bus, query_budget):
+    sqlite_bus.handle(commands.CreateBatch("b1", "lamp", 10, None))
+
+    with pytest.raises(AssertionError, match="over budget"):
+        with query_budget(allocate=2):
+            sqlite_bus.handle(commands.Allocate("o1", "lamp", 1))
+
+
+def test_flags_repeated_statements_in_one_call(sqlite_bus, sql_trace, caplog):
+    for i in range(6):
+        sqlite_bus.handle(commands.CreateBatch(f"b{i}", "lamp", 1, None))
+        sqlite_bus.handle(commands.Allocate(f"o{i}", "lamp", 1))
+    sql_trace.clear()
+
+    def lazy_handler(command, uow):
+        # touching each batch's allocations lazy loads them one batch at a time
+        product = uow.products.get(command.sku, loading=repository.LAZY)
+        return sum(batch.allocated_quantity for batch in product.batches)
+
+    caplog.set_level(logging.WARNING, logger=sql_tracing.__name__)
+    command = commands.Allocate("o6", "lamp", 1)
+    with sqlite_bus.uow_factory() as uow, messagebus.HandlerCall(command, lazy_handler):
+        assert lazy_handler(command, uow) == 6
+
+    [repeated] = sql_trace.repeats()
+    assert repeated.handler == "lazy_handler"
+    assert "FROM order_lines" in repeated.sql
+    assert "an N+1?" in caplog.text
+
+
+def test_logs_slow_statements(in_memory_db, caplog):
+    tracer = sql_tracing.SqlTracer(slow_seconds=0).attach(in_memory_db)
+    caplog.set_level(logging.WARNING, logger=sql_tracing.__name__)
+    try:
+        with in_memory_db.connect() as conn:
+            conn.exec_driver_sql("SELECT 1")
+    finally:
+        tracer.detach(in_memory_db)
+
+    assert "slow statement" in caplog.text
+    assert "SELECT 1" in caplog.text
+    assert tracer.statements == []
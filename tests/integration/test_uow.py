@@ -1,6 +1,8 @@
+import json
 import pytest
 import time
 from sqlalchemy import text
+from allocation.adapters import repository
 from allocation.domain import model
 from allocation.service_layer import unit_of_work
 from conftest import random_batchref, random_orderid, random_sku
@@ -37,10 +39,10 @@ def get_allocated_batch_ref(sqlite_session_factory, orderid, sku):
     return batchref
 
 
-def try_to_allocate(orderid, sku, exceptions):
+def try_to_allocate(orderid, sku, exceptions, lock_mode=repository.OPTIMISTIC):
     line = model.OrderLine(orderid, sku, 10)
     try:
-        with unit_of_work.SqlAlchemyUnitOfWork() as uow:
+        with unit_of_work.SqlAlchemyUnitOfWork(lock_mode=lock_mode) as uow:
             product = uow.products.get(sku=sku)
             product.allocate(line)
             time.sleep(0.2)
@@ -130,3 +132,151 @@ def test_concurrent_updates_to_version_not_allowed(postgres_session_factory):
     assert len(orders) == 1
     with unit_of_work.SqlAlchemyUnitOfWork() as uow:
         uow.session.execute(text("SELECT 1"))
+
+
+@pytest.mark.parametrize("lock_mode", [repository.FOR_UPDATE, repository.ADVISORY])
+def test_postgres_lock_modes_serialise_updates(postgres_session_factory, lock_mode):
+    sku, batch = random_sku(), random_batchref()
+    session = postgres_session_factory()
+    insert_batch(session, batch, sku, 100, eta=None, product_version=1)
+    session.commit()
+
+    exceptions = []
+    threads = [
+        threading.Thread(
+            target=try_to_allocate, args=(random_orderid(i), sku, exceptions, lock_mode)
+        )
+        for i in range(2)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert exceptions == []
+    [[version]] = session.execute(
+        text("SELECT version_number FROM products WHERE sku=:sku"), dict(sku=sku)
+    )
+    assert version == 3
+
+
+def test_lock_modes_fall_back_to_optimistic_off_postgres(sqlite_session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        sqlite_session_factory, lock_mode=repository.ADVISORY
+    )
+    with uow:
+        assert uow.products.lock_mode == repository.OPTIMISTIC
+
+
+def test_rejects_unknown_lock_modes(sqlite_session_factory):
+    with pytest.raises(ValueError, match="Unknown lock mode"):
+        unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, lock_mode="hope")
+
+
+def test_loaded_product_allocates_to_earliest_batch(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, "shipment", "ORNATE-SOFA", 100, "2011-04-11")
+    session.execute(
+        text(
+            "INSERT INTO batches (reference, sku, _purchased_quantity, eta)"
+            " VALUES ('warehouse', 'ORNATE-SOFA', 100, null)"
+        )
+    )
+    session.commit()
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    with uow:
+        product = uow.products.get(sku="ORNATE-SOFA")
+        batchref = product.allocate(model.OrderLine("o1", "ORNATE-SOFA", 10))
+        uow.commit()
+
+    assert batchref == "warehouse"
+    assert get_allocated_batch_ref(session, "o1", "ORNATE-SOFA") == "warehouse"
+
+
+def test_running_totals_are_rebuilt_after_a_rollback(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, "batch1", "TINY-STOOL", 10, None)
+    session.commit()
+
+    product = repository.SqlAlchemyRepository(session).get(sku="TINY-STOOL")
+    [batch] = product.batches
+    assert product.allocate(model.OrderLine("o1", "TINY-STOOL", 10)) == "batch1"
+    session.rollback()
+
+    assert batch.available_quantity == 10
+    assert product.allocate(model.OrderLine("o2", "TINY-STOOL", 10)) == "batch1"
+
+
+def test_events_survive_until_collected(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, "batch1", "GENTLE-LAMP", 100, None)
+    session.commit()
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    with uow:
+        product = uow.products.get(sku="GENTLE-LAMP")
+        product.allocate(model.OrderLine("o1", "GENTLE-LAMP", 10))
+        uow.commit()
+    with uow:
+        pass
+
+    [event] = uow.collect_new_events()
+    assert event.orderid == "o1"
+    assert list(uow.collect_new_events()) == []
+
+
+def test_events_are_discarded_when_the_block_raises(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, "batch1", "GENTLE-LAMP", 100, None)
+    session.commit()
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    with pytest.raises(ZeroDivisionError):
+        with uow:
+            product = uow.products.get(sku="GENTLE-LAMP")
+            product.allocate(model.OrderLine("o1", "GENTLE-LAMP", 10))
+            1 / 0
+
+    assert list(uow.collect_new_events()) == []
+
+
+def outbox_orderids(session):
+    return [
+        json.loads(payload)["orderid"]
+        for [payload] in session.execute(text("SELECT payload FROM outbox"))
+    ]
+
+
+def test_published_events_are_written_to_the_outbox_on_commit(
+    sqlite_session_factory,
+):
+    session = sqlite_session_factory()
+    insert_batch(session, "batch1", "GENTLE-LAMP", 100, None)
+    session.commit()
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    with uow:
+        product = uow.products.get(sku="GENTLE-LAMP")
+        product.allocate(model.OrderLine("o1", "GENTLE-LAMP", 10))
+        product.allocate(model.OrderLine("o2", "GENTLE-LAMP", 1000))  # OutOfStock
+        uow.commit()
+        product.allocate(model.OrderLine("o3", "GENTLE-LAMP", 10))
+        uow.commit()
+    with uow:
+        uow.commit()
+
+    assert outbox_orderids(session) == ["o1", "o3"]
+
+
+def test_outbox_rows_roll_back_with_the_change(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, "batch1", "GENTLE-LAMP", 100, None)
+    session.commit()
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    with uow:
+        product = uow.products.get(sku="GENTLE-LAMP")
+        product.allocate(model.OrderLine("o1", "GENTLE-LAMP", 10))
+
+    assert outbox_orderids(session) == []
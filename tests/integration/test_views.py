@@ -1,3 +1,4 @@
+import functools
 import pytest
 from unittest import mock
 from conftest import today
@@ -5,22 +6,31 @@ from sqlalchemy.orm import clear_mappers
 from allocation.service_layer import unit_of_work
 from allocation.domain import commands
 from allocation import views, bootstrap
+from allocation.adapters import cache
 
 
 @pytest.fixture
-def sqlite_bus(sqlite_session_factory):
+def allocations_cache():
+    return cache.make_allocations_cache()
+
+
+@pytest.fixture
+def sqlite_bus(sqlite_session_factory, allocations_cache):
+    uow_factory = functools.partial(
+        unit_of_work.SqlAlchemyUnitOfWork, sqlite_session_factory
+    )
     bus = bootstrap.bootstrap(
         start_orm=False,
-        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+        uow_factory=uow_factory,
         notifications=mock.Mock(),
-        publish=lambda *args: None,
+        cache=allocations_cache,
+        project=uow_factory,
     )
     yield bus
     clear_mappers()
 
 
 def test_allocations_view(sqlite_bus):
-    sqlite_bus.handle(commands.CreateBatch("sku1batch", "sku1", 50, None))
     sqlite_bus.handle(commands.CreateBatch("sku1batch", "sku1", 50, None))
     sqlite_bus.handle(commands.CreateBatch("sku2batch", "sku2", 50, None))
     sqlite_bus.handle(commands.Allocate("order1", "sku1", 20))
@@ -31,7 +41,132 @@ def test_allocations_view(sqlite_bus):
     sqlite_bus.handle(commands.Allocate("otherorder", "sku1", 30))
     sqlite_bus.handle(commands.Allocate("otherorder", "sku2", 10))
 
-    assert views.allocations("order1", sqlite_bus.uow) == [
+    assert views.allocations("order1", sqlite_bus.uow_factory) == [
         {"sku": "sku1", "batchref": "sku1batch"},
         {"sku": "sku2", "batchref": "sku2batch"},
     ]
+
+
+def test_allocations_view_after_bulk_allocation(sqlite_bus):
+    sqlite_bus.handle(commands.CreateBatch("sku1batch", "sku1", 50, None))
+    sqlite_bus.handle(commands.CreateBatch("sku2batch", "sku2", 50, None))
+    sqlite_bus.handle(
+        commands.AllocateMany(
+            [
+                commands.Allocate("order1", "sku1", 20),
+                commands.Allocate("order1", "sku2", 20),
+                commands.Allocate("order2", "sku1", 20),
+            ]
+        )
+    )
+
+    order1 = views.allocations("order1", sqlite_bus.uow_factory)
+    assert sorted(order1, key=lambda row: row["sku"]) == [
+        {"sku": "sku1", "batchref": "sku1batch"},
+        {"sku": "sku2", "batchref": "sku2batch"},
+    ]
+    assert views.allocations("order2", sqlite_bus.uow_factory) == [
+        {"sku": "sku1", "batchref": "sku1batch"},
+    ]
+
+
+def test_cached_allocations_are_invalidated_by_the_projection(
+    sqlite_bus, allocations_cache
+):
+    sqlite_bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
+    sqlite_bus.handle(commands.Allocate("order1", "sku1", 20))
+    uow_factory = sqlite_bus.uow_factory
+
+    assert views.allocations("order1", uow_factory, allocations_cache) == [
+        {"sku": "sku1", "batchref": "b1"},
+    ]
+    assert views.allocations("order1", uow_factory, allocations_cache) == [
+        {"sku": "sku1", "batchref": "b1"},
+    ]
+    assert allocations_cache.stats == {"hits": [1], "misses": 1}
+
+    sqlite_bus.handle(commands.CreateBatch("b2", "sku1", 50, None))
+    sqlite_bus.handle(commands.ChangeBatchQuantity("b1", 10))
+
+    assert views.allocations("order1", uow_factory, allocations_cache) == [
+        {"sku": "sku1", "batchref": "b2"},
+    ]
+
+
+def test_allocations_for_orders_looks_up_many_orders_at_once(sqlite_bus, monkeypatch):
+    monkeypatch.setattr(views, "IN_CHUNK_SIZE", 2)
+    sqlite_bus.handle(commands.CreateBatch("b1", "sku1", 100, None))
+    sqlite_bus.handle(commands.CreateBatch("b2", "sku2", 100, None))
+    sqlite_bus.handle(
+        commands.AllocateMany(
+            [
+                commands.Allocate("o1", "sku1", 1),
+                commands.Allocate("o1", "sku2", 1),
+                commands.Allocate("o2", "sku1", 1),
+                commands.Allocate("o3", "sku2", 1),
+            ]
+        )
+    )
+
+    results = views.allocations_for_orders(
+        ["o1", "o2", "o3", "unknown", "o1"], sqlite_bus.uow_factory
+    )
+
+    assert list(results) == ["o1", "o2", "o3", "unknown"]
+    assert sorted(results["o1"], key=lambda row: row["sku"]) == [
+        {"sku": "sku1", "batchref": "b1"},
+        {"sku": "sku2", "batchref": "b2"},
+    ]
+    assert results["o2"] == [{"sku": "sku1", "batchref": "b1"}]
+    assert results["o3"] == [{"sku": "sku2", "batchref": "b2"}]
+    assert results["unknown"] == []
+
+
+def all_pages(list_page, key, uow_factory, limit):
+    rows, cursor = list_page(key, uow_factory, limit=limit)
+    pages = [rows]
+    while cursor is not None:
+        rows, cursor = list_page(key, uow_factory, after=cursor, limit=limit)
+        pages.append(rows)
+    return pages
+
+
+def test_allocations_for_sku_pages_by_cursor(sqlite_bus):
+    sqlite_bus.handle(commands.CreateBatch("b1", "sku1", 3, None))
+    sqlite_bus.handle(commands.CreateBatch("b2", "sku1", 100, None))
+    sqlite_bus.handle(commands.CreateBatch("b3", "sku2", 100, None))
+    for orderid in ["o5", "o1", "o4", "o2", "o3"]:
+        sqlite_bus.handle(commands.Allocate(orderid, "sku1", 1))
+    sqlite_bus.handle(commands.Allocate("o1", "sku2", 1))
+
+    pages = all_pages(views.allocations_for_sku, "sku1", sqlite_bus.uow_factory, 2)
+
+    assert [[row["orderid"] for row in page] for page in pages] == [
+        ["o1", "o2"],
+        ["o3", "o4"],
+        ["o5"],
+    ]
+    assert pages[0][0] == {"orderid": "o1", "sku": "sku1", "batchref": "b1"}
+    assert pages[1][0] == {"orderid": "o3", "sku": "sku1", "batchref": "b2"}
+
+
+def test_allocations_for_batch_has_no_next_page_when_it_ends_exactly(sqlite_bus):
+    sqlite_bus.handle(commands.CreateBatch("b1", "sku1", 100, None))
+    for orderid in ["o1", "o2", "o3", "o4"]:
+        sqlite_bus.handle(commands.Allocate(orderid, "sku1", 1))
+
+    pages = all_pages(views.allocations_for_batch, "b1", sqlite_bus.uow_factory, 2)
+
+    assert [[row["orderid"] for row in page] for page in pages] == [
+        ["o1", "o2"],
+        ["o3", "o4"],
+    ]
+
+
+@pytest.mark.parametrize(
+    "cursor",
+    ["not-base64!", "bm90IGpzb24=", "WzFd", "WzEsIDJd", "eyJhIjogImIiLCAiYyI6ICJkIn0="],
+)
+def test_invalid_cursor_is_rejected(sqlite_bus, cursor):
+    with pytest.raises(ValueError, match="Invalid cursor"):
+        views.allocations_for_sku("sku1", sqlite_bus.uow_factory, after=cursor)
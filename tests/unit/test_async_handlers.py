@@ -0,0 +1,118 @@
+import asyncio
+import pytest
+from collections import defaultdict
+from allocation import bootstrap
+from allocation.adapters import notifications, repository
+from allocation.domain import commands
+from allocation.domain.model import Product
+from allocation.service_layer import handlers, unit_of_work
+from conftest import today
+
+
+class FakeAsyncRepository(repository.AbstractAsyncRepository):
+    def __init__(self, products):
+        super().__init__()
+        self._products = set(products)
+
+    def _add(self, product):
+        self._products.add(product)
+
+    async def _get(self, sku, loading=None):
+        return next((p for p in self._products if p.sku == sku), None)
+
+    async def _get_by_batchref(self, batchref, loading=None) -> Product:
+        return next(
+            (p for p in self._products for b in p.batches if b.reference == batchref),
+            None,
+        )
+
+
+class FakeAsyncUnitOfWork(unit_of_work.AbstractAsyncUnitOfWork):
+
+    def __init__(self):
+        self.products = FakeAsyncRepository([])
+        self.committed = False
+
+    async def _commit(self):
+        self.committed = True
+
+    async def rollback(self):
+        pass
+
+
+class FakeAsyncNotifications(notifications.AbstractAsyncNotifications):
+
+    def __init__(self):
+        self.sent = defaultdict(list)
+
+    async def send(self, destination, message):
+        self.sent[destination].append(message)
+
+
+def bootstrap_test_app():
+    return bootstrap.async_bootstrap(
+        start_orm=False,
+        uow=FakeAsyncUnitOfWork(),
+        notifications=FakeAsyncNotifications(),
+    )
+
+
+def handle_all(bus, *messages):
+    async def handle():
+        return [await bus.handle(message) for message in messages]
+
+    return asyncio.run(handle())
+
+
+def test_add_batch_for_new_product():
+    bus = bootstrap_test_app()
+    handle_all(bus, commands.CreateBatch("b1", "ties", 100, None))
+    assert asyncio.run(bus.uow.products.get("ties"))
+    assert bus.uow.committed
+
+
+def test_allocate_returns_allocation():
+    bus = bootstrap_test_app()
+    [_, results] = handle_all(
+        bus,
+        commands.CreateBatch("b1", "penguin", 100, None),
+        commands.Allocate("o1", "penguin", 10),
+    )
+    assert results == ["b1"]
+
+
+def test_error_for_invalid_sku():
+    bus = bootstrap_test_app()
+    with pytest.raises(handlers.InvalidSku, match="Invalid sku"):
+        handle_all(bus, commands.Allocate("o1", "fakesku", 2))
+
+
+def test_sends_email_on_out_of_stock():
+    fake_notifications = FakeAsyncNotifications()
+    bus = bootstrap.async_bootstrap(
+        start_orm=False,
+        uow=FakeAsyncUnitOfWork(),
+        notifications=fake_notifications,
+    )
+    handle_all(
+        bus,
+        commands.CreateBatch("b1", "hyped-stuff", 9, None),
+        commands.Allocate("o1", "hyped-stuff", 400),
+    )
+    assert fake_notifications.sent["user@mail.com"] == ["Out of stock for hyped-stuff"]
+
+
+def test_reallocates_if_necessary():
+    bus = bootstrap_test_app()
+    handle_all(
+        bus,
+        commands.CreateBatch("batch1", "cat-table", 50, None),
+        commands.CreateBatch("batch2", "cat-table", 50, today),
+        commands.Allocate("o1", "cat-table", 20),
+        commands.Allocate("o2", "cat-table", 20),
+        commands.ChangeBatchQuantity("batch1", 25),
+    )
+    product = asyncio.run(bus.uow.products.get(sku="cat-table"))
+    [batch1, batch2] = product.batches
+    assert batch1.available_quantity == 5
+    assert batch2.available_quantity == 30
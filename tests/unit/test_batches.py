@@ -57,3 +57,43 @@ def test_can_only_deallocate_allocated_lines():
     batch, unallocated_line = make_batch_and_line("SOME-PRODUCT", 20, 2)
     batch.deallocate(unallocated_line)
     assert batch.available_quantity == 20
+
+
+def test_release_frees_the_excess_with_the_fewest_lines():
+    batch = Batch("batch-001", "SOME-PRODUCT", 20, eta=None)
+    lines = [
+        OrderLine(f"order-{i}", "SOME-PRODUCT", qty)
+        for i, qty in enumerate([2, 5, 5, 8])
+    ]
+    for line in lines:
+        batch.allocate(line)
+
+    batch.purchased_quantity = 9
+    # the largest line, then the smallest that covers what is left
+    assert batch.release(-batch.available_quantity) == [lines[3], lines[1]]
+    assert batch.allocated_quantity == 7
+    assert batch.available_quantity == 2
+
+
+def test_release_prefers_one_line_that_covers_the_excess():
+    batch = Batch("batch-001", "SOME-PRODUCT", 20, eta=None)
+    small, exact, large = [
+        OrderLine(f"order-{i}", "SOME-PRODUCT", qty) for i, qty in enumerate([1, 3, 16])
+    ]
+    for line in [small, exact, large]:
+        batch.allocate(line)
+
+    assert batch.release(3) == [exact]
+    assert batch.release(0) == []
+    assert batch.release(100) == [large, small]
+    assert batch.allocated_quantity == 0
+
+
+def test_allocated_quantity_tracks_many_lines():
+    batch = Batch("batch-001", "SOME-PRODUCT", 100, eta=None)
+    lines = [OrderLine(f"order-{i}", "SOME-PRODUCT", 3) for i in range(10)]
+    for line in lines:
+        batch.allocate(line)
+    batch.deallocate(lines[0])
+    assert batch.allocated_quantity == 27
+    assert batch.available_quantity == 73
@@ -0,0 +1,57 @@
+import smtplib
+from unittest import mock
+from allocation import bootstrap
+from allocation.adapters import redis_eventpublisher
+from allocation.service_layer import unit_of_work
+
+
+def test_bootstrap_does_not_connect_to_anything(monkeypatch):
+    def refuse(*args, **kwargs):
+        raise AssertionError("connected during bootstrap")
+
+    monkeypatch.setattr(smtplib, "SMTP", refuse)
+    unit_of_work.default_session_factory.cache_clear()
+    redis_eventpublisher.default_client.cache_clear()
+
+    bootstrap.bootstrap(start_orm=False)
+
+    assert unit_of_work.default_session_factory.cache_info().currsize == 0
+    assert redis_eventpublisher.default_client.cache_info().currsize == 0
+
+
+class DownRedis:
+    def ping(self):
+        raise ConnectionError("connection refused")
+
+
+def test_warm_up_carries_on_when_backends_are_down(monkeypatch, caplog):
+    def postgres_down():
+        raise ConnectionError("connection refused")
+
+    monkeypatch.setattr(bootstrap, "_connect_to_postgres", postgres_down)
+    monkeypatch.setattr(redis_eventpublisher, "default_client", DownRedis)
+
+    bootstrap.warm_up()
+
+    assert "Could not connect to postgres" in caplog.text
+    assert "Could not connect to redis" in caplog.text
+
+
+def test_default_units_of_work_are_projected():
+    bus = bootstrap.bootstrap(start_orm=False)
+
+    [hook] = bus.after_handle
+    assert hook.args == (unit_of_work.SqlAlchemyUnitOfWork,)
+
+
+def test_other_units_of_work_are_only_projected_when_asked():
+    uow_factory = mock.Mock()
+
+    assert (
+        bootstrap.bootstrap(start_orm=False, uow_factory=uow_factory).after_handle == []
+    )
+    bus = bootstrap.bootstrap(
+        start_orm=False, uow_factory=uow_factory, project=uow_factory
+    )
+    [hook] = bus.after_handle
+    assert hook.args == (uow_factory,)
@@ -0,0 +1,115 @@
+import json
+import fakeredis
+import redis
+from allocation import metrics
+from allocation.adapters import cache
+
+
+def test_lru_cache_evicts_least_recently_used():
+    lru = cache.LRUCache(max_size=2)
+    lru.set("a", 1)
+    lru.set("b", 2)
+    lru.get("a")
+    lru.set("c", 3)
+
+    assert lru.get("a") == 1
+    assert lru.get("b") is cache.MISSING
+    assert lru.get("c") == 3
+
+
+def test_lru_cache_entries_expire(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    lru = cache.LRUCache(ttl=2.0)
+    lru.set("a", 1)
+
+    now[0] += 1
+    assert lru.get("a") == 1
+    now[0] += 2
+    assert lru.get("a") is cache.MISSING
+
+
+def test_tiered_cache_counts_hits_per_tier_and_fills_upper_tiers():
+    local = cache.LRUCache()
+    shared = cache.RedisCache(fakeredis.FakeRedis())
+    tiered = cache.TieredCache(local, shared)
+    shared.set("k", [{"sku": "s1", "batchref": "b1"}])
+
+    assert tiered.get("k") == [{"sku": "s1", "batchref": "b1"}]
+    assert tiered.get("k") == [{"sku": "s1", "batchref": "b1"}]
+    assert tiered.get("other") is cache.MISSING
+    assert tiered.stats == {"hits": [1, 1], "misses": 1}
+
+
+def test_tiered_cache_publishes_lookups_per_tier():
+    tiered = cache.make_allocations_cache(fakeredis.FakeRedis())
+    counts = lambda: {
+        (tier, result): metrics.ALLOCATIONS_CACHE.labels(tier, result).value
+        for tier in ["local", "redis"]
+        for result in ["hit", "miss"]
+    }
+    before = counts()
+
+    tiered.get("k")
+    tiered.set("k", "v")
+    tiered.get("k")
+
+    after = counts()
+    assert {key: after[key] - before[key] for key in after} == {
+        ("local", "hit"): 1,
+        ("local", "miss"): 1,
+        ("redis", "hit"): 0,
+        ("redis", "miss"): 1,
+    }
+
+
+def test_tiered_cache_delete_many_clears_every_tier():
+    client = fakeredis.FakeRedis()
+    tiered = cache.make_allocations_cache(client)
+    tiered.set(cache.allocations_key("o1"), [])
+    tiered.set(cache.allocations_key("o2"), [])
+
+    cache.invalidator(tiered)(["o1", "o1"])
+
+    assert tiered.get(cache.allocations_key("o1")) is cache.MISSING
+    assert tiered.get(cache.allocations_key("o2")) == []
+    assert client.get("cache:allocations:o1") is None
+
+
+def test_tiered_cache_falls_back_when_redis_is_down():
+    server = fakeredis.FakeServer()
+    server.connected = False
+    tiered = cache.make_allocations_cache(fakeredis.FakeRedis(server=server))
+
+    assert tiered.get_or_load("k", lambda: "loaded") == "loaded"
+    assert tiered.get("k") == "loaded"
+
+
+def test_get_or_load_does_not_cache_a_value_invalidated_while_loading():
+    tiered = cache.make_allocations_cache()
+
+    def load():
+        tiered.delete_many(["k"])
+        return "stale"
+
+    assert tiered.get_or_load("k", load) == "stale"
+    assert tiered.get("k") is cache.MISSING
+    assert tiered.get_or_load("k", lambda: "fresh") == "fresh"
+    assert tiered.get("k") == "fresh"
+
+
+def test_get_or_load_does_not_cache_a_value_another_process_invalidated():
+    client = fakeredis.FakeRedis()
+    reader, projector = (cache.make_allocations_cache(client) for _ in range(2))
+
+    def load():
+        projector.delete_many([cache.allocations_key("o1")])
+        return []
+
+    assert reader.get_or_load(cache.allocations_key("o1"), load) == []
+    assert projector.get(cache.allocations_key("o1")) is cache.MISSING
+    assert client.get("cache:allocations:o1") is None
+
+    fresh = [{"sku": "s1", "batchref": "b1"}]
+    assert projector.get_or_load(cache.allocations_key("o1"), lambda: fresh) == fresh
+    assert json.loads(client.get("cache:allocations:o1")) == fresh
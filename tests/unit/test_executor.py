@@ -0,0 +1,108 @@
+import threading
+import pytest
+from allocation import bootstrap
+from allocation.domain import commands
+from allocation.service_layer.executor import ShardedExecutor
+from test_handlers import FakeNotifications, FakeUnitOFWork, bootstrap_test_app
+
+
+def skus_on_different_shards(executor, count):
+    skus = {}
+    i = 0
+    while len(skus) < count:
+        skus.setdefault(executor.shard_for(f"sku-{i}"), f"sku-{i}")
+        i += 1
+    return list(skus.values())
+
+
+@pytest.fixture
+def executor():
+    executor = ShardedExecutor(
+        bootstrap_test_app, workers=4, resolve_sku=lambda ref: None
+    )
+    yield executor
+    executor.shutdown()
+
+
+def test_same_sku_always_goes_to_the_same_shard(executor):
+    sku = "penguin"
+    executor.handle(commands.CreateBatch("b1", sku, 100, None))
+    results = [executor.submit(commands.Allocate(f"o{i}", sku, 1)) for i in range(50)]
+    assert [r.result() for r in results] == [["b1"]] * 50
+
+    [bus] = [bus for bus in executor.buses if bus.uow.products.get(sku) is not None]
+    [batch] = bus.uow.products.get(sku).batches
+    assert batch.available_quantity == 50
+
+
+def test_change_batch_quantity_is_routed_through_its_batchref():
+    resolved = []
+
+    def resolve_sku(ref):
+        resolved.append(ref)
+        return "penguin"
+
+    executor = ShardedExecutor(bootstrap_test_app, workers=4, resolve_sku=resolve_sku)
+    executor.handle(commands.CreateBatch("b1", "penguin", 100, None))
+    executor.handle(commands.Allocate("o1", "penguin", 60))
+    executor.handle(commands.ChangeBatchQuantity("b1", 80))
+    executor.handle(commands.ChangeBatchQuantity("b1", 70))
+    executor.shutdown()
+
+    assert resolved == ["b1"]
+    bus = executor.buses[executor.shard_for("penguin")]
+    [batch] = bus.uow.products.get("penguin").batches
+    assert batch.available_quantity == 10
+
+
+def test_batchrefs_not_found_yet_are_looked_up_again():
+    skus = {}
+    executor = ShardedExecutor(bootstrap_test_app, workers=4, resolve_sku=skus.get)
+
+    assert executor.sku_for(commands.ChangeBatchQuantity("b1", 80)) is None
+    skus["b1"] = "penguin"
+    assert executor.sku_for(commands.ChangeBatchQuantity("b1", 80)) == "penguin"
+    executor.shutdown()
+
+
+def test_allocate_many_is_split_by_shard_and_results_keep_their_order(executor):
+    skus = skus_on_different_shards(executor, 3)
+    for sku in skus:
+        executor.handle(commands.CreateBatch(f"batch-{sku}", sku, 10, None))
+
+    [results] = executor.handle(
+        commands.AllocateMany(
+            [commands.Allocate("o1", sku, 1) for sku in skus + ["unknown"]]
+        )
+    )
+
+    assert results == [
+        {"orderid": "o1", "sku": sku, "batchref": f"batch-{sku}"} for sku in skus
+    ] + [{"orderid": "o1", "sku": "unknown", "error": "Invalid sku: unknown"}]
+
+
+def test_different_skus_run_concurrently():
+    both_committing = threading.Barrier(2, timeout=5)
+
+    class SlowUnitOfWork(FakeUnitOFWork):
+        def _commit(self):
+            both_committing.wait()
+            super()._commit()
+
+    def bootstrap_slow_app():
+        return bootstrap.bootstrap(
+            start_orm=False,
+            uow=SlowUnitOfWork(),
+            notifications=FakeNotifications(),
+        )
+
+    executor = ShardedExecutor(
+        bootstrap_slow_app, workers=4, resolve_sku=lambda ref: None
+    )
+    first, second = skus_on_different_shards(executor, 2)
+    futures = [
+        executor.submit(commands.CreateBatch(f"batch-{sku}", sku, 10, None))
+        for sku in (first, second)
+    ]
+    assert [f.result() for f in futures] == [[None], [None]]
+    executor.shutdown()
@@ -1,5 +1,7 @@
 import pytest
-from allocation.domain import commands
+from sqlalchemy import exc
+from tenacity import wait_none
+from allocation.domain import commands, events
 from allocation.adapters import repository, notifications
 from allocation.domain.model import Product
 from allocation.service_layer import unit_of_work, messagebus, handlers
@@ -16,10 +18,10 @@ class FakeRepository(repository.AbstractRepository):
     def _add(self, product):
         self._products.add(product)
 
-    def _get(self, sku):
+    def _get(self, sku, loading=None):
         return next((p for p in self._products if p.sku == sku), None)
 
-    def _get_by_batchref(self, batchref) -> Product:
+    def _get_by_batchref(self, batchref, loading=None) -> Product:
         return next(
             (p for p in self._products for b in p.batches if b.reference == batchref),
             None,
@@ -53,10 +55,35 @@ def bootstrap_test_app():
         start_orm=False,
         uow=FakeUnitOFWork(),
         notifications=FakeNotifications(),
-        publish=lambda *args: None,
     )
 
 
+class SerializationFailure(Exception):
+    pgcode = "40001"
+
+
+class ConflictingUnitOfWork(FakeUnitOFWork):
+    def __init__(self, conflicts):
+        super().__init__()
+        self.conflicts = conflicts
+
+    def _commit(self):
+        if self.conflicts:
+            self.conflicts -= 1
+            raise exc.OperationalError("COMMIT", {}, SerializationFailure())
+        super()._commit()
+
+
+def bootstrap_conflicting_app(conflicts):
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=ConflictingUnitOfWork(conflicts),
+        notifications=FakeNotifications(),
+    )
+    bus.retry_wait = wait_none()
+    return bus
+
+
 class TestNotifications:
     def test_send_email_on_out_of_stock_error(self):
         fake_notif = FakeNotifications()
@@ -64,13 +91,102 @@ class TestNotifications:
             start_orm=False,
             uow=FakeUnitOFWork(),
             notifications=fake_notif,
-            publish=lambda *args: None,
         )
         bus.handle(commands.CreateBatch("b1", "hyped-stuff", 9, None))
         bus.handle(commands.Allocate("o1", "hyped-stuff", 400))
         assert fake_notif.sent["user@mail.com"] == ["Out of stock for hyped-stuff"]
 
 
+class TestMessageBus:
+    def test_rejects_unknown_messages(self):
+        bus = bootstrap_test_app()
+        with pytest.raises(Exception, match="was not an Event or Command"):
+            bus.handle("not a message")
+
+    def test_returns_command_results_in_order(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b1", "penguin", 10, None))
+        bus.handle(commands.CreateBatch("b2", "penguin", 5, today))
+        bus.handle(commands.Allocate("o1", "penguin", 10))
+
+        # the released line doesn't fit b2, so the domain raises a command to
+        # allocate it again, which finds nothing in stock either
+        assert bus.handle(commands.ChangeBatchQuantity("b1", 5)) == [None, None]
+
+    def test_after_handle_runs_once_per_top_level_message(self):
+        bus = bootstrap_test_app()
+        calls = []
+        bus.after_handle.append(lambda: calls.append(len(calls)))
+
+        bus.handle(commands.CreateBatch("b1", "sku", 100, None))
+        bus.handle(commands.Allocate("o1", "sku", 10))
+
+        assert calls == [0, 1]
+
+    def test_failing_after_handle_hooks_do_not_fail_the_message(self):
+        bus = bootstrap_test_app()
+
+        def broken():
+            raise ConnectionError()
+
+        bus.after_handle.append(broken)
+        bus.handle(commands.CreateBatch("b1", "sku", 100, None))
+
+    def test_after_handle_runs_when_the_message_fails(self):
+        bus = bootstrap_test_app()
+        calls = []
+        bus.after_handle.append(lambda: calls.append(True))
+
+        with pytest.raises(Exception):
+            bus.handle(commands.Allocate("o1", "nonexistent", 10))
+
+        assert calls == [True]
+
+
+class TestConflictRetry:
+    def test_retries_a_conflicting_command(self):
+        bus = bootstrap_conflicting_app(conflicts=0)
+        bus.handle(commands.CreateBatch("b1", "busy-lamp", 100, None))
+        bus.uow.conflicts = 2
+
+        [batchref] = bus.handle(commands.Allocate("o1", "busy-lamp", 10))
+
+        assert batchref == "b1"
+        assert bus.uow.committed
+        assert bus.retry_stats.retried == {"Allocate": 2}
+        assert bus.retry_stats.gave_up == {}
+
+    def test_gives_up_after_max_attempts(self):
+        bus = bootstrap_conflicting_app(conflicts=0)
+        bus.handle(commands.CreateBatch("b1", "busy-lamp", 100, None))
+        bus.uow.conflicts = bus.max_attempts
+
+        with pytest.raises(exc.OperationalError):
+            bus.handle(commands.Allocate("o1", "busy-lamp", 10))
+
+        assert bus.retry_stats.retried == {"Allocate": bus.max_attempts - 1}
+        assert bus.retry_stats.gave_up == {"Allocate": 1}
+
+    def test_does_not_retry_other_errors(self):
+        bus = bootstrap_conflicting_app(conflicts=0)
+        with pytest.raises(handlers.InvalidSku):
+            bus.handle(commands.Allocate("o1", "nonexistent", 10))
+        assert bus.retry_stats.retried == {}
+
+    def test_failed_attempts_raise_no_events(self):
+        bus = bootstrap_conflicting_app(conflicts=0)
+        bus.handle(commands.CreateBatch("b1", "busy-lamp", 100, None))
+        bus.uow.conflicts = 1
+        published = []
+        bus.event_handlers[events.Allocated] = [
+            lambda event, uow: published.append(event)
+        ]
+
+        bus.handle(commands.Allocate("o1", "busy-lamp", 10))
+
+        assert [e.orderid for e in published] == ["o1"]
+
+
 class TestAddBatch:
     def test_add_batch_for_new_product(self):
         bus = bootstrap_test_app()
@@ -108,6 +224,67 @@ class TestAllocate:
         assert bus.uow.committed
 
 
+class TestAllocateMany:
+    def test_allocates_every_line(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b1", "penguin", 100, None))
+        bus.handle(commands.CreateBatch("b2", "walrus", 100, None))
+
+        [results] = bus.handle(
+            commands.AllocateMany(
+                [
+                    commands.Allocate("o1", "penguin", 10),
+                    commands.Allocate("o1", "walrus", 20),
+                    commands.Allocate("o2", "penguin", 30),
+                ]
+            )
+        )
+
+        assert results == [
+            {"orderid": "o1", "sku": "penguin", "batchref": "b1"},
+            {"orderid": "o1", "sku": "walrus", "batchref": "b2"},
+            {"orderid": "o2", "sku": "penguin", "batchref": "b1"},
+        ]
+        [batch] = bus.uow.products.get("penguin").batches
+        assert batch.available_quantity == 60
+        assert bus.uow.committed
+
+    def test_reports_failures_per_line(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b1", "penguin", 10, None))
+
+        [results] = bus.handle(
+            commands.AllocateMany(
+                [
+                    commands.Allocate("o1", "penguin", 10),
+                    commands.Allocate("o1", "fakesku", 1),
+                    commands.Allocate("o2", "penguin", 1),
+                ]
+            )
+        )
+
+        assert results == [
+            {"orderid": "o1", "sku": "penguin", "batchref": "b1"},
+            {"orderid": "o1", "sku": "fakesku", "error": "Invalid sku: fakesku"},
+            {"orderid": "o2", "sku": "penguin", "error": "Out of stock for penguin"},
+        ]
+
+    def test_loads_each_product_once(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b1", "penguin", 100, None))
+        gets = []
+        get = bus.uow.products._get
+        bus.uow.products._get = lambda sku, loading: gets.append(sku) or get(sku)
+
+        bus.handle(
+            commands.AllocateMany(
+                [commands.Allocate(f"o{i}", "penguin", 1) for i in range(10)]
+            )
+        )
+
+        assert gets == ["penguin"]
+
+
 class TestChangeBatchQuantity:
     def test_changes_available_quantity(self):
         bus = bootstrap_test_app()
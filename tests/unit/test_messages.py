@@ -0,0 +1,22 @@
+import json
+import pickle
+from dataclasses import asdict
+from allocation.domain import commands, events
+
+
+def test_messages_have_no_instance_dict():
+    command = commands.Allocate("o1", "lamp", 1)
+    event = events.Allocated("o1", "lamp", 1, "b1")
+
+    assert not hasattr(command, "__dict__")
+    assert not hasattr(event, "__dict__")
+
+
+def test_messages_still_serialize_compare_and_pickle():
+    event = events.Deallocated("o1", "lamp", 1)
+
+    assert json.loads(json.dumps(asdict(event))) == dict(
+        orderid="o1", sku="lamp", qty=1
+    )
+    assert commands.Allocate(**asdict(event)) == commands.Allocate("o1", "lamp", 1)
+    assert pickle.loads(pickle.dumps(event)) == event
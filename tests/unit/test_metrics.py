@@ -0,0 +1,95 @@
+import requests
+from allocation import metrics
+from allocation.domain import commands
+from test_handlers import bootstrap_test_app
+
+
+def sample(name, **labels):
+    line_start = f"{name}{metrics.format_labels(tuple(sorted(labels.items())))} "
+    for line in metrics.render().splitlines():
+        if line.startswith(line_start):
+            return float(line[len(line_start) :])
+    return 0.0
+
+
+def test_histogram_renders_cumulative_buckets(monkeypatch):
+    monkeypatch.setattr(metrics, "REGISTRY", [])
+    histogram = metrics.Histogram(
+        "test_seconds", "Test timings", ["kind"], buckets=(0.1, 1)
+    )
+    for value in [0.05, 0.5, 5]:
+        histogram.labels("a").observe(value)
+
+    assert metrics.render().splitlines() == [
+        "# HELP test_seconds Test timings",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{kind="a",le="0.1"} 1',
+        'test_seconds_bucket{kind="a",le="1"} 2',
+        'test_seconds_bucket{kind="a",le="+Inf"} 3',
+        'test_seconds_sum{kind="a"} 5.55',
+        'test_seconds_count{kind="a"} 3',
+    ]
+
+
+def test_timer_counts_failures(monkeypatch):
+    monkeypatch.setattr(metrics, "REGISTRY", [])
+    histogram = metrics.Histogram("test_seconds", "Test timings", ["call"])
+    failures = metrics.Counter("test_failures_total", "Test failures", ["call"])
+
+    with metrics.Timer(histogram.labels("ok"), failures.labels("ok")):
+        pass
+    try:
+        with metrics.Timer(histogram.labels("broken"), failures.labels("broken")):
+            raise ValueError
+    except ValueError:
+        pass
+
+    assert sample("test_seconds_count", call="ok") == 1
+    assert sample("test_seconds_count", call="broken") == 1
+    assert sample("test_failures_total", call="broken") == 1
+    assert sample("test_failures_total", call="ok") == 0
+
+
+def test_label_values_are_escaped():
+    assert metrics.format_labels((("a", 'say "hi"\\\n'),)) == r'{a="say \"hi\"\\\n"}'
+
+
+def test_bus_records_handlers_messages_and_cascades():
+    bus = bootstrap_test_app()
+    before = {
+        "allocate": sample("allocation_handler_seconds_count", handler="allocate"),
+        "allocated": sample("allocation_message_seconds_count", type="Allocated"),
+        "cascades": sample("allocation_cascade_messages_count"),
+        "failures": sample("allocation_handler_failures_total", handler="allocate"),
+    }
+
+    bus.handle(commands.CreateBatch("b1", "lamp", 10, None))
+    bus.handle(commands.Allocate("o1", "lamp", 1))
+    try:
+        bus.handle(commands.Allocate("o2", "missing", 1))
+    except Exception:
+        pass
+
+    assert sample("allocation_handler_seconds_count", handler="allocate") == (
+        before["allocate"] + 2
+    )
+    assert sample("allocation_handler_failures_total", handler="allocate") == (
+        before["failures"] + 1
+    )
+    assert sample("allocation_message_seconds_count", type="Allocated") == (
+        before["allocated"] + 1
+    )
+    assert sample("allocation_cascade_messages_count") == before["cascades"] + 3
+
+
+def test_serves_metrics_over_http():
+    server = metrics.serve(0, host="localhost")
+    try:
+        url = f"http://localhost:{server.server_address[1]}"
+        r = requests.get(f"{url}/metrics")
+        assert r.headers["Content-Type"] == metrics.CONTENT_TYPE
+        assert "# TYPE allocation_handler_seconds histogram" in r.text
+        assert requests.get(f"{url}/other").status_code == 404
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,95 @@
+import atexit
+import threading
+from allocation.adapters import notifications
+from test_handlers import FakeNotifications
+
+
+class FailingNotifications(FakeNotifications):
+    def send(self, destination, message):
+        if destination == "broken@mail.com":
+            raise ConnectionError("no route to host")
+        super().send(destination, message)
+
+
+def test_repeated_messages_in_a_window_are_sent_as_one_digest():
+    fake = FakeNotifications()
+    background = notifications.BackgroundNotifications(fake, window=60)
+
+    for _ in range(3):
+        background.send("user@mail.com", "Out of stock for lamp")
+    background.send("user@mail.com", "Out of stock for chair")
+    background.send("other@mail.com", "Out of stock for lamp")
+    background.close()
+
+    assert fake.sent == {
+        "user@mail.com": ["Out of stock for lamp (x3)\nOut of stock for chair"],
+        "other@mail.com": ["Out of stock for lamp"],
+    }
+
+
+def test_send_does_not_wait_for_the_email_to_go_out():
+    sending = threading.Event()
+    release = threading.Event()
+
+    class SlowNotifications(FakeNotifications):
+        def send(self, destination, message):
+            sending.set()
+            release.wait()
+            super().send(destination, message)
+
+    slow = SlowNotifications()
+    background = notifications.BackgroundNotifications(slow, window=0)
+
+    background.send("user@mail.com", "first")
+    assert sending.wait(1)
+    background.send("user@mail.com", "second")
+    assert slow.sent == {}
+
+    release.set()
+    background.close()
+    assert slow.sent["user@mail.com"] == ["first", "second"]
+
+
+def test_a_failed_send_does_not_stop_the_worker():
+    failing = FailingNotifications()
+    background = notifications.BackgroundNotifications(failing, window=0)
+
+    background.send("broken@mail.com", "lost")
+    background.send("user@mail.com", "delivered")
+    background.close()
+
+    assert failing.sent == {"user@mail.com": ["delivered"]}
+
+
+def test_can_send_again_after_closing():
+    fake = FakeNotifications()
+    background = notifications.BackgroundNotifications(fake, window=0)
+    background.send("user@mail.com", "first")
+    background.close()
+
+    background.send("user@mail.com", "second")
+    background.close()
+
+    assert fake.sent["user@mail.com"] == ["first", "second"]
+
+
+def test_close_sends_what_was_queued_after_the_worker_stopped():
+    fake = FakeNotifications()
+    background = notifications.BackgroundNotifications(fake, window=0)
+    background.send("user@mail.com", "first")
+    background.close()
+
+    # what a send racing with close leaves behind
+    background.queue.put(("user@mail.com", "late"))
+    background.close()
+
+    assert fake.sent["user@mail.com"] == ["first", "late"]
+
+
+def test_close_is_registered_to_run_at_exit(monkeypatch):
+    registered = []
+    monkeypatch.setattr(atexit, "register", registered.append)
+
+    background = notifications.BackgroundNotifications(FakeNotifications(), window=0)
+
+    assert registered == [background.close]
@@ -1,5 +1,6 @@
+import random
 from datetime import date, timedelta
-from allocation.domain import events
+from allocation.domain import commands, events
 from allocation.domain.model import Product, OrderLine, Batch
 from conftest import random_sku, today, later, tomorrow
 
@@ -41,6 +42,17 @@ def test_increment_version_number():
     assert product.version_number == 421
 
 
+def test_every_change_increments_version_number():
+    # cached products are checked against it, so nothing may change unseen
+    sku = random_sku()
+    product = Product(sku, [Batch("b1", sku, 100, None)])
+
+    product.add_batch(Batch("b2", sku, 100, None))
+    assert product.version_number == 1
+    product.change_batch_quantity("b1", 50)
+    assert product.version_number == 2
+
+
 def test_records_out_of_stock_event_if_cannot_allocate():
     sku = random_sku()
     batch = Batch("b1", sku, 1, None)
@@ -50,3 +62,85 @@ def test_records_out_of_stock_event_if_cannot_allocate():
     allocation = product.allocate(order)
     assert product.events[-1] == events.OutOfStock(sku=sku)
     assert allocation is None
+
+
+def test_add_batch_keeps_eta_order():
+    sku = random_sku()
+    product = Product(sku, [Batch("late", sku, 100, later)])
+    product.add_batch(Batch("soon", sku, 100, tomorrow))
+    product.add_batch(Batch("in-stock", sku, 100, None))
+
+    assert product.allocate(OrderLine("o1", sku, 10)) == "in-stock"
+    assert [b.reference for b in product.batches] == ["late", "soon", "in-stock"]
+
+
+def test_skips_exhausted_batches():
+    sku = random_sku()
+    in_stock_batch = Batch("b1", sku, 10, None)
+    shipment_batch = Batch("b2", sku, 100, tomorrow)
+    product = Product(sku, [in_stock_batch, shipment_batch])
+
+    assert product.allocate(OrderLine("o1", sku, 10)) == "b1"
+    assert product.allocate(OrderLine("o2", sku, 10)) == "b2"
+
+
+def test_batch_with_raised_quantity_is_preferred_again():
+    sku = random_sku()
+    product = Product(sku, [Batch("b1", sku, 10, None), Batch("b2", sku, 100, today)])
+    product.allocate(OrderLine("o1", sku, 10))
+
+    product.change_batch_quantity("b1", 20)
+
+    assert product.allocate(OrderLine("o2", sku, 10)) == "b1"
+
+
+def test_shrinking_a_batch_moves_lines_to_other_batches():
+    sku = random_sku()
+    product = Product(sku, [Batch("b1", sku, 20, None), Batch("b2", sku, 20, today)])
+    product.allocate(OrderLine("o1", sku, 10))
+    product.allocate(OrderLine("o2", sku, 6))
+    product.events.clear()
+
+    product.change_batch_quantity("b1", 10)
+
+    assert product.events == [
+        events.Deallocated("o2", sku, 6),
+        events.Allocated("o2", sku, 6, "b2"),
+    ]
+    assert [b.available_quantity for b in product.batches] == [0, 14]
+
+
+def test_lines_with_nowhere_to_go_are_allocated_again_later():
+    sku = random_sku()
+    product = Product(sku, [Batch("b1", sku, 20, None), Batch("b2", sku, 5, today)])
+    product.allocate(OrderLine("o1", sku, 10))
+    product.allocate(OrderLine("o2", sku, 4))
+    product.events.clear()
+
+    product.change_batch_quantity("b1", 0)
+
+    assert product.events == [
+        events.Deallocated("o1", sku, 10),
+        events.Deallocated("o2", sku, 4),
+        commands.Allocate("o1", sku, 10),
+        events.Allocated("o2", sku, 4, "b2"),
+    ]
+
+
+def test_allocates_like_sorting_batches_by_eta():
+    rng = random.Random(42)
+    sku = random_sku()
+    etas = [None, today, tomorrow, later]
+    batches = [
+        Batch(f"b{i}", sku, rng.randint(1, 30), rng.choice(etas)) for i in range(40)
+    ]
+    reference = [Batch(b.reference, sku, b.purchased_quantity, b.eta) for b in batches]
+    product = Product(sku, batches)
+
+    for i in range(200):
+        line = OrderLine(f"o{i}", sku, rng.randint(1, 10))
+        expected = next((b for b in sorted(reference) if b.can_allocate(line)), None)
+        if expected:
+            expected.allocate(line)
+        allocation = product.allocate(line)
+        assert allocation == (expected.reference if expected else None)
@@ -0,0 +1,112 @@
+import concurrent.futures
+import json
+import fakeredis
+import pytest
+from allocation.domain import commands
+from allocation.entrypoints import redis_eventconsumer as consumer
+from allocation.service_layer.executor import ShardedExecutor
+from test_handlers import bootstrap_test_app
+
+
+@pytest.fixture
+def client():
+    client = fakeredis.FakeRedis()
+    consumer.create_group(client)
+    return client
+
+
+@pytest.fixture
+def executor():
+    executor = ShardedExecutor(bootstrap_test_app, workers=1, resolve_sku=str)
+    executor.handle(commands.CreateBatch("b1", "sku", 100, None))
+    yield executor
+    executor.shutdown()
+
+
+def publish(client, **data):
+    client.xadd(consumer.STREAM, {"data": json.dumps(data)})
+
+
+def batch(executor):
+    [bus] = executor.buses
+    [batch] = bus.uow.products.get("sku").batches
+    return batch
+
+
+def pending(client):
+    return client.xpending(consumer.STREAM, consumer.GROUP)["pending"]
+
+
+def test_create_group_is_idempotent(client):
+    consumer.create_group(client)
+
+
+def test_reads_in_batches_and_acks_handled_entries(client, executor):
+    for qty in [90, 80, 70]:
+        publish(client, batchref="b1", qty=qty)
+
+    assert consumer.consume(client, executor, "c1", count=2, block=None) == 2
+    assert batch(executor).available_quantity == 80
+    assert consumer.consume(client, executor, "c1", count=2, block=None) == 1
+    assert batch(executor).available_quantity == 70
+    assert pending(client) == 0
+
+
+def test_failed_entries_stay_pending_and_are_reclaimed(client, executor):
+    publish(client, batchref="unknown", qty=10)
+
+    consumer.consume(client, executor, "c1", block=None)
+    assert pending(client) == 1
+
+    # c1 died; c2 takes over once the entry has been idle long enough
+    [bus] = executor.buses
+    bus.handle(commands.CreateBatch("unknown", "sku", 100, None))
+    assert consumer.consume(client, executor, "c2", block=None, idle=0) == 1
+    assert pending(client) == 0
+
+
+def test_entries_after_a_failed_one_wait_for_it(client, executor):
+    class FlakyExecutor:
+        # fails the first command it is given, runs the rest
+        def __init__(self):
+            self.failed = False
+
+        def submit(self, command):
+            if not self.failed:
+                self.failed = True
+                future = concurrent.futures.Future()
+                future.set_exception(ConnectionError("database went away"))
+                return future
+            return executor.submit(command)
+
+    publish(client, batchref="b1", qty=50)
+    publish(client, batchref="b1", qty=70)
+    flaky = FlakyExecutor()
+
+    consumer.consume(client, flaky, "c1", block=None)
+    assert pending(client) == 2
+    assert batch(executor).purchased_quantity == 100
+
+    assert consumer.consume(client, flaky, "c2", block=None, idle=0) == 2
+    assert pending(client) == 0
+    assert batch(executor).purchased_quantity == 70
+
+
+def test_entries_are_dead_lettered_after_max_deliveries(client, executor):
+    publish(client, batchref="unknown", qty=10)
+
+    for _ in range(consumer.MAX_DELIVERIES):
+        consumer.consume(client, executor, "c1", block=None, idle=0)
+
+    assert pending(client) == 0
+    [(_, fields)] = client.xrange(consumer.DEAD_LETTERS)
+    assert json.loads(fields[b"data"]) == {"batchref": "unknown", "qty": 10}
+
+
+def test_malformed_entries_are_dead_lettered_straight_away(client, executor):
+    client.xadd(consumer.STREAM, {"data": "not json"})
+
+    consumer.consume(client, executor, "c1", block=None)
+
+    assert pending(client) == 0
+    assert client.xlen(consumer.DEAD_LETTERS) == 1
@@ -0,0 +1,59 @@
+import json
+import fakeredis
+from dataclasses import asdict
+from allocation import metrics
+from allocation.adapters import redis_eventpublisher
+from allocation.domain import events
+
+
+def allocated(orderid):
+    return events.Allocated(orderid, "sku", 10, "b1")
+
+
+def published(client, stream="line_allocated"):
+    return [
+        json.loads(fields[b"data"])["orderid"] for _, fields in client.xrange(stream)
+    ]
+
+
+def test_publishes_outbox_payloads_to_their_streams():
+    client = fakeredis.FakeRedis()
+    payload = json.dumps(asdict(allocated("o1")))
+
+    redis_eventpublisher.publish_all(
+        [("line_allocated", payload), ("line_deallocated", payload)], client
+    )
+
+    [(_, fields)] = client.xrange("line_allocated")
+    assert json.loads(fields[b"data"]) == {
+        "orderid": "o1",
+        "sku": "sku",
+        "qty": 10,
+        "batchref": "b1",
+    }
+    assert published(client, "line_deallocated") == ["o1"]
+
+
+def test_uses_the_default_client(monkeypatch):
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr(redis_eventpublisher, "default_client", lambda: client)
+
+    redis_eventpublisher.publish_all([("line_allocated", '{"orderid": "o1"}')])
+
+    assert published(client) == ["o1"]
+
+
+def test_times_each_pipeline_as_one_redis_call():
+    client = fakeredis.FakeRedis()
+    timings = metrics.ADAPTER_SECONDS.labels("redis")
+    before = sum(timings.counts)
+
+    redis_eventpublisher.publish_all(
+        [
+            ("line_allocated", '{"orderid": "o1"}'),
+            ("line_allocated", '{"orderid": "o2"}'),
+        ],
+        client,
+    )
+
+    assert sum(timings.counts) == before + 1